@@ -0,0 +1,14 @@
+"""Helpers shared by the benchmarks"""
+from cache import *
+
+
+class CountingStore(BackingStore):
+   """BackingStore that counts the writes made to it"""
+
+   def __init__(self, *args, **kwargs):
+      BackingStore.__init__(self, *args, **kwargs)
+      self.writes = 0
+
+   def __setitem__(self, key, val):
+      self.writes += 1
+      BackingStore.__setitem__(self, key, val)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3.5
+"""Compare the durability modes of BackingStore
+
+Writes a stream of keys, some of them overwritten, straight to a
+BackingStore in each durability mode, then through a write-back
+Cache chain whose evictions reach the store. Prints, per run, the
+time per write and the throughput.
+
+Usage:
+   $ cd path/to/Cache
+   $ env PYTHONPATH=.:$PYTHONPATH python benchmarks/durability.py
+"""
+import os
+import random
+import tempfile
+import time
+
+from cache import *
+
+
+def run(durability, through_cache, ops=2000, nkeys=500, seed=1):
+   """run one workload and return a dictionary of its measurements
+
+   Args:
+      durability: durability mode of the store
+      through_cache: if True, write through an L1 -> L2 chain above the
+         store instead of to the store directly
+      ops: int number of writes
+      nkeys: int number of distinct keys
+      seed: int seed of the random generator
+   """
+   rnd = random.Random(seed)
+   keys = [str(rnd.randrange(nkeys)) for i in range(ops)]
+   with tempfile.TemporaryDirectory() as tmp:
+      bs = BackingStore(nkeys, os.path.join(tmp, 'bench'),
+                        durability=durability)
+      mem = bs
+      if through_cache:
+         mem = Cache(16, lower_mem=Cache(64, lower_mem=bs))
+      with bs:
+         start = time.perf_counter()
+         for i, k in enumerate(keys):
+            mem[k] = i
+         elapsed = time.perf_counter() - start
+   return {
+      'us/write': elapsed / ops * 1e6,
+      'writes/s': ops / elapsed,
+   }
+
+
+def main():
+   print('{:<8}{:<8}{:>10}{:>12}'.format(
+      'writes', 'mode', 'us/write', 'writes/s'))
+   for name, through_cache in (('store', False), ('chain', True)):
+      for durability in BackingStore._DURABILITIES:
+         r = run(durability, through_cache)
+         print('{:<8}{:<8}{:>10.1f}{:>12.0f}'.format(
+            name, durability, r['us/write'], r['writes/s']))
+
+
+if __name__ == '__main__':
+   main()
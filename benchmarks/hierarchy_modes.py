@@ -0,0 +1,76 @@
+#!/usr/bin/env python3.5
+"""Compare the exclusive and inclusive hierarchy modes of a Cache chain
+
+Runs a read-heavy and a write-heavy workload of skewed key accesses
+against an L1 -> L2 -> BackingStore chain in each mode and prints, per
+run, the time per operation, the hit rate of each cache level and the
+number of reads and writes that reached the backing store.
+
+Usage:
+   $ cd path/to/Cache
+   $ env PYTHONPATH=.:$PYTHONPATH python benchmarks/hierarchy_modes.py
+"""
+import os
+import random
+import tempfile
+import time
+
+from cache import *
+from common import CountingStore
+
+
+def run(mode, read_ratio, ops=20000, nkeys=400, seed=1):
+   """run one workload and return a dictionary of its measurements
+
+   Args:
+      mode: 'exclusive' or 'inclusive'
+      read_ratio: float share of the operations that are reads
+      ops: int number of operations
+      nkeys: int number of distinct keys, accessed with a skewed
+         (Pareto) distribution
+      seed: int seed of the random generator
+   """
+   rnd = random.Random(seed)
+   keys = [str(min(int(rnd.paretovariate(1.2)) - 1, nkeys - 1))
+           for i in range(ops)]
+   reads = [rnd.random() < read_ratio for i in range(ops)]
+   with tempfile.TemporaryDirectory() as tmp:
+      bs = CountingStore(nkeys, os.path.join(tmp, 'bench'))
+      c2 = Cache(32, lower_mem=bs)
+      c1 = Cache(8, lower_mem=c2)
+      c1.set_mode(mode)
+      with c1:
+         for i in range(nkeys):
+            bs[str(i)] = i
+         bs.writes = 0
+         start = time.perf_counter()
+         for i, (k, read) in enumerate(zip(keys, reads)):
+            if read:
+               c1[k]
+            else:
+               c1[k] = i
+         elapsed = time.perf_counter() - start
+   s1, s2 = c1.stats(), c2.stats()
+   return {
+      'us/op': elapsed / ops * 1e6,
+      'L1 hit': s1['hits'] / (s1['hits'] + s1['misses']),
+      'L2 hit': s2['hits'] / max(1, s2['hits'] + s2['misses']),
+      'store reads': s2['misses'],
+      'store writes': bs.writes,
+   }
+
+
+def main():
+   print('{:<12}{:<11}{:>8}{:>8}{:>8}{:>13}{:>14}'.format(
+      'workload', 'mode', 'us/op', 'L1 hit', 'L2 hit', 'store reads',
+      'store writes'))
+   for name, read_ratio in (('read-heavy', 0.95), ('write-heavy', 0.5)):
+      for mode in ('exclusive', 'inclusive'):
+         r = run(mode, read_ratio)
+         print('{:<12}{:<11}{:>8.2f}{:>8.1%}{:>8.1%}{:>13}{:>14}'.format(
+            name, mode, r['us/op'], r['L1 hit'], r['L2 hit'],
+            r['store reads'], r['store writes']))
+
+
+if __name__ == '__main__':
+   main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3.5
+"""Compare an L1 cache that admits every value with one that routes
+large values to the levels below
+
+Runs a workload that keeps reading a hot set of small values while
+reading and writing large blobs now and then, against an L1 -> L2 ->
+BackingStore chain. Prints, per run, the time per operation, the hit
+rate of the small reads in L1 and the share of the items L1 turned
+away.
+
+Usage:
+   $ cd path/to/Cache
+   $ env PYTHONPATH=.:$PYTHONPATH python benchmarks/size_routing.py
+"""
+import os
+import random
+import tempfile
+import time
+
+from cache import *
+
+
+def run(max_entry_size, ops=20000, nsmall=24, nlarge=64, large_ratio=0.1,
+        seed=1):
+   """run the workload and return a dictionary of its measurements
+
+   Args:
+      max_entry_size: max_entry_size of the L1 cache, or None
+      ops: int number of operations
+      nsmall: int number of small hot keys, read uniformly
+      nlarge: int number of large keys
+      large_ratio: float share of the operations on a large key, half of
+         them writes
+      seed: int seed of the random generator
+   """
+   rnd = random.Random(seed)
+   blob = b'x' * 64 * 1024
+   with tempfile.TemporaryDirectory() as tmp:
+      bs = BackingStore(nsmall + nlarge, os.path.join(tmp, 'bench'))
+      c2 = Cache(128, lower_mem=bs)
+      c1 = Cache(32, lower_mem=c2, max_entry_size=max_entry_size)
+      with c1:
+         for i in range(nsmall):
+            bs['small' + str(i)] = i
+         for i in range(nlarge):
+            bs['large' + str(i)] = blob
+         hits = reads = 0
+         start = time.perf_counter()
+         for i in range(ops):
+            if rnd.random() < large_ratio:
+               k = 'large' + str(rnd.randrange(nlarge))
+               if rnd.random() < 0.5:
+                  c1[k] = blob
+               else:
+                  c1[k]
+            else:
+               k = 'small' + str(rnd.randrange(nsmall))
+               hits += k in c1
+               reads += 1
+               c1[k]
+         elapsed = time.perf_counter() - start
+   s1 = c1.stats()
+   routed = s1.get('admitted', 0) + s1.get('bypassed', 0)
+   return {
+      'us/op': elapsed / ops * 1e6,
+      'small L1 hit': hits / reads,
+      'bypassed': s1.get('bypassed', 0) / max(1, routed),
+   }
+
+
+def main():
+   print('{:<16}{:>8}{:>14}{:>10}'.format(
+      'L1 max size', 'us/op', 'small L1 hit', 'bypassed'))
+   for max_entry_size in (None, 1024):
+      r = run(max_entry_size)
+      print('{:<16}{:>8.2f}{:>14.1%}{:>10.1%}'.format(
+         str(max_entry_size), r['us/op'], r['small L1 hit'],
+         r['bypassed']))
+
+
+if __name__ == '__main__':
+   main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3.5
+"""Compare the write policies of the top level of a Cache chain
+
+Runs a workload that keeps reading a small hot set of keys while
+ingesting a stream of keys written once, against an L1 -> L2 ->
+BackingStore chain whose L1 is write-back, write-through or
+write-around. Prints, per policy, the time per operation, the hit rate
+of the hot reads in L1 and the number of writes that reached the
+backing store.
+
+Usage:
+   $ cd path/to/Cache
+   $ env PYTHONPATH=.:$PYTHONPATH python benchmarks/write_policies.py
+"""
+import os
+import random
+import tempfile
+import time
+
+from cache import *
+from common import CountingStore
+
+
+def run(policy, ops=20000, nhot=24, write_ratio=0.25, seed=1):
+   """run the workload and return a dictionary of its measurements
+
+   Args:
+      policy: write_policy of the L1 cache
+      ops: int number of operations
+      nhot: int number of hot keys, read uniformly
+      write_ratio: float share of the operations that write a new key
+      seed: int seed of the random generator
+   """
+   rnd = random.Random(seed)
+   with tempfile.TemporaryDirectory() as tmp:
+      bs = CountingStore(ops, os.path.join(tmp, 'bench'))
+      c2 = Cache(128, lower_mem=bs)
+      c1 = Cache(32, lower_mem=c2, write_policy=policy)
+      with c1:
+         for i in range(nhot):
+            bs['hot' + str(i)] = i
+         bs.writes = 0
+         hits = reads = 0
+         start = time.perf_counter()
+         for i in range(ops):
+            if rnd.random() < write_ratio:
+               c1['new' + str(i)] = i
+            else:
+               k = 'hot' + str(rnd.randrange(nhot))
+               hits += k in c1
+               reads += 1
+               c1[k]
+         elapsed = time.perf_counter() - start
+         c1.flush().wait()
+   return {
+      'us/op': elapsed / ops * 1e6,
+      'hot L1 hit': hits / reads,
+      'store writes': bs.writes,
+   }
+
+
+def main():
+   print('{:<15}{:>8}{:>12}{:>14}'.format(
+      'L1 policy', 'us/op', 'hot L1 hit', 'store writes'))
+   for policy in Cache._WRITE_POLICIES:
+      r = run(policy)
+      print('{:<15}{:>8.2f}{:>12.1%}{:>14}'.format(
+         policy, r['us/op'], r['hot L1 hit'], r['store writes']))
+
+
+if __name__ == '__main__':
+   main()
@@ -1,7 +1,496 @@
 #!/usr/bin/env python3.5
-from collections import OrderedDict
+from collections import OrderedDict, deque, namedtuple
 from collections.abc import MutableMapping
+import asyncio
+import bisect
+import concurrent.futures
+import contextlib
+import fnmatch
+import functools
+import glob
+import hashlib
+import heapq
+import itertools
+import math
+import multiprocessing
+import os
+import pickle
 import shelve
+import struct
+import sys
+import threading
+import time
+import weakref
+import zlib
+
+try:
+   from multiprocessing import shared_memory
+except ImportError:
+   shared_memory = None
+
+
+def _stable_hash(key):
+   # return a 64 bit hash of |key| that is the same in every process
+   #
+   # The builtin hash() of a string is salted per interpreter, so it
+   # can't be used for anything shared between processes or persisted.
+   #
+   # Args:
+   #     key: string (or any object with a stable repr) to hash
+   #
+   # Returns:
+   #     signed 64 bit int
+   if isinstance(key, str):
+      data = key.encode('utf-8')
+   elif isinstance(key, bytes):
+      data = key
+   else:
+      data = repr(key).encode('utf-8')
+   digest = hashlib.blake2b(data, digest_size=8).digest()
+   return int.from_bytes(digest, 'little', signed=True)
+
+
+def _locked(method):
+   # decorate a BackingStore method so it runs holding the store's lock
+   #
+   # Batched write-backs write to the store from worker threads, so every
+   # access to the underlying shelve goes through the lock.
+   @functools.wraps(method)
+   def wrapper(self, *args, **kwargs):
+      with self._lock:
+         return method(self, *args, **kwargs)
+   return wrapper
+
+
+class _OwnedLock():
+   # Represents a reentrant lock that knows if the calling thread holds it
+   #
+   # How many times each thread holds the lock is counted in a thread
+   # local, so a StoreManager can skip a store in use further up its
+   # caller's stack.
+
+   def __init__(self):
+      # instantiate an _OwnedLock object
+      self._lock = threading.RLock()
+      self._local = threading.local()
+
+   def owned(self):
+      # return True if the calling thread holds the lock
+      return getattr(self._local, 'depth', 0) > 0
+
+   def acquire(self, blocking=True):
+      # acquire the lock; return False if |blocking| is False and another
+      # thread holds it
+      if not self._lock.acquire(blocking):
+         return False
+      self._local.depth = getattr(self._local, 'depth', 0) + 1
+      return True
+
+   def release(self):
+      # release the lock once
+      self._local.depth -= 1
+      self._lock.release()
+
+   def __enter__(self):
+      self.acquire()
+      return self
+
+   def __exit__(self, *exc_info):
+      self.release()
+
+
+class _BloomFilter():
+   # Represents a Bloom filter over string keys
+   #
+   # Answers "definitely not present" or "maybe present". Keys can't be
+   # removed; the owner rebuilds the filter once enough keys have been
+   # removed to matter.
+
+   def __init__(self, capacity, error_rate):
+      # instantiate a _BloomFilter object
+      #
+      # Args:
+      #     capacity: int number of keys the filter is sized for
+      #     error_rate: float false positive rate wanted at |capacity|
+      #        keys
+      bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+      self._nbits = max(8, bits)
+      self._nhashes = max(1, round(self._nbits / capacity * math.log(2)))
+      self._bits = bytearray((self._nbits + 7) // 8)
+
+   def _positions(self, key):
+      # yield the bit positions of |key|, using double hashing
+      data = key.encode('utf-8') if isinstance(key, str) else \
+         repr(key).encode('utf-8')
+      digest = hashlib.blake2b(data, digest_size=16).digest()
+      h1 = int.from_bytes(digest[:8], 'little')
+      h2 = int.from_bytes(digest[8:], 'little') | 1
+      for i in range(self._nhashes):
+         yield (h1 + i * h2) % self._nbits
+
+   def add(self, key):
+      # add |key| to the filter
+      for pos in self._positions(key):
+         self._bits[pos >> 3] |= 1 << (pos & 7)
+
+   def __contains__(self, key):
+      # return False if |key| was never added; True if it may have been
+      return all(self._bits[pos >> 3] & (1 << (pos & 7))
+                 for pos in self._positions(key))
+
+   def clear(self):
+      # remove every key from the filter
+      self._bits = bytearray(len(self._bits))
+
+
+class _SortedKeys():
+   # Represents a set of keys kept in sorted order
+   #
+   # The keys are held in sorted runs of up to 2 * _RUN keys, with the
+   # last key of each run in _maxes. Finding a key is two binary
+   # searches, and adding or removing one only shifts the keys of its
+   # run.
+
+   _RUN = 512
+
+   def __init__(self, keys=()):
+      # instantiate a _SortedKeys object holding |keys|
+      keys = sorted(set(keys))
+      self._runs = [keys[i:i + self._RUN]
+                    for i in range(0, len(keys), self._RUN)]
+      self._maxes = [run[-1] for run in self._runs]
+      self._len = len(keys)
+
+   def __len__(self):
+      return self._len
+
+   def __contains__(self, key):
+      i = bisect.bisect_left(self._maxes, key)
+      if i == len(self._runs):
+         return False
+      run = self._runs[i]
+      j = bisect.bisect_left(run, key)
+      return j < len(run) and run[j] == key
+
+   def add(self, key):
+      # add |key| unless it's already there
+      if not self._runs:
+         self._runs.append([key])
+         self._maxes.append(key)
+         self._len = 1
+         return
+      i = bisect.bisect_left(self._maxes, key)
+      if i == len(self._runs):
+         i -= 1
+         run = self._runs[i]
+         run.append(key)
+         self._maxes[i] = key
+      else:
+         run = self._runs[i]
+         j = bisect.bisect_left(run, key)
+         if j < len(run) and run[j] == key:
+            return
+         run.insert(j, key)
+      self._len += 1
+      if len(run) > 2 * self._RUN:
+         self._runs[i:i + 1] = [run[:self._RUN], run[self._RUN:]]
+         self._maxes[i:i + 1] = [run[self._RUN - 1], run[-1]]
+
+   def discard(self, key):
+      # remove |key| if it's there
+      i = bisect.bisect_left(self._maxes, key)
+      if i == len(self._runs):
+         return
+      run = self._runs[i]
+      j = bisect.bisect_left(run, key)
+      if j == len(run) or run[j] != key:
+         return
+      del run[j]
+      self._len -= 1
+      if run:
+         self._maxes[i] = run[-1]
+      else:
+         del self._runs[i]
+         del self._maxes[i]
+
+   def clear(self):
+      # remove every key
+      self._runs = []
+      self._maxes = []
+      self._len = 0
+
+   def after(self, key, count, inclusive=True):
+      # return a list of up to |count| keys from |key| on, in order
+      #
+      # Args:
+      #     key: key to start at, or None to start at the smallest key
+      #     count: int maximum number of keys returned
+      #     inclusive: if True, |key| itself is returned if present
+      if key is None:
+         i = j = 0
+      else:
+         find = bisect.bisect_left if inclusive else bisect.bisect_right
+         i = find(self._maxes, key)
+         j = find(self._runs[i], key) if i < len(self._runs) else 0
+      keys = []
+      while i < len(self._runs) and len(keys) < count:
+         keys.extend(self._runs[i][j:j + count - len(keys)])
+         i += 1
+         j = 0
+      return keys
+
+
+class _TagIndex():
+   # Represents the tags of the keys of a chain, with a reverse index
+   #
+   # Maps each tagged key to its tags, and each tag to its keys, so the
+   # keys of a tag are found without looking at any other key.
+
+   def __init__(self):
+      # instantiate an empty _TagIndex object
+      self._tags = {}
+      self._keys = {}
+      self.sweep_at = 1024
+
+   def __len__(self):
+      # return the number of tagged keys
+      return len(self._tags)
+
+   def tag(self, key, tags):
+      # set the tags of |key| to |tags|, replacing any it had
+      self.untag(key)
+      if tags:
+         self._tags[key] = set(tags)
+         for t in tags:
+            self._keys.setdefault(t, set()).add(key)
+
+   def untag(self, key):
+      # remove every tag of |key|
+      for t in self._tags.pop(key, ()):
+         keys = self._keys[t]
+         keys.discard(key)
+         if not keys:
+            del self._keys[t]
+
+   def tags_of(self, key):
+      # return a frozenset of the tags of |key|
+      return frozenset(self._tags.get(key, ()))
+
+   def pop_tag(self, tag):
+      # remove |tag| from every key and return the set of those keys
+      keys = self._keys.pop(tag, set())
+      for k in keys:
+         tags = self._tags[k]
+         tags.discard(tag)
+         if not tags:
+            del self._tags[k]
+      return keys
+
+   def keys(self):
+      # return a list of the tagged keys
+      return list(self._tags)
+
+
+class _ReadBufferedDict(OrderedDict):
+   # Represents the items of a Cache read through a snapshot
+   #
+   # Every change to the items takes |lock| and drops the snapshot, a
+   # plain dictionary of the unwrapped values that is never changed once
+   # published. Reads look the snapshot up without locking and record
+   # the key read in their thread's stripe of the read buffer. A stripe
+   # that fills up is drained, moving its keys to the end of the LRU
+   # order, only if the lock is free, and stripes drop their oldest
+   # reads when they overflow. Evictions drain every stripe first.
+
+   def __init__(self, stripes=4, drain_at=32, items=()):
+      # instantiate a _ReadBufferedDict object holding |items|
+      super().__init__()
+      self.lock = threading.RLock()
+      self.drain_at = drain_at
+      self.stripes = [deque(maxlen=4 * drain_at) for i in range(stripes)]
+      self._next_stripe = itertools.count()
+      self._local = threading.local()
+      self._snap = None
+      for k, v in items:
+         OrderedDict.__setitem__(self, k, v)
+
+   def __reduce__(self):
+      # copy and pickle the items, but neither the lock nor the buffer
+      return (self.__class__, (len(self.stripes), self.drain_at),
+              None, None, iter(self.items()))
+
+   def __setitem__(self, key, val):
+      with self.lock:
+         OrderedDict.__setitem__(self, key, val)
+         self._snap = None
+
+   def __delitem__(self, key):
+      with self.lock:
+         OrderedDict.__delitem__(self, key)
+         self._snap = None
+
+   def pop(self, *args):
+      with self.lock:
+         self._snap = None
+         return OrderedDict.pop(self, *args)
+
+   def popitem(self, last=True):
+      with self.lock:
+         if not last:
+            self.drain()
+         self._snap = None
+         return OrderedDict.popitem(self, last)
+
+   def move_to_end(self, key, last=True):
+      with self.lock:
+         OrderedDict.move_to_end(self, key, last)
+
+   def clear(self):
+      with self.lock:
+         OrderedDict.clear(self)
+         for stripe in self.stripes:
+            stripe.clear()
+         self._snap = None
+
+   def update(self, *args, **kwargs):
+      with self.lock:
+         OrderedDict.update(self, *args, **kwargs)
+         self._snap = None
+
+   def snapshot(self):
+      # return the published snapshot, publishing one if the lock is free
+      #
+      # Returns:
+      #     dictionary of keys to unwrapped values, or None if there is
+      #     none and the lock is held by a writer
+      snap = self._snap
+      if snap is None and self.lock.acquire(False):
+         try:
+            snap = self._snap = {k: v.val for k, v in self.items()}
+         finally:
+            self.lock.release()
+      return snap
+
+   def touch(self, key):
+      # record a read of |key| and drain the stripe if it is full
+      try:
+         stripe = self._local.stripe
+      except AttributeError:
+         stripe = self._local.stripe = self.stripes[
+            next(self._next_stripe) % len(self.stripes)]
+      stripe.append(key)
+      if len(stripe) >= self.drain_at and self.lock.acquire(False):
+         try:
+            self._drain(stripe)
+         finally:
+            self.lock.release()
+
+   def drain(self):
+      # apply every buffered read to the LRU order
+      with self.lock:
+         for stripe in self.stripes:
+            self._drain(stripe)
+
+   def _drain(self, stripe):
+      # apply the reads of |stripe| to the LRU order. Hold the lock.
+      while stripe:
+         key = stripe.popleft()
+         if OrderedDict.__contains__(self, key):
+            OrderedDict.move_to_end(self, key)
+
+
+class _Refresher():
+   # Represents the reload state of a Cache with a loader
+   #
+   # Keeps, per key, when its value was loaded or set and when it was
+   # last read, and the reloads running on the executor. Reloads are
+   # only handed back through |done|, so the cache itself is never
+   # touched from the executor's threads.
+
+   def __init__(self, loader, ttl, stale_ttl, refresh_ahead, executor):
+      # instantiate a _Refresher object. See Cache.enable_refresh()
+      self.loader = loader
+      self.ttl = ttl
+      self.stale_ttl = stale_ttl
+      self.refresh_ahead = refresh_ahead
+      self.own_executor = executor is None
+      self.executor = executor or concurrent.futures.ThreadPoolExecutor(
+         max_workers=4, thread_name_prefix='cache-refresh')
+      self.born = {}
+      self.read_at = {}
+      self.inflight = {}
+      self.done = deque()
+      self.sweep_at = 1024
+
+   def schedule(self, key):
+      # start reloading |key| on the executor unless it already is
+      #
+      # Returns:
+      #     True if a reload was started; False otherwise
+      if key in self.inflight:
+         return False
+      started = time.monotonic()
+      future = self.executor.submit(self.loader, key)
+      self.inflight[key] = future
+      future.add_done_callback(
+         lambda f: self.done.append((key, f, started)))
+      return True
+
+   def prune(self, now):
+      # forget keys whose value is too old to be served anyway
+      #
+      # A key of unknown age counts as expired, so this changes nothing
+      # but memory use. Runs when the number of keys has doubled since
+      # the last pruning.
+      limit = now - self.ttl - self.stale_ttl
+      for k in [k for k, t in self.born.items() if t < limit]:
+         del self.born[k]
+         if self.read_at.get(k, limit) <= limit:
+            self.read_at.pop(k, None)
+      self.sweep_at = max(1024, 2 * len(self.born))
+
+
+class _View():
+   # Represents a lazy view of the keys, items or values of a container
+   #
+   # Iterating the view streams the elements from the container instead
+   # of copying them into a list first, and reflects its current content.
+   # For the sake of code written against the lists these views replace,
+   # a view compares equal to a list or tuple of the same elements in
+   # the same order.
+
+   def __init__(self, iterate, size, contains=None):
+      # instantiate a _View object
+      #
+      # Args:
+      #     iterate: callable returning a new iterator over the elements
+      #     size: callable returning the number of elements
+      #     contains: callable testing an element for membership. By
+      #        default, the elements are searched one by one
+      self._iterate = iterate
+      self._size = size
+      self._contains = contains
+
+   def __iter__(self):
+      return self._iterate()
+
+   def __len__(self):
+      return self._size()
+
+   def __contains__(self, elem):
+      if self._contains is not None:
+         return self._contains(elem)
+      return any(e == elem for e in self._iterate())
+
+   def __eq__(self, other):
+      if isinstance(other, (_View, list, tuple)):
+         return list(self) == list(other)
+      return NotImplemented
+
+   __hash__ = None
+
+   def __repr__(self):
+      return '{}({})'.format(type(self).__name__, list(self))
 
 
 class CacheMiss(Exception):
@@ -28,6 +517,19 @@ class BStoreClosedError(Exception):
       return "Backing store not open"
 
 
+StoreReport = namedtuple('StoreReport', ['error', 'entries', 'unreadable',
+                                         'journal_records', 'journal_torn'])
+StoreReport.__doc__ = """Report returned by BackingStore.verify()
+
+   error: string describing why the database couldn't be opened, or None
+   entries: number of entries in the database
+   unreadable: list of keys whose value can't be unpickled
+   journal_records: number of journal records open() would replay
+   journal_torn: True if the journal ends with a partly written or
+      corrupt record, which is ignored
+"""
+
+
 class BackingStore(MutableMapping):
    """Backing Store class. Link this to a Cache object
 
@@ -42,29 +544,377 @@ class BackingStore(MutableMapping):
 
    def _raise_on_bstore_closed(self):
       # if the backing store is closed, raise a BStoreClosedError
-      if self.closed():
-         raise BStoreClosedError
+      #
+      # A store of a StoreManager whose database the manager closed, or
+      # hasn't opened yet, has it opened instead.
+      if self._db is None:
+         if self._manager is None or not self._opened:
+            raise BStoreClosedError
+         self._manager._acquire(self)
+         try:
+            self._open_db()
+         except BaseException:
+            self._manager._release(self)
+            raise
+      elif self._manager is not None:
+         self._manager._touch(self)
 
    def _trim_to_capacity(self):
       # trim down the contents in the backing store until equal to the
       # maximum capacity. Data is removed randomly.
       if self._db is not None:
-         while len(self._db) > self._capacity:
-            self._db.popitem()
+         while self._db_len() > self._capacity:
+            self._note_remove(self._db_popitem()[0])
+
+   _TRIM_STEP = 8
+
+   def _limit(self):
+      # return the size writing to the store may grow it to
+      #
+      # That is the capacity, unless a lazily opened store still holds
+      # more than that. It then shrinks by at most _TRIM_STEP keys per
+      # write, so trimming it costs little on each of the writes that
+      # follow opening it.
+      excess = self._db_len() + len(self._pending_new) - self._capacity
+      return self._capacity + max(0, excess - BackingStore._TRIM_STEP)
+
+   def _meta_path(self):
+      # return the path of the file the entry count is kept in
+      return self._dbname + '.meta'
+
+   def _load_count(self):
+      # return the entry count saved by the last close(), and forget it
+      #
+      # The count is only valid until the database changes, so it is
+      # removed as soon as it is read.
+      try:
+         with open(self._meta_path(), 'rb') as f:
+            count = pickle.load(f)
+         os.remove(self._meta_path())
+      except (OSError, EOFError, pickle.UnpicklingError):
+         return None
+      return count if isinstance(count, int) else None
+
+   def _db_len(self):
+      # return the number of entries in the database
+      return len(self._db) if self._count is None else self._count
+
+   _DURABILITIES = ('none', 'group', 'fsync')
+   _DB_SUFFIXES = ('', '.db', '.dat', '.dir', '.bak', '.pag')
+   _J_SET, _J_DEL, _J_CLEAR = 1, 2, 3
+   _J_HEADER = struct.Struct('<IBII')
+
+   def _journal_path(self):
+      # return the path of the file the journal is kept in
+      return self._dbname + '.journal'
+
+   def _log(self, op, key=None, blob=b''):
+      # append a record of an operation to the journal, if one is kept
+      #
+      # A record is a header of the crc32 of the rest of the record, the
+      # operation, and the lengths of the key and of the pickled value,
+      # followed by the key and the pickled value. The record is appended
+      # before the operation is applied to the database; the caller
+      # commits the journal with _commit_journal() once it is applied.
+      #
+      # Args:
+      #    op: _J_SET, _J_DEL or _J_CLEAR
+      #    key: string representing the key, if any
+      #    blob: bytes of the pickled value of a _J_SET
+      if self._journal is None:
+         return
+      kb = b'' if key is None else key.encode('utf-8')
+      body = struct.pack('<BII', op, len(kb), len(blob)) + kb + blob
+      self._journal.write(struct.pack('<I', zlib.crc32(body)) + body)
+      self._journal_records += 1
+
+   def _commit_journal(self):
+      # make the records written so far durable, per the durability mode
+      #
+      # Must only be called once the logged operations are applied to the
+      # database: once the journal holds capacity records, the database
+      # is synced and the journal emptied.
+      if self._journal is None:
+         return
+      if self._journal_records >= self._capacity:
+         self._checkpoint()
+      elif self._durability == 'fsync':
+         self._sync_journal()
+      elif self._sync_timer is None:
+         self._sync_timer = threading.Timer(self._group_commit,
+                                            self._sync_journal)
+         self._sync_timer.daemon = True
+         self._sync_timer.start()
+
+   @_locked
+   def _sync_journal(self):
+      # flush the journal to disk
+      if self._sync_timer is not None:
+         self._sync_timer.cancel()
+         self._sync_timer = None
+      if self._journal is not None:
+         self._journal.flush()
+         os.fsync(self._journal.fileno())
+
+   def _fsync_db_files(self):
+      # flush the files of the closed or synced database to disk
+      for suffix in BackingStore._DB_SUFFIXES:
+         try:
+            fd = os.open(self._dbname + suffix, os.O_RDONLY)
+         except OSError:
+            continue
+         try:
+            os.fsync(fd)
+         finally:
+            os.close(fd)
+
+   def _checkpoint(self):
+      # sync the database to disk and empty the journal
+      self._db.sync()
+      self._fsync_db_files()
+      self._journal.seek(0)
+      self._journal.truncate()
+      self._journal_records = 0
+      self._sync_journal()
+
+   def _read_journal(self):
+      # return the records of the journal and whether its tail is torn
+      #
+      # Returns:
+      #    (list of (op, key, blob) triples, True if the journal ends
+      #    with a partial or corrupt record) pair
+      try:
+         with open(self._journal_path(), 'rb') as f:
+            data = f.read()
+      except OSError:
+         return [], False
+      records = []
+      pos = 0
+      size = BackingStore._J_HEADER.size
+      while pos + size <= len(data):
+         crc, op, klen, blen = BackingStore._J_HEADER.unpack_from(data, pos)
+         end = pos + size + klen + blen
+         if end > len(data) or \
+               zlib.crc32(data[pos + 4:end]) != crc:
+            break
+         key = data[pos + size:pos + size + klen]
+         records.append((op, key, data[pos + size + klen:end]))
+         pos = end
+      return records, pos != len(data)
+
+   def _replay(self, db, records):
+      # apply journal |records| to the shelf |db|
+      for op, key, blob in records:
+         key = key.decode('utf-8')
+         if op == BackingStore._J_SET:
+            db[key] = pickle.loads(blob)
+         elif op == BackingStore._J_DEL:
+            try:
+               del db[key]
+            except KeyError:
+               pass
+         else:
+            db.clear()
+
+   def _db_set(self, key, value, commit=True):
+      # write |value| for |key| to the database, journaling the write
+      if self._count is not None and key not in self._db:
+         self._count += 1
+      if self._journal is not None:
+         self._log(BackingStore._J_SET, key, pickle.dumps(value))
+      self._db[key] = value
+      if commit:
+         self._commit_journal()
+
+   def _db_pop(self, key, default=__marker):
+      # remove |key| from the database, journaling the removal
+      #
+      # Raises:
+      #    KeyError: |key| isn't in the database and |default| isn't given
+      if key not in self._db:
+         if default is BackingStore.__marker:
+            raise KeyError(key)
+         return default
+      self._log(BackingStore._J_DEL, key)
+      value = self._db.pop(key)
+      if self._count is not None:
+         self._count -= 1
+      self._commit_journal()
+      return value
+
+   def _db_popitem(self):
+      # remove an arbitrary entry of the database, journaling the removal
+      #
+      # Raises:
+      #    KeyError: the database is empty
+      for key in self._db:
+         return key, self._db_pop(key)
+      raise KeyError('popitem(): backing store is empty')
 
    def _notify_modify_dirty_above_for(self, key):
-      # notify all caches above to look for an entry with key |key|
+      # mark the copy of |key| held by a cache above as dirty
       #
-      # If no cache exists, this is a no-op.
+      # Only the cache holding |key| is touched, and it is marked right
+      # away, so removing several keys in a row loses no notification.
+      # The directory of the caches is used to find the holder if they
+      # keep one. If no cache holds |key|, it may be on its way down
+      # between two caches; it is then kept as an orphan and marked dirty
+      # when it lands (see Cache._setitem() and
+      # Cache._send_bs_nondirties()). If no cache exists, this is a no-op.
       #
       # Args:
       #    key: string representing the key to look for
       mem = self._upper_mem
+      if mem is not None and mem._directory is not None:
+         directory = mem._directory
+         owner = directory.get(key)
+         if owner is not None:
+            owner._mark_dirty(key)
+            return
+         while mem is not None and mem._directory is directory:
+            mem = mem._upper_mem
       while mem is not None:
-         mem._modify_key = key
+         if key in mem._cache:
+            mem._mark_dirty(key)
+            return
          mem = mem._upper_mem
+      if self._upper_mem is not None:
+         self._orphans.add(key)
+
+   def _note_read(self, key):
+      # record that |key| was read from the store
+      if self._recency is not None:
+         self._recency[key] = None
+         self._recency.move_to_end(key)
+
+   def _note_write(self, key):
+      # record that |key| was written to the store
+      self._orphans.discard(key)
+      if self._bloom is not None:
+         self._bloom.add(key)
+      if self._index is not None:
+         self._index.add(key)
+      if self._recency is not None:
+         self._recency[key] = None
+         self._recency.move_to_end(key)
+
+   def _note_remove(self, key):
+      # record that |key| was removed from the store
+      if self._index is not None:
+         self._index.discard(key)
+      if self._recency is not None:
+         self._recency.pop(key, None)
+      if self._bloom is not None:
+         self._bloom_removed += 1
+         if self._bloom_removed > self._capacity:
+            self._build_bloom()
+
+   def _note_clear(self):
+      # record that every key was removed from the store
+      if self._index is not None:
+         self._index.clear()
+      if self._recency is not None:
+         self._recency.clear()
+      if self._bloom is not None:
+         self._bloom.clear()
+         self._bloom_removed = 0
+
+   def _build_bloom(self):
+      # build the Bloom filter from the keys in the store
+      #
+      # Removed keys can't be taken out of a Bloom filter, so it is
+      # rebuilt once as many keys have been removed as the store holds.
+      # That keeps the false positive rate near the one asked for, at an
+      # amortized cost of one key per removal.
+      self._bloom = _BloomFilter(self._capacity, self._bloom_error_rate)
+      self._bloom_removed = 0
+      for k in itertools.chain(self._db.keys(), self._pending_new):
+         self._bloom.add(k)
+
+   def _surely_missing(self, key):
+      # return True if the Bloom filter says |key| is not in the store
+      if self._bloom is None or key in self._bloom:
+         return False
+      self._bloom_skips += 1
+      return True
+
+   def _recency_path(self):
+      # return the path of the file the recency order is kept in
+      return self._dbname + '.recency'
+
+   def _drop_pending(self, key):
+      # forget the batched write of |key| still in flight, if any
+      #
+      # Args:
+      #    key: string representing the key
+      #
+      # Returns:
+      #    True if |key| had a write in flight; False otherwise
+      if key in self._pending:
+         del self._pending[key]
+         self._pending_new.discard(key)
+         self._staged.pop(key, None)
+         return True
+      return False
 
-   def __init__(self, capacity=10, dbname='bstore'):
+   def _stage(self, key, value):
+      # hold the write of |key| in the staging buffer
+      #
+      # The value is pending like the ones of set_many(), so reads see it
+      # right away. The buffer is committed once it holds stage_size
+      # writes, or by the first write made stage_ms after the oldest one.
+      # Committing can evict keys and notify the caches above, so it is
+      # never done from another thread.
+      if not self._staged:
+         self._staged_since = time.monotonic()
+      if key not in self._pending and key not in self._db:
+         self._pending_new.add(key)
+      self._staged.pop(key, None)
+      self._staged[key] = value
+      self._pending[key] = value
+      self._note_write(key)
+      if len(self._staged) >= self._stage_size or \
+            self._stage_ms is not None and \
+            time.monotonic() - self._staged_since >= self._stage_ms / 1000:
+         self.commit()
+
+   def _apply_pending(self):
+      # write every batched write still in flight on the calling thread
+      for k, v in list(self._pending.items()):
+         self._db_set(k, v, False)
+      self._pending.clear()
+      self._pending_new.clear()
+      self._staged.clear()
+
+   @_locked
+   def _write_batch(self, batch):
+      # write a batch handed over by set_many()
+      #
+      # Runs on an executor worker thread, as it works on the open
+      # database. A value is only written if it is still the one in
+      # flight for its key, so a write or delete of the key made in the
+      # meantime wins.
+      #
+      # Args:
+      #    batch: list of (key, value) pairs
+      #
+      # Returns:
+      #    number of pairs written
+      batch = [(k, v) for k, v in batch
+               if self._pending.get(k, BackingStore.__marker) is v]
+      if not batch:
+         return 0
+      self._raise_on_bstore_closed()
+      for k, v in batch:
+         self._db_set(k, v, False)
+         self._drop_pending(k)
+      self._commit_journal()
+      return len(batch)
+
+   def __init__(self, capacity=10, dbname='bstore', track_recency=False,
+                bloom_filter=False, bloom_error_rate=0.01,
+                ordered_index=False, durability='none', group_commit_ms=10,
+                stage_size=0, stage_ms=None, manager=None, lazy_open=False):
       """BackingStore ctor
 
       Instantiate a BackingStore object with a maximum capacity of
@@ -75,14 +925,93 @@ class BackingStore(MutableMapping):
             can hold. Default is 10.
          dbname: string representing the name of the database/store.
             Default is 'bstore'
+         track_recency: if True, keep the order in which keys were last
+            read or written, saved to "|dbname|.recency" on close, so
+            caches can be warmed up with the most recent keys. Default is
+            False.
+         bloom_filter: if True, keep an in-memory Bloom filter of the
+            keys in the store, built when the store is opened, so that
+            lookups of keys that aren't stored don't touch the disk.
+            Default is False.
+         bloom_error_rate: float rate of lookups of missing keys that
+            still go to disk when the store is full. Default is 0.01.
+         ordered_index: if True, keep an in-memory sorted index of the
+            keys in the store, built when the store is opened, so that
+            scan() can find a range of keys without reading every key.
+            Default is False.
+         durability: 'none', 'group' or 'fsync'. Unless 'none', every
+            change is first appended to a journal, "|dbname|.journal",
+            which open() replays if the store wasn't closed. With
+            'fsync', the journal is flushed to disk on every change; with
+            'group', at most |group_commit_ms| after a change, so a crash
+            loses the changes of that window at most. Once the journal
+            holds |capacity| records, the database is synced to disk and
+            the journal emptied. Default is 'none', which relies on the
+            store being closed.
+         group_commit_ms: milliseconds between flushes of the journal in
+            'group' durability. Default is 10.
+         stage_size: if greater than 0, writes made with obj[key] = value
+            are held in a staging buffer, which reads look at first, and
+            committed with set_many() once it holds |stage_size| writes.
+            Room is then made for the whole group at once, so the store
+            can hold up to |stage_size| keys over capacity meanwhile.
+            Staged writes aren't journaled until committed. Default is 0,
+            which writes right away.
+         stage_ms: milliseconds after which the next write commits the
+            staging buffer, however many writes it holds. Default is
+            None, which commits on stage_size, commit() and close() only.
+         manager: StoreManager opening and closing the database of the
+            store. Default is None, which leaves that to open() and
+            close().
+         lazy_open: if True, open() doesn't count the entries nor trim
+            the store down to capacity. The count saved by the last
+            close() is used instead, and a store holding more than
+            capacity entries is trimmed by a few entries on each write.
+            Default is False.
+
+      Raises:
+         ValueError: capacity is less than 1, durability is not a known
+            mode, or |manager| already has a store named |dbname|
       """
       if capacity < 1:
          raise ValueError("capacity must be greater than 0")
+      if durability not in BackingStore._DURABILITIES:
+         raise ValueError("durability must be one of {}".format(
+            ", ".join(BackingStore._DURABILITIES)))
       self._capacity = capacity
       self._dbname = dbname
       self._db = None
       self._nondirty_map = {}
+      self._orphans = set()
       self._upper_mem = None
+      self._lock = _OwnedLock()
+      self._streams = 0
+      self._pending = {}
+      self._pending_new = set()
+      self._track_recency = track_recency
+      self._recency = None
+      self._bloom_filter = bloom_filter
+      self._bloom_error_rate = bloom_error_rate
+      self._bloom = None
+      self._bloom_removed = 0
+      self._bloom_skips = 0
+      self._ordered_index = ordered_index
+      self._index = None
+      self._durability = durability
+      self._group_commit = group_commit_ms / 1000
+      self._journal = None
+      self._journal_records = 0
+      self._sync_timer = None
+      self._stage_size = stage_size
+      self._stage_ms = stage_ms
+      self._staged = OrderedDict()
+      self._staged_since = 0
+      self._manager = manager
+      self._opened = False
+      self._lazy_open = lazy_open
+      self._count = None
+      if manager is not None:
+         manager._register(self)
 
    @property
    def capacity(self):
@@ -101,9 +1030,12 @@ class BackingStore(MutableMapping):
       return self._capacity
 
    @capacity.setter
+   @_locked
    def capacity(self, new_cap):
       self._capacity = new_cap
       self._trim_to_capacity()
+      if self._bloom is not None:
+         self._build_bloom()
 
    @property
    def dbname(self):
@@ -114,25 +1046,280 @@ class BackingStore(MutableMapping):
       """
       return self._dbname
 
+   @_locked
    def open(self):
       """open the backing store i/o stream
 
-      On opening, if the shelve content length is too large, it is
-      reduced down to the maximum capacity. Data is removed randomly.
+      On opening, the journal left by a store that wasn't closed is
+      replayed, up to its first partial or corrupt record. If the shelve
+      content length is too large, it is reduced down to the maximum
+      capacity, unless the store was created with lazy_open=True. Data
+      is removed randomly. If recency is tracked, the
+      order saved by the last close() is loaded. If a Bloom filter or an
+      ordered index is kept, it is built from the keys.
+
+      The database of a store with a manager is only opened on first
+      access, and may be closed and opened again by the manager while
+      the store stays open.
       """
-      self._db = shelve.open(self._dbname)
-      self._trim_to_capacity()
+      if self._manager is not None:
+         self._opened = True
+         return
+      self._open_db()
 
+   def _open_db(self):
+      # open the database. See open()
+      #
+      # The state kept by _close_handle() isn't built again.
+      self._db = shelve.open(self._dbname)
+      records = self._read_journal()[0]
+      count = self._load_count()
+      if self._count is not None:
+         count = self._count
+      if records:
+         self._replay(self._db, records)
+         self._db.sync()
+         self._fsync_db_files()
+         count = None
+      if self._lazy_open:
+         self._count = len(self._db) if count is None else count
+      if self._durability != 'none':
+         self._journal = open(self._journal_path(), 'wb')
+         self._sync_journal()
+      elif os.path.exists(self._journal_path()):
+         os.remove(self._journal_path())
+      if self._track_recency and self._recency is None:
+         try:
+            with open(self._recency_path(), 'rb') as f:
+               saved = pickle.load(f)
+         except (OSError, EOFError, pickle.UnpicklingError):
+            saved = []
+         self._recency = OrderedDict.fromkeys(self._db.keys())
+         for k in saved:
+            if k in self._recency:
+               self._recency.move_to_end(k)
+      if self._ordered_index and self._index is None:
+         self._index = _SortedKeys(self._db_keys())
+      if not self._lazy_open:
+         self._trim_to_capacity()
+      if self._bloom_filter and self._bloom is None:
+         self._build_bloom()
+
+   @_locked
    def close(self):
-      """close the backing store i/o stream"""
+      """close the backing store i/o stream
+
+      The staging buffer is committed and batched write-backs still in
+      flight are written out first. If a journal is kept, the database
+      is flushed to disk and the journal removed.
+      """
+      if self._manager is not None:
+         if self._opened and self._pending:
+            self._raise_on_bstore_closed()
+         self._opened = False
+         self._manager._release(self)
+      self._close_db()
+
+   def _close_db(self):
+      # close the database. See close()
       if self._db is not None:
-         self._db.close()
-         self._db = None
+         self.commit()
+         self._apply_pending()
+         self._close_handle()
+      if self._recency is not None:
+         with open(self._recency_path(), 'wb') as f:
+            pickle.dump(list(self._recency), f)
+         self._recency = None
+      self._bloom = None
+      self._index = None
+      self._count = None
+
+   def _close_handle(self):
+      # close the files of the database and the journal, if open
+      #
+      # The writes in flight, the recency order, the Bloom filter and the
+      # index are kept, so the StoreManager can open the database again
+      # without rebuilding them.
+      if self._db is None:
+         return
+      self._db.close()
+      self._db = None
+      if self._count is not None:
+         with open(self._meta_path(), 'wb') as f:
+            pickle.dump(self._count, f)
+      if self._journal is not None:
+         self._fsync_db_files()
+         self._sync_journal()
+         self._journal.close()
+         self._journal = None
+         self._journal_records = 0
+         os.remove(self._journal_path())
 
    def closed(self):
       """return True if backing store is closed; False otherwise"""
+      if self._manager is not None:
+         return not self._opened
       return self._db is None
 
+   def _salvage(self):
+      # return the readable (key, value) pairs of the database
+      #
+      # Returns:
+      #    (list of readable pairs, list of unreadable keys, string
+      #    describing why the database couldn't be opened or None) triple
+      try:
+         shelf = self._db if self._db is not None else \
+            shelve.open(self._dbname, 'r')
+      except Exception as e:
+         return [], [], '{}: {}'.format(type(e).__name__, e)
+      readable, unreadable = [], []
+      try:
+         for k in list(shelf.keys()):
+            try:
+               readable.append((k, shelf[k]))
+            except Exception:
+               unreadable.append(k)
+      finally:
+         if shelf is not self._db:
+            shelf.close()
+      return readable, unreadable, None
+
+   @_locked
+   def verify(self):
+      """check the database and the journal of the store
+
+      Every value is read and unpickled, and the journal is read up to
+      its first partial or corrupt record. The store can be open or
+      closed; the journal of an open store holds the changes made since
+      the database was last synced.
+
+      Returns:
+         StoreReport of what was found
+      """
+      readable, unreadable, error = self._salvage()
+      self._sync_journal()
+      records, torn = self._read_journal()
+      return StoreReport(error, len(readable) + len(unreadable),
+                         unreadable, len(records), torn)
+
+   @_locked
+   def repair(self):
+      """rebuild the database of the closed store from what is readable
+
+      The values that can be unpickled are copied to a new database and
+      the valid records of the journal replayed on top of them, then the
+      journal is removed. Values that can't be unpickled are lost, and
+      so is everything if the database can't be opened at all.
+
+      Returns:
+         StoreReport of the store before the repair
+
+      Raises:
+         ValueError: the store is open
+      """
+      if not self.closed():
+         raise ValueError("the store must be closed to be repaired")
+      readable, unreadable, error = self._salvage()
+      records, torn = self._read_journal()
+      for suffix in BackingStore._DB_SUFFIXES:
+         try:
+            os.remove(self._dbname + suffix)
+         except OSError:
+            pass
+      db = shelve.open(self._dbname, 'n')
+      try:
+         for k, value in readable:
+            db[k] = value
+         self._replay(db, records)
+      finally:
+         db.close()
+      self._fsync_db_files()
+      for path in (self._journal_path(), self._meta_path()):
+         if os.path.exists(path):
+            os.remove(path)
+      return StoreReport(error, len(readable) + len(unreadable),
+                         unreadable, len(records), torn)
+
+   @_locked
+   def commit(self):
+      """commit the writes held in the staging buffer
+
+      See __init__(). A no-op if the buffer is empty or the store is
+      closed.
+
+      Returns:
+         WriteBackHandle to wait on for the writes to be done
+      """
+      if not self._staged or self.closed():
+         return WriteBackHandle([])
+      batch, self._staged = self._staged, OrderedDict()
+      return self.set_many(batch)
+
+   @_locked
+   def set_many(self, items, executor=None):
+      """write a batch of (key, value) pairs to the store
+
+      Room for the new keys is made once for the whole batch, following
+      the same rules as popitem(). If the batch has more new keys than
+      the store can hold, the earliest ones are dropped, as writing the
+      pairs one at a time would have done, and the caches above are
+      notified about them like any other removed key.
+
+      If |executor| is given, the values are pickled and written by a
+      task submitted to it and set_many() returns right away. Until the
+      task is done, reads of the store see the new values, and a write
+      or delete of one of the keys wins over the batch. Only executors
+      running tasks on threads of this process are supported, as the
+      task works on the open database.
+
+      Args:
+         items: dictionary or iterable of (key, value) pairs
+         executor: concurrent.futures.Executor used to write the batch,
+            such as a ThreadPoolExecutor, but not a ProcessPoolExecutor.
+            If None, the batch is written before returning.
+
+      Returns:
+         WriteBackHandle to wait on for the batch to be written
+
+      Raises:
+         BStoreClosedError: backing store is closed
+      """
+      self._raise_on_bstore_closed()
+      batch = OrderedDict(items)
+      was_new = set()
+      for k in batch:
+         if k in self._pending_new:
+            was_new.add(k)
+         self._drop_pending(k)
+      new = sum(1 for k in batch if k not in self._db)
+      limit = self._limit()
+      while self._db_len() and \
+            self._db_len() + len(self._pending_new) + new > limit:
+         if self.popitem()[0] in batch:
+            new += 1
+      for k in list(batch):
+         if self._db_len() + len(self._pending_new) + new <= limit:
+            break
+         if k not in self._db:
+            del batch[k]
+            new -= 1
+            if k in was_new:
+               self._note_remove(k)
+            self._notify_modify_dirty_above_for(k)
+
+      for k, v in batch.items():
+         if k not in self._db:
+            self._pending_new.add(k)
+         self._pending[k] = v
+         self._note_write(k)
+      if executor is None:
+         future = concurrent.futures.Future()
+         future.set_result(self._write_batch(list(batch.items())))
+      else:
+         future = executor.submit(self._write_batch, list(batch.items()))
+      return WriteBackHandle([future])
+
+   @_locked
    def __getitem__(self, key):
       """obj[key]
 
@@ -149,8 +1336,25 @@ class BackingStore(MutableMapping):
          KeyError: |key| doesn't exist
       """
       self._raise_on_bstore_closed()
-      return self._db[key]
+      if self._surely_missing(key):
+         raise KeyError(key)
+      value = self._pending[key] if key in self._pending else self._db[key]
+      self._note_read(key)
+      return value
+
+   @_locked
+   def _peek(self, key):
+      # get data from backing store without recording the read
+      #
+      # Raises:
+      #     BStoreClosedError: backing store is closed
+      #     KeyError: |key| doesn't exist
+      self._raise_on_bstore_closed()
+      if self._surely_missing(key):
+         raise KeyError(key)
+      return self._pending[key] if key in self._pending else self._db[key]
 
+   @_locked
    def __setitem__(self, key, value):
       """obj[key] = value
 
@@ -164,10 +1368,18 @@ class BackingStore(MutableMapping):
          BStoreClosedError: backing store is closed
       """
       self._raise_on_bstore_closed()
-      while len(self._db) >= self._capacity:
+      if self._stage_size > 0:
+         self._stage(key, value)
+         return
+      self._drop_pending(key)
+      limit = self._limit()
+      while self._db_len() and \
+            self._db_len() + len(self._pending_new) >= limit:
          self.popitem()
-      self._db[key] = value
+      self._db_set(key, value)
+      self._note_write(key)
 
+   @_locked
    def __delitem__(self, key):
       """del obj[key]
 
@@ -178,10 +1390,16 @@ class BackingStore(MutableMapping):
 
       Raises:
          BStoreClosedError: backing store is closed
+         KeyError: |key| doesn't exist
       """
       self._raise_on_bstore_closed()
-      del self._db[key]
+      if self._drop_pending(key):
+         self._db_pop(key, None)
+      else:
+         self._db_pop(key)
+      self._note_remove(key)
 
+   @_locked
    def __iter__(self):
       """return an iterator over the keys in the backing store
 
@@ -192,8 +1410,73 @@ class BackingStore(MutableMapping):
          BStoreClosedError: backing store is closed
       """
       self._raise_on_bstore_closed()
-      return iter(self._db)
+      return iter(self.keys())
+
+   def _db_keys(self):
+      # yield the keys of the shelve
+      #
+      # Walks the database cursor when the dbm module has one (dbm.gnu)
+      # rather than listing every key first. dbm.ndbm and dbm.dumb have
+      # no cursor, so there every key is listed in memory up front;
+      # dbm.dumb holds its whole index in memory anyway.
+      db = self._db.dict
+      if hasattr(db, 'firstkey'):
+         k = db.firstkey()
+         while k is not None:
+            yield k.decode('utf-8')
+            k = db.nextkey(k)
+      else:
+         for k in db.keys():
+            yield k.decode('utf-8')
 
+   def _stream(self, batch_size, with_values):
+      # yield the keys, or (key, value) pairs, of the store in batches
+      #
+      # The lock is held while a batch of up to |batch_size| entries is
+      # read, and released while the batch is consumed, so only one batch
+      # is in memory at a time. Keys removed between batches are
+      # skipped. Keys only in the pending writes when the iteration
+      # starts are noted then and come last, so a batch written to the
+      # database meanwhile isn't missed. The StoreManager doesn't close
+      # the database while it is streamed.
+      with self._lock:
+         self._streams += 1
+      try:
+         cursor = None
+         pending = None
+         while True:
+            with self._lock:
+               self._raise_on_bstore_closed()
+               if cursor is None:
+                  pending = dict.fromkeys(self._pending_new)
+                  cursor = self._db_keys()
+               keys = list(itertools.islice(cursor, batch_size))
+               if not keys and pending is not None:
+                  cursor = iter(list(pending))
+                  pending = None
+                  continue
+               batch = []
+               for k in keys:
+                  if pending is not None:
+                     pending.pop(k, None)
+                  if k in self._pending:
+                     batch.append((k, self._pending[k]))
+                  elif with_values:
+                     try:
+                        batch.append((k, self._db[k]))
+                     except KeyError:
+                        pass
+                  elif k in self._db:
+                     batch.append((k, None))
+            if not keys:
+               return
+            for k, v in batch:
+               yield (k, v) if with_values else k
+      finally:
+         with self._lock:
+            self._streams -= 1
+
+   @_locked
    def __len__(self):
       """return the number of itmes in the backing store
 
@@ -204,8 +1487,9 @@ class BackingStore(MutableMapping):
          BStoreClosedError: backing store is closed
       """
       self._raise_on_bstore_closed()
-      return len(self._db)
+      return self._db_len() + len(self._pending_new)
 
+   @_locked
    def __contains__(self, key):
       """|key| in obj
 
@@ -221,44 +1505,77 @@ class BackingStore(MutableMapping):
          BStoreClosedError: backing store is closed
       """
       self._raise_on_bstore_closed()
-      return key in self._db
+      if self._surely_missing(key):
+         return False
+      return key in self._pending or key in self._db
 
-   def keys(self):
-      """return a list of the keys in the backing store
+   @_locked
+   def keys(self, batch_size=1024):
+      """return a view of the keys in the backing store
+
+      The view reads the keys from disk as it is iterated, |batch_size|
+      at a time. Writes made while it is iterated may or may not be
+      seen; keys removed meanwhile are skipped. Only dbm.gnu databases
+      are walked with a cursor; with other dbm modules, the keys are
+      listed in memory when the iteration starts, and only the values
+      are read in batches.
+
+      Args:
+         batch_size: int number of keys read from disk at a time.
+            Defaults to 1024
 
       Returns:
-         a list of all the keys in the backing store
+         a view of all the keys in the backing store
 
       Raises:
          BStoreClosedError: backing store is closed
       """
       self._raise_on_bstore_closed()
-      return list(self._db.keys())
+      return _View(lambda: self._stream(batch_size, False),
+                   self.__len__, self.__contains__)
 
-   def items(self):
-      """return a list of (key, value) pairs contained in the backing store
+   @_locked
+   def items(self, batch_size=1024):
+      """return a view of the (key, value) pairs in the backing store
+
+      The view reads the pairs from disk as it is iterated, |batch_size|
+      at a time. See keys().
+
+      Args:
+         batch_size: int number of pairs read from disk at a time.
+            Defaults to 1024
 
       Returns:
-         a list of (key, value) pairs contained in the backing store
+         a view of the (key, value) pairs contained in the backing store
 
       Raises:
          BStoreClosedError: backing store is closed
       """
       self._raise_on_bstore_closed()
-      return list(self._db.items())
+      return _View(lambda: self._stream(batch_size, True), self.__len__)
 
-   def values(self):
-      """return a list of the values in the backing store
+   @_locked
+   def values(self, batch_size=1024):
+      """return a view of the values in the backing store
+
+      The view reads the values from disk as it is iterated,
+      |batch_size| at a time. See keys().
+
+      Args:
+         batch_size: int number of values read from disk at a time.
+            Defaults to 1024
 
       Returns:
-         a list of values contained in the backing store
+         a view of the values contained in the backing store
 
       Raises:
          BStoreClosedError: backing store is closed
       """
       self._raise_on_bstore_closed()
-      return list(self._db.values())
+      return _View(lambda: (v for k, v in self._stream(batch_size, True)),
+                   self.__len__)
 
+   @_locked
    def get(self, key, default=None):
       """return the value for |key| if |key| is in the store
 
@@ -272,7 +1589,98 @@ class BackingStore(MutableMapping):
          BStoreClosedError: backing store is closed
       """
       self._raise_on_bstore_closed()
-      return self._db.get(key, default)
+      if key in self:
+         return self[key]
+      return default
+
+   def scan(self, start=None, end=None, prefix=None, batch_size=1024):
+      """yield the (key, value) pairs of a range of keys, in key order
+
+      Either the keys from |start| included to |end| excluded, or the
+      keys beginning with |prefix|, are looked up in the ordered index
+      and their values read from disk |batch_size| at a time, so the
+      cost is O(log n + k) for k pairs. The store is locked only while a
+      batch is read. Writes made during the scan may or may not be seen;
+      keys removed meanwhile are skipped.
+
+      Args:
+         start: smallest key to yield. Defaults to the smallest key
+         end: key to stop before. Defaults to no limit
+         prefix: string every yielded key begins with. Can't be given
+            with |start| or |end|
+         batch_size: int number of pairs read from disk at a time.
+            Defaults to 1024
+
+      Returns:
+         generator of (key, value) pairs
+
+      Raises:
+         ValueError: the store wasn't created with ordered_index=True,
+            or |prefix| is given with |start| or |end|
+         BStoreClosedError: backing store is closed
+      """
+      if not self._ordered_index:
+         raise ValueError("the store doesn't keep an ordered index")
+      if prefix is not None:
+         if start is not None or end is not None:
+            raise ValueError("prefix can't be given with start or end")
+         start = prefix
+      return self._scan(start, end, prefix, batch_size)
+
+   def _scan(self, start, end, prefix, batch_size):
+      # generator behind scan()
+      key, inclusive = start, True
+      while True:
+         with self._lock:
+            self._raise_on_bstore_closed()
+            keys = self._index.after(key, batch_size, inclusive)
+            batch = []
+            for k in keys:
+               if end is not None and k >= end or \
+                     prefix is not None and not k.startswith(prefix):
+                  keys = None
+                  break
+               try:
+                  batch.append((k, self._pending[k] if k in self._pending
+                                else self._db[k]))
+               except KeyError:
+                  pass
+         yield from batch
+         if not keys or len(keys) < batch_size:
+            return
+         key, inclusive = keys[-1], False
+
+   def bloom_skips(self):
+      """return how many lookups the Bloom filter answered without disk
+
+      Returns:
+         number of lookups of missing keys that the Bloom filter turned
+         away since the store was created
+      """
+      return self._bloom_skips
+
+   @_locked
+   def recent_keys(self, count=None):
+      """return the keys of the store, most recently used first
+
+      Recency covers reads and writes, and survives closing and
+      reopening the store.
+
+      Args:
+         count: int maximum number of keys to return. All keys are
+            returned if None.
+
+      Returns:
+         list of keys, most recently read or written first
+
+      Raises:
+         BStoreClosedError: backing store is closed
+         ValueError: the store was created without track_recency
+      """
+      self._raise_on_bstore_closed()
+      if self._recency is None:
+         raise ValueError("recency is not tracked by this store")
+      return list(itertools.islice(reversed(self._recency), count))
 
    def __eq__(self, other):
       """return True if equal; False otherwise
@@ -302,6 +1710,7 @@ class BackingStore(MutableMapping):
       """
       return not (self == other)
 
+   @_locked
    def pop(self, key, default=__marker):
       """Remove |key| and return its value if exists in store
 
@@ -322,9 +1731,24 @@ class BackingStore(MutableMapping):
          BStoreClosedError: backing store is closed
       """
       self._raise_on_bstore_closed()
-      return self._db.pop(key) if default == BackingStore.__marker \
-         else self._db.pop(key, default)
+      if key in self._pending:
+         value = self._pending[key]
+         self._drop_pending(key)
+         self._db_pop(key, None)
+      elif self._surely_missing(key):
+         if default == BackingStore.__marker:
+            raise KeyError(key)
+         return default
+      elif default == BackingStore.__marker:
+         value = self._db_pop(key)
+      elif key in self._db:
+         value = self._db_pop(key)
+      else:
+         return default
+      self._note_remove(key)
+      return value
 
+   @_locked
    def popitem(self):
       """Remove and return a (key, value) pair from store
 
@@ -345,13 +1769,17 @@ class BackingStore(MutableMapping):
          BStoreClosedError: backing store is closed
       """
       self._raise_on_bstore_closed()
-      for k in self.keys():
-         if k not in self._nondirty_map:
-            return k, self._db.pop(k)
-      item = self._db.popitem()
+      k = next((k for k in self._db_keys() if k not in self._nondirty_map),
+               None)
+      if k is not None:
+         self._note_remove(k)
+         return k, self._db_pop(k)
+      item = self._db_popitem()
+      self._note_remove(item[0])
       self._notify_modify_dirty_above_for(item[0])
       return item
 
+   @_locked
    def clear(self):
       """remove all (key, value) pairs from the store
 
@@ -359,8 +1787,17 @@ class BackingStore(MutableMapping):
          BStoreClosedError: backing store is closed
       """
       self._raise_on_bstore_closed()
+      self._pending.clear()
+      self._pending_new.clear()
+      self._staged.clear()
+      self._log(BackingStore._J_CLEAR)
       self._db.clear()
+      if self._count is not None:
+         self._count = 0
+      self._commit_journal()
+      self._note_clear()
 
+   @_locked
    def update(self, other):
       """updates the store with (key, value) pairs from another store
 
@@ -374,8 +1811,13 @@ class BackingStore(MutableMapping):
          BStoreClosedError: backing store is closed
       """
       self._raise_on_bstore_closed()
-      self._db.update(other)
+      for k in other:
+         self._drop_pending(k)
+         self._note_write(k)
+         self._db_set(k, other[k], False)
+      self._commit_journal()
 
+   @_locked
    def setdefault(self, key, default=None):
       """return key's value if in store, otherwise insert key
 
@@ -391,25 +1833,41 @@ class BackingStore(MutableMapping):
          BStoreClosedError: backing store is closed
       """
       self._raise_on_bstore_closed()
-      return self._db.setdefault(key, default)
+      if key in self._pending:
+         value = self._pending[key]
+      elif key in self._db:
+         value = self._db[key]
+      else:
+         value = default
+         self._db_set(key, value)
+      self._note_write(key)
+      return value
+
+   _STR_PAIRS = 100
 
    def __str__(self):
       """return a string representation of the backing store
 
-      A string representation of the backing store is all the
-      (key, value) pairs sorted by key and listed out. If
-      backing store is closed, prints out "BackingStore: closed".
+      A string representation of the backing store is the (key, value)
+      pairs sorted by key and listed out, up to the first 100 of them;
+      "..." stands for the rest. If backing store is closed, prints out
+      "BackingStore: closed". The keys are streamed, keeping only the
+      smallest ones, and each value is loaded as its pair is listed.
 
       Returns:
          string representation of the backing store
       """
-      ldump = []
       try:
-         for k, v in self.items():
-            ldump.append((k, v))
-         ldump.sort(key=lambda t: t[0])
-         ldump = [str(i) for i in ldump]
-         return "BackingStore: [{}]".format(", ".join(ldump))
+         with self._lock:
+            self._raise_on_bstore_closed()
+            keys = heapq.nsmallest(BackingStore._STR_PAIRS + 1,
+                                   self.keys())
+            pairs = [str((k, self._pending[k] if k in self._pending
+                          else self._db[k]))
+                     for k in keys[:BackingStore._STR_PAIRS]]
+            if len(keys) > BackingStore._STR_PAIRS:
+               pairs.append('...')
+            return "BackingStore: [{}]".format(", ".join(pairs))
       except BStoreClosedError:
          return "BackingStore: closed"
 
@@ -432,6 +1890,180 @@ class BackingStore(MutableMapping):
       return False
 
 
+class WriteBackHandle():
+   """Completion handle for batched write-backs to backing stores
+
+   Returned by BackingStore.set_many(), Cache.flush() and
+   ShardedCache.flush(). A handle may cover batches written to several
+   backing stores.
+   """
+
+   def __init__(self, futures):
+      """Instantiate a WriteBackHandle object.
+
+      Args:
+         futures: concurrent.futures.Future objects, one per batch, each
+            resulting in the number of pairs written
+      """
+      self._futures = list(futures)
+
+   def done(self):
+      """return True if every batch has been written; False otherwise"""
+      return all(f.done() for f in self._futures)
+
+   def wait(self, timeout=None):
+      """block until every batch has been written
+
+      Args:
+         timeout: seconds to wait at most. Waits forever if None.
+
+      Returns:
+         number of (key, value) pairs written
+
+      Raises:
+         concurrent.futures.TimeoutError: a batch is still being written
+            after |timeout| seconds
+         any exception raised while writing a batch
+      """
+      not_done = concurrent.futures.wait(self._futures, timeout).not_done
+      if not_done:
+         raise concurrent.futures.TimeoutError
+      return sum(f.result() for f in self._futures)
+
+
+class StoreManager():
+   """Pool of the open databases of many BackingStore objects
+
+   A BackingStore created with a manager has its database opened on
+   first access rather than by open(). At most |max_open| databases are
+   open at a time; opening one more closes the least recently used
+   database that no other thread is using. Its store stays open and
+   opens the database again on its next access, so thousands of stores
+   can be kept open without running out of file descriptors. The
+   manager also refuses two stores with the same database file.
+   """
+
+   def __init__(self, max_open=64):
+      """Instantiate a StoreManager object.
+
+      Args:
+         max_open: int maximum number of databases open at a time.
+            Defaults to 64
+
+      Raises:
+         ValueError: max_open is less than 1
+      """
+      if max_open < 1:
+         raise ValueError("max_open must be greater than 0")
+      self._max_open = max_open
+      self._lock = threading.RLock()
+      self._names = weakref.WeakValueDictionary()
+      self._lru = OrderedDict()
+      self._stats = {'opens': 0, 'closes': 0}
+
+   def _register(self, store):
+      # record |store| under the path of its database
+      #
+      # Raises:
+      #     ValueError: another live store of self has that database
+      path = os.path.abspath(store.dbname)
+      with self._lock:
+         if path in self._names:
+            raise ValueError(
+               "a store named {} already exists".format(store.dbname))
+         self._names[path] = store
+
+   def _touch(self, store):
+      # record an access to |store|, whose database is open
+      with self._lock:
+         if id(store) in self._lru:
+            self._lru.move_to_end(id(store))
+
+   def _acquire(self, store):
+      # make room for the database of |store|, which is about to open
+      #
+      # The least recently used databases are closed first.
+      with self._lock:
+         self._lru[id(store)] = store
+         self._stats['opens'] += 1
+         for victim in list(self._lru.values()):
+            if len(self._lru) <= self._max_open:
+               break
+            if victim is not store:
+               self._try_close(victim)
+
+   def _try_close(self, store):
+      # close the database of |store| unless it is in use
+      #
+      # A store whose lock is held, by another thread or further up the
+      # calling thread's stack, or whose keys are being streamed, is in
+      # use. No lock is ever waited for while holding the lock of self.
+      # Only the files are closed: the staged writes and the state built
+      # from the database are kept.
+      if store._lock.owned() or not store._lock.acquire(False):
+         return
+      try:
+         if store._streams:
+            return
+         store._close_handle()
+         del self._lru[id(store)]
+         self._stats['closes'] += 1
+      finally:
+         store._lock.release()
+
+   def _release(self, store):
+      # forget the database of |store|, which is about to close
+      with self._lock:
+         if self._lru.pop(id(store), None) is not None:
+            self._stats['closes'] += 1
+
+   @property
+   def max_open(self):
+      """return the maximum number of databases open at a time"""
+      return self._max_open
+
+   def store(self, dbname, *args, **kwargs):
+      """return the store of self named |dbname|, creating it if needed
+
+      Args:
+         dbname: string representing the name of the database/store
+         *args, **kwargs: other arguments of BackingStore() used if the
+            store is created
+
+      Returns:
+         BackingStore object managed by self
+      """
+      with self._lock:
+         store = self._names.get(os.path.abspath(dbname))
+         if store is None:
+            store = BackingStore(*args, dbname=dbname, manager=self,
+                                 **kwargs)
+         return store
+
+   def open_count(self):
+      """return the number of databases open"""
+      with self._lock:
+         return len(self._lru)
+
+   def close_all(self):
+      """close every database that no other thread is using
+
+      The stores stay open and open their database again on next access.
+      """
+      with self._lock:
+         for store in list(self._lru.values()):
+            self._try_close(store)
+
+   def stats(self):
+      """return the number of databases opened and closed by self
+
+      Returns:
+         dictionary with 'opens' and 'closes' counts
+      """
+      with self._lock:
+         return dict(self._stats)
+
+
 class Cache(MutableMapping):
    """Cache class. Cache and BackingStore objects can be linked to this
 
@@ -532,6 +2164,8 @@ class Cache(MutableMapping):
       #     KeyError: |key| doesn't exist and |default| isn't specified
       item = self._cache.pop(key) if default == Cache.__marker \
          else self._cache.pop(key, default)
+      if self._directory is not None:
+         self._untrack(key)
       try:
          return item.val if unwrap else item
       except AttributeError:
@@ -556,6 +2190,8 @@ class Cache(MutableMapping):
       #     a (dirty, value) pair, thus (key, (dirty, value)) is
       #     returned.
       entry = self._cache.popitem(last)
+      if self._directory is not None:
+         self._untrack(entry[0])
       if unwrap:
          return entry[0], entry[1].val
       return entry
@@ -577,9 +2213,12 @@ class Cache(MutableMapping):
       # Raises:
       #     CacheMiss: the key doesn't exist in the cache or backing
       #        store
+      if self._directory is not None:
+         return self._directory_pop(key)
       try:
-         return self._pop(key).val, False
+         item = self._pop(key)
       except KeyError:
+         self._stats['misses'] += 1
          try:
             return self.lower_mem._recurs_pop_unless_from_bs(key)
          except AttributeError:
@@ -589,68 +2228,336 @@ class Cache(MutableMapping):
                return self.lower_mem[key], True
             except KeyError:
                raise CacheMiss
+      self._stats['hits'] += 1
+      return item.val, False
 
-   def _modify_dirty_if_notified(self):
-      # modify the dirty bool of a value in the cache
+   def _recurs_copy_unless_from_bs(self, key):
+      # find |key| in the cache, leaving a clean copy where it's found
       #
-      # the dirty bool changed is associated to the key specified
-      # by the backing store if exists. If no backing store exists
-      # this a no-op.
-      if self._modify_key is not None:
-         try:
-            item = self._cache[self._modify_key]
-            self._cache[self._modify_key] = Cache._Val(True, item.val)
-         except KeyError:
-            pass
-         finally:
-            self._modify_key = None
-
-   def _setitem(self, key, val, dirty=True):
-      # sets item in cache
+      # Inclusive mode counterpart of _recurs_pop_unless_from_bs(). If
+      # |key| is found in a cache, it stays there as the most recently
+      # used item and its dirty flag is handed over to the caller, who
+      # puts the value in a higher cache. If |key| is found in the
+      # store, it is left there.
       #
-      # the least recently used item in a cache will be pushed down
+      # Args:
+      #     key: string representing the key
+      #
+      # Returns:
+      #     (value, dirty) pair, where dirty is the dirty flag the copy
+      #     had
+      #
+      # Raises:
+      #     CacheMiss: the key doesn't exist in the cache or backing
+      #        store
+      try:
+         item = self._cache[key]
+      except KeyError:
+         self._stats['misses'] += 1
+         try:
+            return self.lower_mem._recurs_copy_unless_from_bs(key)
+         except AttributeError:
+            if self.lower_mem is None:
+               raise CacheMiss
+            try:
+               return self.lower_mem[key], False
+            except KeyError:
+               raise CacheMiss
+      self._cache.move_to_end(key)
+      if item.dirty:
+         self._cache[key] = Cache._Val(False, item.val)
+      self._stats['hits'] += 1
+      return item.val, item.dirty
+
+   def _discard(self, key):
+      # remove |key| from self cache if it's there
+      #
+      # Returns:
+      #     True if |key| was removed; False otherwise
+      if key in self._cache:
+         self._pop(key)
+         return True
+      return False
+
+   def _drop_lower_copies(self, key):
+      # remove |key| from every cache below the highest one holding it
+      #
+      # Used by writes in inclusive mode, so that the copies below don't
+      # go stale.
+      found = False
+      for mem in self._levels():
+         if found:
+            mem._discard(key)
+         elif key in mem:
+            found = True
+
+   def _lookup(self, key):
+      # find |key| for a read through self
+      #
+      # Returns:
+      #     (value, dirty) pair, where dirty is the dirty flag the value
+      #     should have in self cache
+      #
+      # Raises:
+      #     CacheMiss: the key doesn't exist in the cache or backing
+      #        store
+      if self._inclusive:
+         return self._recurs_copy_unless_from_bs(key)
+      item, from_bstore = self._recurs_pop_unless_from_bs(key)
+      return item, not from_bstore
+
+   def _directory_pop(self, key):
+      # pop |key| from the cache the directory says holds it
+      #
+      # Same as _recurs_pop_unless_from_bs(), but goes straight to the
+      # cache holding |key|, or straight to the backing store if no
+      # cache from self down holds it, instead of probing each level.
+      # The misses of the levels skipped are counted all at once; see
+      # _directory_misses().
+      #
+      # Args:
+      #     key: string representing the key
+      #
+      # Returns:
+      #     (value, True if value came from the backing store) pair
+      #
+      # Raises:
+      #     CacheMiss: the key doesn't exist in the cache or backing
+      #        store
+      owner = self._directory.get(key)
+      if owner is self:
+         self._stats['hits'] += 1
+         return self._pop(key).val, False
+      self._skipped += 1
+      if owner is not None and owner._depth > self._depth:
+         owner._skipped -= 1
+         owner._stats['hits'] += 1
+         return owner._pop(key).val, False
+      if self._bstore is None:
+         raise CacheMiss
+      try:
+         return self._bstore[key], True
+      except KeyError:
+         raise CacheMiss
+
+   def _directory_misses(self):
+      # return the misses of self counted by directory lookups
+      #
+      # A lookup adds 1 to _skipped of the level it starts at and takes 1
+      # from that of the level it finds the key in, so the misses of a
+      # level are the sum of _skipped over it and the levels above it
+      # that share its directory.
+      if self._directory is None:
+         return 0
+      misses = 0
+      mem = self
+      while mem is not None and mem._directory is self._directory:
+         misses += mem._skipped
+         mem = mem._upper_mem
+      return misses
+
+   def _negative_hit(self, key):
+      # return True if |key| was recently confirmed missing
+      #
+      # An expired entry is dropped.
+      expiry = self._negatives.get(key)
+      if expiry is None:
+         return False
+      if expiry <= time.monotonic():
+         del self._negatives[key]
+         return False
+      self._stats['negative_hits'] += 1
+      return True
+
+   def _note_missing(self, key):
+      # remember for negative_ttl seconds that |key| is missing
+      #
+      # At most capacity keys are remembered; the oldest goes first.
+      self._negatives.pop(key, None)
+      self._negatives[key] = time.monotonic() + self._negative_ttl
+      if len(self._negatives) > self._capacity:
+         self._negatives.popitem(False)
+
+   def _track(self, key):
+      # record in the directory that self cache holds |key|
+      if self._directory is not None:
+         self._directory[key] = self
+
+   def _untrack(self, key):
+      # record in the directory that self cache no longer holds |key|
+      if self._directory.get(key) is self:
+         del self._directory[key]
+
+   def _mark_dirty(self, key):
+      # mark the item with key |key| in self cache as dirty
+      #
+      # The item keeps its place in LRU order.
+      #
+      # Raises:
+      #     KeyError: |key| is not in self cache
+      item = self._cache[key]
+      if not item.dirty:
+         self._cache[key] = Cache._Val(True, item.val)
+
+   def _setitem(self, key, val, dirty=True):
+      # sets item in cache
+      #
+      # the least recently used item in a cache will be pushed down
       # to lower memory if capacity in the cache is reached. If lower
       # memory is backing store, then write a dirty item to store;
-      # otherwise, if not dirty, no-op.
+      # otherwise, if not dirty, no-op. A non-dirty item the backing
+      # store dropped while it was on its way down is set as dirty.
+      #
+      # An item larger than max_entry_size isn't set in self cache but
+      # demoted right away, removing the copy self cache had.
       #
       # Args:
       #     key: string representing the key
       #     val: data representing a value to store
       #     dirty: bool to set the dirty flag. Defaults to True
+      if self._negatives:
+         self._negatives.pop(key, None)
+      if self._max_entry_size is not None:
+         if self._lower_mem is not None and \
+               self._sizeof(val) > self._max_entry_size:
+            self._stats['bypassed'] += 1
+            if key in self._cache:
+               self._pop(key)
+            self._demote(key, Cache._Val(dirty, val))
+            return
+         self._stats['admitted'] += 1
       try:
          self._cache.pop(key)
       except KeyError:
          while (len(self._cache) >= self._capacity):
-            k, v = self._popitem(False)
-            try:
-               if self._lower_mem is not None:
-                  self._lower_mem._setitem(k, v.val, v.dirty)
-            except AttributeError:
-               if v.dirty:
-                  self._lower_mem[k] = v.val
+            self._demote(*self._popitem(False))
+      # making room may have had the store drop |key|
+      if not dirty and self._bstore is not None and \
+            key in self._bstore._orphans:
+         self._bstore._orphans.discard(key)
+         dirty = True
       self._cache[key] = Cache._Val(dirty, val)
-      self._modify_dirty_if_notified()
+      self._track(key)
+
+   def _demote(self, key, item):
+      # push an item evicted from self cache down to lower memory
+      #
+      # If lower memory is a cache, the item is set there keeping its
+      # dirty flag. If lower memory is backing store, the item is written
+      # to the store only if it is dirty, or if the store dropped it while
+      # it was held as non-dirty. If there is no lower memory, the item is
+      # dropped.
+      #
+      # A clean item is dropped instead of set in a lower cache when that
+      # cache already holds a copy, in inclusive mode, or when the store
+      # holds it and self cache's clean_demotion is 'drop'.
+      #
+      # Args:
+      #     key: string representing the key
+      #     item: _Val object holding the (dirty, value) pair
+      try:
+         if self._lower_mem is not None:
+            if not item.dirty and (
+                  self._drop_clean and key not in self._bstore._orphans or
+                  self._inclusive and key in self._lower_mem._cache):
+               return
+            if item.dirty and \
+                  self._lower_mem._write_policy == 'write-through':
+               self._lower_mem._write(key, item.val)
+            else:
+               self._lower_mem._setitem(key, item.val, item.dirty)
+      except AttributeError:
+         if item.dirty or key in self._lower_mem._orphans:
+            self._lower_mem[key] = item.val
+
+   def _write(self, key, val):
+      # set |key| to |val| in self cache as a write, per the write policy
+      #
+      # A write-through cache also writes the backing store and keeps
+      # the item clean, telling the store it holds a clean copy so the
+      # store doesn't drop it without notice while making room. A
+      # write-around cache hands the write to the memory below, or keeps
+      # it if there is none.
+      #
+      # Args:
+      #     key: string representing the key
+      #     val: data to set with key |key|
+      if self._write_policy == 'write-around' and \
+            self._lower_mem is not None:
+         if isinstance(self._lower_mem, Cache):
+            self._lower_mem._write(key, val)
+         else:
+            self._lower_mem[key] = val
+      elif self._write_policy == 'write-through' and \
+            self._bstore is not None:
+         self._bstore[key] = val
+         self._bstore._nondirty_map[key] = val
+         self._setitem(key, val, False)
+      else:
+         self._setitem(key, val)
+
+   def _levels(self):
+      # yield self and every Cache object below self in the chain
+      mem = self
+      while isinstance(mem, Cache):
+         yield mem
+         mem = mem.lower_mem
+
+   def _hold(self):
+      # return a context manager keeping other users out of self cache
+      #
+      # A Cache is only used by the threads of one process, which don't
+      # interleave its multi-step updates, so this holds nothing. See
+      # SharedMemoryCache._hold().
+      return contextlib.nullcontext()
+
+   @contextlib.contextmanager
+   def _chain_held(self):
+      # hold every level of the chain for a read-modify-write sequence
+      #
+      # Levels are held from the top of the chain down, the order the
+      # demotions of a shared level take them in.
+      top = self
+      while top._upper_mem is not None:
+         top = top._upper_mem
+      with contextlib.ExitStack() as stack:
+         for mem in top._levels():
+            stack.enter_context(mem._hold())
+         yield
 
    def _send_bs_nondirties(self, *more):
       # send backing store all nondirty items from existing caches
       #
-      # parses all caches in the chain below for items whose dirty
-      # flags are False and sends a dictionary of this to the backing
-      # store if exists. Includes pairs from |*more|.
+      # parses all caches in the chain, from its top cache down, for
+      # items whose dirty flags are False and sends a dictionary of this
+      # to the backing store if exists, whichever level this is called
+      # on. Includes pairs from |*more|. Orphans the store reported for
+      # items that are now settled in a cache are marked dirty there,
+      # and dropped otherwise.
       #
       # Args:
       #     *more: (key, value) pairs to add on top of the ones in the
       #        caches.
-      if self._is_lowest_mem_bstore():
-         bs = self._get_lowest_mem()
-         nondirty_map = dict([*more])
-
-         mem = self
-         while mem is not bs:
-            nondirty_map.update(
-               {k: v.val for k, v in mem._items() if not v.dirty})
-            mem = mem.lower_mem
-         bs._nondirty_map = nondirty_map
+      if not self._is_lowest_mem_bstore():
+         return
+      bs = self._get_lowest_mem()
+      nondirty_map = dict([*more])
+      top = self
+      while top._upper_mem is not None:
+         top = top._upper_mem
+
+      with self._chain_held():
+         for mem in top._levels():
+            for k, v in mem._items():
+               if v.dirty:
+                  continue
+               if k in bs._orphans:
+                  mem._mark_dirty(k)
+                  bs._orphans.discard(k)
+               else:
+                  nondirty_map[k] = v.val
+      bs._orphans.clear()
+      bs._nondirty_map = nondirty_map
 
    def _get_lowest_mem(self):
       # returns the lowest memory in the chain
@@ -675,26 +2582,81 @@ class Cache(MutableMapping):
       # False otherwise
       return isinstance(self._get_lowest_mem(), BackingStore)
 
-   def __init__(self, capacity=10, init_values=None, lower_mem=None):
+   _WRITE_POLICIES = ('write-back', 'write-through', 'write-around')
+
+   def __init__(self, capacity=10, init_values=None, lower_mem=None,
+                negative_ttl=None, clean_demotion='demote',
+                write_policy='write-back', max_entry_size=None, sizeof=None):
       """Instantiate a Cache object.
 
       Args:
          capacity: int specifying the capacity of the cache
-         init_values: list of pairs or a dictionary to initialize the
-            cache with
+         init_values: list of pairs, a view of pairs returned by
+            items() or a dictionary to initialize the cache with
          lower_mem: Cache or BackingStore to link to self
+         negative_ttl: if given, seconds for which a key that a lookup
+            through self found nowhere in the chain keeps raising
+            CacheMiss without searching the chain again. Up to capacity
+            such keys are remembered. Writing the key through self
+            forgets it; writes made below self are seen once it expires.
+            Default is None, which remembers nothing.
+         clean_demotion: what to do with a clean item evicted from self
+            cache when the chain ends in a backing store, which then
+            holds the item's value. 'demote', the default, sets it in
+            the cache below like a dirty item. 'drop' drops it, so that
+            evictions don't cascade through every level below.
+         write_policy: how writes reaching self cache are handled.
+            'write-back', the default, keeps them dirty in self cache
+            until they are evicted to the backing store. 'write-through'
+            also writes them to the backing store right away and keeps
+            them clean, and does the same for dirty items evicted into
+            self cache; without a backing store it acts as
+            'write-back'. 'write-around' doesn't put written keys in
+            self cache but hands them to the memory below, so bulk
+            writes don't evict the items being read.
+         max_entry_size: if given, items whose value is larger than that
+            many bytes are set in the memory below instead of self
+            cache, so a few large values don't evict many small ones.
+            They end up in the highest level that admits them, or in the
+            backing store. stats() then counts 'admitted' and 'bypassed'
+            items. Ignored if self has no lower memory. Default is None,
+            which admits every item.
+         sizeof: function returning the size in bytes of a value.
+            Defaults to sys.getsizeof(), which is cheap but doesn't
+            count the objects a container refers to.
 
       Raises:
-         ValueError: capacity is less than 1
+         ValueError: capacity is less than 1, clean_demotion is
+            neither 'demote' nor 'drop' or write_policy is unknown
          TypeError: lower_mem is not of type Cache or BackingStore or
             init_values is not of type list or dict
       """
       if capacity < 1:
          raise ValueError("capacity must be greater than 0")
+      if clean_demotion not in ('demote', 'drop'):
+         raise ValueError("clean_demotion must be 'demote' or 'drop'")
+      if write_policy not in Cache._WRITE_POLICIES:
+         raise ValueError("write_policy must be one of " +
+                          ", ".join(Cache._WRITE_POLICIES))
       self._capacity = capacity
       self._lower_mem = lower_mem
       self._upper_mem = None
-      self._modify_key = None
+      self._stats = {'hits': 0, 'misses': 0}
+      self._directory = None
+      self._depth = 0
+      self._skipped = 0
+      self._inclusive = False
+      self._tag_index = None
+      self._refresher = None
+      self._negative_ttl = negative_ttl
+      self._negatives = OrderedDict()
+      if negative_ttl is not None:
+         self._stats['negative_hits'] = 0
+      self._max_entry_size = max_entry_size
+      self._sizeof = sizeof or sys.getsizeof
+      if max_entry_size is not None:
+         self._stats['admitted'] = 0
+         self._stats['bypassed'] = 0
 
       if not (lower_mem is None or isinstance(lower_mem, Cache) or
                  isinstance(lower_mem, BackingStore)):
@@ -703,8 +2665,15 @@ class Cache(MutableMapping):
 
       if self._lower_mem is not None:
          self._lower_mem._upper_mem = self
+      if isinstance(lower_mem, BackingStore):
+         self._bstore = lower_mem
+      else:
+         self._bstore = getattr(lower_mem, '_bstore', None)
+      self._drop_clean = clean_demotion == 'drop' and \
+         isinstance(lower_mem, Cache) and self._bstore is not None
+      self._write_policy = write_policy
 
-      if isinstance(init_values, list):
+      if isinstance(init_values, (list, _View)):
          new_od = []
          for pair in init_values:
             entry = pair[0], Cache._Val(True, pair[1])
@@ -726,23 +2695,31 @@ class Cache(MutableMapping):
 
       When setting capacity lower than the amount of items stored in
       the cache, items are removed from the beginning of the cache,
-      that is, the LRU items.
+      that is, the LRU items. Removed items are demoted to lower memory
+      the same way an eviction would, so dirty items end up in the lower
+      cache or backing store. If there is no lower memory, they are
+      dropped.
 
       Args:
          new_cap: int specifying new capacity
 
       Returns:
          current capacity
+
+      Raises:
+         ValueError: new_cap is less than 1
       """
       return self._capacity
 
    @capacity.setter
    def capacity(self, new_cap):
+      if new_cap < 1:
+         raise ValueError("capacity must be greater than 0")
       self._capacity = new_cap
-      trim = len(self._cache) - self._capacity
-      if (trim > 0):
-         for i in range(trim):
-            self.popitem(last=False)
+      if len(self._cache) > self._capacity:
+         self._send_bs_nondirties()
+         while len(self._cache) > self._capacity:
+            self._demote(*self._popitem(False))
 
    @property
    def lower_mem(self):
@@ -767,12 +2744,32 @@ class Cache(MutableMapping):
       Returns:
          the item belonging to |key|
 
+      With a loader (see enable_refresh()), keys are loaded on a miss
+      and reloaded when they get old, and CacheMiss is only raised if
+      the loader raises KeyError.
+
       Raises:
          CacheMiss: |key| doesn't match anything in caches or backing
-            store
+            store, or did so less than negative_ttl seconds ago
       """
-      item, from_bstore = self._recurs_pop_unless_from_bs(key)
-      dirty = False if from_bstore else True
+      if self._refresher is not None:
+         return self._refreshing_get(key)
+      return self._get(key)
+
+   def _get(self, key):
+      # get the item associated to |key| through the chain
+      #
+      # See __getitem__(); this is it without the loader.
+      if self._negative_ttl is not None:
+         if self._negatives and self._negative_hit(key):
+            raise CacheMiss
+         try:
+            item, dirty = self._lookup(key)
+         except CacheMiss:
+            self._note_missing(key)
+            raise
+      else:
+         item, dirty = self._lookup(key)
       self._send_bs_nondirties((key, item))
       self._setitem(key, item, dirty)
       return item
@@ -781,13 +2778,23 @@ class Cache(MutableMapping):
       """cache[key] = val
 
       set (key, val) into the cache while moving items down in LRU
-      order.
+      order. Any other copy of |key| in the chain is removed first. How
+      the write is done depends on the write_policy of self cache, see
+      __init__().
 
       Args:
          key: string representing key
          val: data to set with key |key|
       """
       args = []
+      if self._negatives:
+         self._negatives.pop(key, None)
+      if self._tag_index is not None:
+         self._tag_index.untag(key)
+      if self._refresher is not None:
+         self._refresher.born[key] = time.monotonic()
+      if self._inclusive:
+         self._drop_lower_copies(key)
       try:
          item, from_bstore = self._recurs_pop_unless_from_bs(key)
          dirty = False if from_bstore else True
@@ -795,7 +2802,7 @@ class Cache(MutableMapping):
       except CacheMiss:
          pass
       self._send_bs_nondirties(*args)
-      self._setitem(key, val)
+      self._write(key, val)
 
    def __delitem__(self, key):
       """del cache[key]
@@ -806,6 +2813,8 @@ class Cache(MutableMapping):
          key: string representing key to remove
       """
       del self._cache[key]
+      if self._directory is not None:
+         self._untrack(key)
 
    def __len__(self):
       """len(cache)
@@ -816,12 +2825,16 @@ class Cache(MutableMapping):
       return len(self._cache)
 
    def items(self):
-      """return list of (key, value) pairs in self cache
+      """return a view of the (key, value) pairs in self cache
+
+      The view is iterated in LRU order, without copying the pairs, and
+      compares equal to a list of the same pairs in the same order.
 
       Returns:
-         list of (key, value) pairs
+         view of (key, value) pairs
       """
-      return [(k, v.val) for k, v in self._cache.items()]
+      return _View(lambda: ((k, v.val) for k, v in self._cache.items()),
+                   self.__len__)
 
    def __iter__(self):
       """return iterator over keys in self cache
@@ -832,20 +2845,26 @@ class Cache(MutableMapping):
       return iter(self._cache)
 
    def keys(self):
-      """return list of keys in self cache
+      """return a view of the keys in self cache
+
+      See items().
 
       Returns:
-         list of keys in self cache
+         view of keys in self cache
       """
-      return list(self._cache.keys())
+      return _View(lambda: iter(self._cache), self.__len__,
+                   self.__contains__)
 
    def values(self):
-      """return list of values in self cache
+      """return a view of the values in self cache
+
+      See items().
 
       Returns:
-         list of values in self cache
+         view of values in self cache
       """
-      return [v.val for v in self._cache.values()]
+      return _View(lambda: (v.val for v in self._cache.values()),
+                   self.__len__)
 
    def __str__(self):
       """return string representation of self cache
@@ -870,21 +2889,79 @@ class Cache(MutableMapping):
       """
       return key in self._cache
 
-   def get(self, key, default=None):
-      """return the value of |key| if exists in self cache
+   def get(self, key, default=None, promote=False):
+      """return the value of |key| if exists in the chain
 
-      Default otherwise.
+      Default otherwise. Unless |promote| is True, the chain is searched
+      like peek() does, and nothing is changed. With a read buffer (see
+      enable_read_buffer()), a value in self cache is read from a
+      snapshot without locking and the read counts toward the LRU order.
 
       Args:
          key: string representing the key
          default: value returned if key doesn't exist. Defaults to None
+         promote: if True, look |key| up like cache[key] does, placing
+            it at the top of self cache. Defaults to False
+
+      Returns:
+         value of |key| if exists in the chain; otherwise returns
+         default. A closed backing store is treated as not holding
+         |key|
+
+      Raises:
+         BStoreClosedError: |promote| is True, the backing store is
+            searched and is closed
+      """
+      if promote:
+         try:
+            return self[key]
+         except CacheMiss:
+            return default
+      if self._read_buffered:
+         snap = self._cache.snapshot()
+         if snap is not None and key in snap:
+            self._cache.touch(key)
+            return snap[key]
+      try:
+         return self.peek(key)
+      except (CacheMiss, BStoreClosedError):
+         return default
+
+   def peek(self, key):
+      """return the value of |key| without changing anything
+
+      The caches from self down and the backing store are searched like
+      cache[key] does, but the key isn't promoted, nothing is demoted,
+      and neither the LRU order, the stats nor the remembered misses
+      change.
+
+      Args:
+         key: string representing the key
 
       Returns:
-         value of |key| if exists in self cache; otherwise returns
-         default
+         the item belonging to |key|
+
+      Raises:
+         CacheMiss: |key| doesn't match anything in caches or backing
+            store
+         BStoreClosedError: the backing store is searched and is closed
       """
-      got = self._cache.get(key, default)
-      return got.val if got is not default else got
+      levels = self._levels()
+      if self._directory is not None:
+         owner = self._directory.get(key)
+         levels = () if owner is None or owner._depth < self._depth \
+            else (owner,)
+      for mem in levels:
+         try:
+            return mem._cache[key].val
+         except KeyError:
+            pass
+      if self._bstore is not None:
+         try:
+            return self._bstore._peek(key)
+         except KeyError:
+            pass
+      raise CacheMiss
 
    def __eq__(self, other):
       """return True if self is equal to |other| Cache
@@ -955,7 +3032,11 @@ class Cache(MutableMapping):
 
    def clear(self):
       """Remove all items in the self cache"""
+      if self._directory is not None:
+         for k in self._cache:
+            self._untrack(k)
       self._cache.clear()
+      self._negatives.clear()
 
    def update(self, other):
       """update self cache with items from other cache
@@ -965,7 +3046,11 @@ class Cache(MutableMapping):
       Args:
          other: other Cache instance
       """
-      self._cache.update(other._items())
+      items = other._items()
+      self._cache.update(items)
+      for k, v in items:
+         self._track(k)
+         self._negatives.pop(k, None)
 
    def setdefault(self, key, default=None):
       """return key's value if key is in self cache
@@ -985,63 +3070,1857 @@ class Cache(MutableMapping):
          self[key] = default
          return default
 
-   def open_bstore(self):
-      """open backing store
+   def enable_directory(self):
+      """keep a directory of which cache holds each key
 
-      if lowest memory in the chain is a BackingStore object
+      The directory covers self and every cache below self. Lookups
+      through self then go straight to the cache holding the key, or
+      straight to the backing store when no cache holds it, instead of
+      probing every level in turn. Keeping the directory up to date
+      costs a dictionary update on every insert and removal.
+
+      Raises:
+         ValueError: a cache of the chain is a SharedMemoryCache, whose
+            contents other processes can change, or the chain is in
+            inclusive mode, where a key can be held by several caches
+      """
+      levels = list(self._levels())
+      if any(isinstance(mem, SharedMemoryCache) for mem in levels):
+         raise ValueError("a directory can't cover a SharedMemoryCache")
+      if any(mem._inclusive for mem in levels):
+         raise ValueError("a directory can't cover an inclusive chain")
+      self.disable_directory()
+      directory = {}
+      for depth, mem in enumerate(levels):
+         for k in mem._cache:
+            directory.setdefault(k, mem)
+         mem._directory = directory
+         mem._depth = depth
+
+   def disable_directory(self):
+      """stop keeping the directory of self and every cache below self"""
+      levels = list(self._levels())
+      misses = [mem._directory_misses() for mem in levels]
+      for mem, missed in zip(levels, misses):
+         mem._stats['misses'] += missed
+         mem._skipped = 0
+         mem._directory = None
+
+   @property
+   def _read_buffered(self):
+      # return True if self cache has a read buffer
+      return isinstance(self._cache, _ReadBufferedDict)
+
+   def enable_read_buffer(self, stripes=4, drain_at=32):
+      """read self cache through a snapshot and a buffer of reads
+
+      Meant for read-mostly caches shared by threads. get() then looks
+      the key up in a snapshot of the values of self cache, without
+      taking any lock, and leaves the read in a buffer. The buffer is
+      split in |stripes| stripes, each thread writing to one of them,
+      and a stripe holding |drain_at| reads is applied to the LRU order
+      under a lock, if no other thread holds it. Evicting from self
+      cache applies every stripe first. Reads are dropped when a stripe
+      holds 4 * drain_at of them, so the LRU order is approximate.
+
+      Changes to self cache take the lock and drop the snapshot, which
+      the next get() publishes again, so a write costs a copy of self
+      cache once it is read. Lookups through the chain with cache[key]
+      still promote the key and change self cache.
+
+      Args:
+         stripes: int number of stripes of the read buffer. Defaults
+            to 4
+         drain_at: int number of reads a stripe holds before it is
+            applied. Defaults to 32
+
+      Raises:
+         ValueError: stripes or drain_at is less than 1, or self is a
+            SharedMemoryCache, which has a lock of its own
+      """
+      if stripes < 1 or drain_at < 1:
+         raise ValueError("stripes and drain_at must be greater than 0")
+      if not isinstance(self._cache, OrderedDict):
+         raise ValueError("a SharedMemoryCache can't have a read buffer")
+      self.disable_read_buffer()
+      self._cache = _ReadBufferedDict(stripes, drain_at,
+                                      self._cache.items())
+
+   def disable_read_buffer(self):
+      """apply the buffered reads and stop using the read buffer"""
+      if self._read_buffered:
+         self._cache.drain()
+         self._cache = OrderedDict(self._cache.items())
+
+   @property
+   def mode(self):
+      """get the hierarchy mode of self cache
+
+      Returns:
+         'exclusive' or 'inclusive'. See set_mode().
+      """
+      return 'inclusive' if self._inclusive else 'exclusive'
+
+   def set_mode(self, mode):
+      """set the hierarchy mode of self and every cache below self
+
+      In 'exclusive' mode, the default, a key found in a lower cache is
+      moved up into self, so each key is held by one cache at most and
+      the chain holds as many keys as its capacities add up to. This
+      suits write-heavy workloads.
+
+      In 'inclusive' mode, a key found in a lower cache is copied up and
+      its copy stays there, still the most recently used. The copy
+      handed up takes the dirty flag, leaving the lower copy clean, so
+      evicting a clean item whose lower cache still holds a copy costs
+      nothing. Writing a key removes the copies below the one written.
+      This suits read-heavy workloads.
+
+      Items already in the caches are left where they are.
+
+      Args:
+         mode: 'exclusive' or 'inclusive'
+
+      Raises:
+         ValueError: |mode| is not a known mode, or a directory is kept
+            for the chain. See enable_directory().
+      """
+      if mode not in ('exclusive', 'inclusive'):
+         raise ValueError("mode must be 'exclusive' or 'inclusive'")
+      levels = list(self._levels())
+      if mode == 'inclusive' and \
+            any(mem._directory is not None for mem in levels):
+         raise ValueError("a directory can't cover an inclusive chain")
+      for mem in levels:
+         mem._inclusive = mode == 'inclusive'
+
+   _SNAPSHOT_MAGIC = 'cache-snapshot'
+   _SNAPSHOT_VERSION = 1
+
+   def snapshot(self, path):
+      """save the items of self and every cache below self to a file
+
+      Each level's keys, values and dirty flags are written in LRU order
+      as a stream of pickles, one per item, so the whole chain never has
+      to be copied in memory. The backing store is not included.
+
+      Args:
+         path: string representing the path of the file to write
+
+      Returns:
+         number of items saved
+      """
+      levels = list(self._levels())
+      saved = 0
+      with open(path, 'wb') as f:
+         pickler = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+         pickler.dump((Cache._SNAPSHOT_MAGIC, Cache._SNAPSHOT_VERSION,
+                       len(levels)))
+         for mem in levels:
+            pickler.dump(len(mem._cache))
+            for k, v in mem._cache.items():
+               pickler.dump((k, v.dirty, v.val))
+               pickler.clear_memo()
+               saved += 1
+      return saved
+
+   def _read_snapshot(self, path, count):
+      # return the items of each level saved in the snapshot file |path|
+      #
+      # The whole file is read and checked before anything is returned.
+      #
+      # Args:
+      #    path: string representing the path of a snapshot file
+      #    count: number of cache levels the snapshot must have
+      #
+      # Returns:
+      #    list of one list of (key, dirty, value) triples per level
+      #
+      # Raises:
+      #    ValueError: the file is not a snapshot, is truncated or
+      #       corrupt, or doesn't have |count| levels
+      with open(path, 'rb') as f:
+         unpickler = pickle.Unpickler(f)
+         try:
+            header = unpickler.load()
+         except (EOFError, pickle.UnpicklingError):
+            header = None
+         if not (isinstance(header, tuple) and len(header) == 3 and
+                 header[0] == Cache._SNAPSHOT_MAGIC and
+                 header[1] == Cache._SNAPSHOT_VERSION):
+            raise ValueError("{} is not a cache snapshot".format(path))
+         if header[2] != count:
+            raise ValueError(
+               "snapshot has {} levels but the chain has {}".format(
+                  header[2], count))
+         levels = []
+         try:
+            for i in range(count):
+               items = []
+               for j in range(unpickler.load()):
+                  k, dirty, val = unpickler.load()
+                  items.append((k, dirty, val))
+               levels.append(items)
+         except (EOFError, pickle.UnpicklingError, TypeError,
+                 ValueError) as e:
+            raise ValueError("{} is a corrupt cache snapshot: {}".format(
+               path, e)) from e
+      return levels
+
+   def restore(self, path):
+      """replace the items of self and every cache below self from a file
+
+      The file must have been written by snapshot() on a chain with the
+      same number of cache levels. Each level gets back its items in LRU
+      order with their dirty flags. If a level now has a smaller capacity
+      than it had, its LRU items are demoted as if evicted. The file is
+      read and checked in full first, and the dirty items of the chain
+      are written back with flush() before they are replaced, so a bad
+      file leaves the chain as it was.
+
+      Args:
+         path: string representing the path of a snapshot file
+
+      Returns:
+         number of items restored
+
+      Raises:
+         ValueError: the file is not a snapshot or is corrupt, the
+            number of levels doesn't match the chain, or the chain holds
+            dirty items and has no backing store to write them back to
+         BStoreClosedError: the chain holds dirty items and the backing
+            store is closed
+      """
+      levels = list(self._levels())
+      snapshot = self._read_snapshot(path, len(levels))
+      restored = 0
+      with self._chain_held():
+         if any(v.dirty for mem in levels for v in mem._cache.values()):
+            if not self._is_lowest_mem_bstore():
+               raise ValueError("dirty items can't be replaced without "
+                                "a backing store to write them back to")
+            self.flush().wait()
+         for mem, items in zip(levels, snapshot):
+            mem.clear()
+            for k, dirty, val in items:
+               mem._cache[k] = Cache._Val(dirty, val)
+               mem._track(k)
+               restored += 1
+         self._send_bs_nondirties()
+         for mem in levels:
+            while len(mem._cache) > mem._capacity:
+               mem._demote(*mem._popitem(False))
+      return restored
+
+   def warm_up(self, count=None):
+      """load the most recently used keys of the backing store
+
+      Keys are taken from BackingStore.recent_keys() and loaded as
+      non-dirty items, the most recent ending up in self cache and older
+      ones in the caches below. Keys already in a cache are skipped.
+
+      Args:
+         count: int maximum number of keys to load. Defaults to the
+            total capacity of self and the caches below.
+
+      Returns:
+         number of items loaded
 
       Raises:
          NoBStoreError: lowest memory in the chain is not a BackingStore
             object
+         BStoreClosedError: backing store is closed
+         ValueError: the backing store doesn't track recency
       """
       if not self._is_lowest_mem_bstore():
          raise NoBStoreError
       bs = self._get_lowest_mem()
-      bs.open()
+      levels = list(self._levels())
+      if count is None:
+         count = sum(mem.capacity for mem in levels)
+      loaded = 0
+      for k in reversed(bs.recent_keys(count)):
+         if not any(k in mem for mem in levels):
+            self._setitem(k, bs[k], False)
+            loaded += 1
+      return loaded
+
+   def flush(self, executor=None):
+      """write back every dirty item of the chain as one batch
+
+      The dirty items of self and of every cache below self are handed
+      to the backing store with BackingStore.set_many() and marked as
+      non-dirty.
 
-   def close_bstore(self):
-      """close backing store
+      Args:
+         executor: concurrent.futures.Executor used to write the batch.
+            If None, the batch is written before returning.
 
-      if lowest memory in the chain is a BackingStore object.
-      No-op otherwise.
+      Returns:
+         WriteBackHandle to wait on for the batch to be written
+
+      Raises:
+         NoBStoreError: lowest memory in the chain is not a BackingStore
+            object
+         BStoreClosedError: backing store is closed
       """
-      if self._is_lowest_mem_bstore():
-         bs = self._get_lowest_mem()
-         bs.close()
+      if not self._is_lowest_mem_bstore():
+         raise NoBStoreError
+      bs = self._get_lowest_mem()
+      batch = []
+      with self._chain_held():
+         for mem in self._levels():
+            for k, v in mem._items():
+               if v.dirty:
+                  batch.append((k, v.val))
+                  mem._cache[k] = Cache._Val(False, v.val)
+         self._send_bs_nondirties()
+         return bs.set_many(batch, executor)
 
-   def bstore_closed(self):
-      """return True if backing store is closed
+   def set(self, key, val, tags=()):
+      """cache[key] = val, tagging the entry with |tags|
 
-      If lowest memroy in the chain is not a BackingStore object,
-      True is returned anyway.
+      The tags stay with the key as it moves through the chain, down to
+      the backing store, until the key is set again. Setting it with
+      cache[key] = val drops its tags. See invalidate_tag().
+
+      Args:
+         key: string representing key
+         val: data to set with key |key|
+         tags: iterable of hashable tags
+      """
+      self[key] = val
+      tags = set(tags)
+      if tags:
+         index = self._tag_index
+         if index is None:
+            index = _TagIndex()
+            for mem in self._levels():
+               mem._tag_index = index
+         index.tag(key, tags)
+         if len(index) > index.sweep_at:
+            self._prune_tags()
+
+   def _prune_tags(self):
+      # untag the keys that are no longer anywhere in the chain
+      #
+      # Runs when the number of tagged keys has doubled since the last
+      # pruning, so it costs O(1) per tagged set on average.
+      index = self._tag_index
+      bs = self._bstore
+      levels = list(self._levels())
+      for k in index.keys():
+         if not any(k in mem for mem in levels) and \
+               (bs is None or k not in bs):
+            index.untag(k)
+      index.sweep_at = max(1024, 2 * len(index))
+
+   def tags(self, key):
+      """return the tags |key| was set with
+
+      Args:
+         key: string representing key
 
       Returns:
-         True if backing store closed or nonexistent; False otherwise
+         frozenset of the tags of |key|, empty if it has none
       """
-      if self._is_lowest_mem_bstore():
-         bs = self._get_lowest_mem()
-         return bs.closed()
-      else:
-         return True
+      if self._tag_index is None:
+         return frozenset()
+      return self._tag_index.tags_of(key)
 
-   def __enter__(self):
-      """opens the backing store using the "with" context manager
+   def _invalidate(self, keys):
+      # remove |keys| from self, every cache below and the backing store
+      #
+      # Returns:
+      #     number of keys removed from at least one of them
+      removed = set()
+      with self._chain_held():
+         for mem in self._levels():
+            for k in keys:
+               if mem._discard(k):
+                  removed.add(k)
+         if self._bstore is not None:
+            bs = self._bstore
+            with bs._lock:
+               bs._raise_on_bstore_closed()
+               for k in keys:
+                  bs._orphans.discard(k)
+                  if k in bs:
+                     del bs[k]
+                     removed.add(k)
+      if self._tag_index is not None:
+         for k in keys:
+            self._tag_index.untag(k)
+      if self._refresher is not None:
+         self._refresh_invalidated(keys)
+      return len(removed)
+
+   def invalidate_tag(self, tag):
+      """remove every key tagged with |tag| from the whole chain
+
+      The keys are found in the tag index, then removed from self, every
+      cache below self and the backing store, dirty or not, with one
+      pass per level rather than one chain traversal per key.
 
-      calls open_bstore(). See above for description.
+      Args:
+         tag: tag given to set()
 
       Returns:
-         self
+         number of keys removed
+
+      Raises:
+         BStoreClosedError: backing store is closed
       """
-      self.open_bstore()
-      return self
+      if self._tag_index is None:
+         return 0
+      return self._invalidate(self._tag_index.pop_tag(tag))
 
-   def __exit__(self, exc_type, exc_val, exc_tb):
-      """closes the backing store at the end of the "with" context
+   def invalidate_pattern(self, pattern):
+      """remove every key matching |pattern| from the whole chain
 
-      calls close_bstore(). See above for description.
+      |pattern| is a shell-style pattern as understood by fnmatch, such
+      as 'tenant1:*'. Every key of self, of every cache below self and
+      of the backing store is matched against it.
+
+      Args:
+         pattern: string holding the pattern
+
+      Returns:
+         number of keys removed
 
       Raises:
-         any exceptions thrown in the "with" context
+         BStoreClosedError: backing store is closed
       """
-      self.close_bstore()
-      return False
+      keys = set()
+      with self._chain_held():
+         for mem in self._levels():
+            keys.update(k for k in mem._cache.keys()
+                        if fnmatch.fnmatchcase(k, pattern))
+         if self._bstore is not None:
+            keys.update(k for k in self._bstore.keys()
+                        if fnmatch.fnmatchcase(k, pattern))
+         return self._invalidate(keys)
+
+   def enable_refresh(self, loader, ttl, stale_ttl=0, refresh_ahead=None,
+                      executor=None):
+      """load missing keys with |loader| and keep hot keys fresh
+
+      A key read through self that no cache or store holds is loaded
+      by calling loader(key) and set in self like a write. A value
+      loaded or set through self is fresh for |ttl| seconds. After that
+      it is stale: for |stale_ttl| more seconds it is still returned,
+      while a reload runs on |executor| (stale-while-revalidate). Older
+      values, and values of unknown age such as ones left in the backing
+      store by an earlier run, are reloaded before returning. With
+      |refresh_ahead|, a fresh value read after that fraction of |ttl|
+      is reloaded in the background too, so keys read often never go
+      stale. Keys read in the last |ttl| seconds that are invalidated
+      with invalidate_tag() or invalidate_pattern() are reloaded in the
+      background as well.
+
+      Reloads finished on the executor are set in the chain by the next
+      read through self, from the reading thread. A read of a key being
+      reloaded waits for that reload instead of calling the loader
+      again. stats() counts 'loads' made while reading, 'refreshes'
+      started in the background and 'stale_hits'.
+
+      Args:
+         loader: callable returning the value of a key, or raising
+            KeyError if there is none
+         ttl: seconds a value stays fresh
+         stale_ttl: seconds a value is still returned after going
+            stale. Defaults to 0
+         refresh_ahead: fraction of |ttl| after which a read starts a
+            reload, between 0 and 1. Defaults to None, which only
+            reloads stale values
+         executor: concurrent.futures.Executor running the background
+            reloads. Defaults to a ThreadPoolExecutor owned by self
+
+      Raises:
+         ValueError: ttl isn't positive, stale_ttl is negative or
+            refresh_ahead isn't between 0 and 1
+      """
+      if ttl <= 0 or stale_ttl < 0:
+         raise ValueError("ttl must be positive and stale_ttl not negative")
+      if refresh_ahead is not None and not 0 < refresh_ahead <= 1:
+         raise ValueError("refresh_ahead must be between 0 and 1")
+      self.disable_refresh()
+      self._refresher = _Refresher(loader, ttl, stale_ttl, refresh_ahead,
+                                   executor)
+      for k in ('loads', 'refreshes', 'stale_hits'):
+         self._stats.setdefault(k, 0)
+
+   def disable_refresh(self, wait=True):
+      """stop using the loader given to enable_refresh()
+
+      Reloads still running are dropped. The executor is shut down if
+      self created it.
+
+      Args:
+         wait: if True, wait for the running reloads to finish
+      """
+      r = self._refresher
+      if r is None:
+         return
+      self._refresher = None
+      if r.own_executor:
+         r.executor.shutdown(wait)
+
+   def _refreshing_get(self, key):
+      # get |key| through the chain, loading or reloading it as needed
+      r = self._refresher
+      self._apply_refreshes()
+      now = time.monotonic()
+      try:
+         val = self._get(key)
+      except CacheMiss:
+         return self._load(key)
+      r.read_at[key] = now
+      age = now - r.born.get(key, -math.inf)
+      if age >= r.ttl + r.stale_ttl:
+         return self._load(key)
+      if age >= r.ttl:
+         self._stats['stale_hits'] += 1
+         self._schedule_refresh(key)
+      elif r.refresh_ahead is not None and age >= r.refresh_ahead * r.ttl:
+         self._schedule_refresh(key)
+      return val
+
+   def _schedule_refresh(self, key):
+      # reload |key| in the background
+      if self._refresher.schedule(key):
+         self._stats['refreshes'] += 1
+
+   def _load(self, key):
+      # load |key|, or wait for its running reload, and set it in self
+      #
+      # Raises:
+      #     CacheMiss: the loader raised KeyError
+      r = self._refresher
+      future = r.inflight.pop(key, None)
+      try:
+         if future is not None:
+            val = future.result()
+         else:
+            self._stats['loads'] += 1
+            val = r.loader(key)
+      except KeyError:
+         raise CacheMiss
+      self._set_loaded(key, val)
+      r.read_at[key] = r.born[key]
+      if len(r.born) > r.sweep_at:
+         r.prune(r.born[key])
+      return val
+
+   def _apply_refreshes(self):
+      # set the values of the reloads finished on the executor
+      #
+      # A reload is dropped if it failed, or if |key| was set again
+      # after the reload started.
+      r = self._refresher
+      while r.done:
+         key, future, started = r.done.popleft()
+         if r.inflight.get(key) is future:
+            del r.inflight[key]
+         if future.exception() is None and \
+               r.born.get(key, -math.inf) < started:
+            self._set_loaded(key, future.result())
+
+   def _set_loaded(self, key, val):
+      # set the (re)loaded |val| of |key|, keeping the tags of |key|
+      #
+      # self[key] = val drops the tags, as a write replaces the item.
+      # A reload refreshes the same item, so its tags are put back.
+      index = self._tag_index
+      tags = index.tags_of(key) if index is not None else ()
+      self[key] = val
+      if tags:
+         index.tag(key, tags)
+
+   def _refresh_invalidated(self, keys):
+      # reload the invalidated |keys| that were read in the last ttl
+      r = self._refresher
+      now = time.monotonic()
+      for k in keys:
+         r.born.pop(k, None)
+         if now - r.read_at.get(k, -math.inf) < r.ttl:
+            self._schedule_refresh(k)
+
+   def stats(self):
+      """return the hit/miss counters of self cache
+
+      A hit is counted whenever a lookup through the chain finds the key
+      in self cache, and a miss whenever it has to look below self.
+
+      Returns:
+         dictionary with 'hits' and 'misses' counts for self cache, and
+         a 'negative_hits' count of lookups answered by remembered
+         misses if self cache has a negative_ttl. See enable_refresh()
+         for the counters of a cache with a loader, and __init__() for
+         those of a cache with a max_entry_size.
+      """
+      stats = dict(self._stats)
+      stats['misses'] += self._directory_misses()
+      return stats
+
+   def reset_stats(self):
+      """reset the hit/miss counters of self cache to 0"""
+      for k in self._stats:
+         self._stats[k] = 0
+      missed = self._directory_misses()
+      if missed:
+         self._skipped -= missed
+         if isinstance(self._lower_mem, Cache) and \
+               self._lower_mem._directory is self._directory:
+            self._lower_mem._skipped += missed
+
+   def open_bstore(self):
+      """open backing store
+
+      if lowest memory in the chain is a BackingStore object
+
+      Raises:
+         NoBStoreError: lowest memory in the chain is not a BackingStore
+            object
+      """
+      if not self._is_lowest_mem_bstore():
+         raise NoBStoreError
+      bs = self._get_lowest_mem()
+      bs.open()
+
+   def close_bstore(self):
+      """close backing store
+
+      if lowest memory in the chain is a BackingStore object.
+      No-op otherwise.
+      """
+      if self._is_lowest_mem_bstore():
+         bs = self._get_lowest_mem()
+         bs.close()
+
+   def bstore_closed(self):
+      """return True if backing store is closed
+
+      If lowest memroy in the chain is not a BackingStore object,
+      True is returned anyway.
+
+      Returns:
+         True if backing store closed or nonexistent; False otherwise
+      """
+      if self._is_lowest_mem_bstore():
+         bs = self._get_lowest_mem()
+         return bs.closed()
+      else:
+         return True
+
+   def __enter__(self):
+      """opens the backing store using the "with" context manager
+
+      calls open_bstore(). See above for description.
+
+      Returns:
+         self
+      """
+      self.open_bstore()
+      return self
+
+   def __exit__(self, exc_type, exc_val, exc_tb):
+      """closes the backing store at the end of the "with" context
+
+      calls close_bstore(). See above for description.
+
+      Raises:
+         any exceptions thrown in the "with" context
+      """
+      self.close_bstore()
+      return False
+
+
+class CapacityController():
+   """Capacity controller class. Link this to the top Cache of a chain
+
+   Splits a total budget across every Cache level of a chain and, on each
+   call to rebalance(), shifts capacity toward the levels that served the
+   most hits since the previous call. The budget is a number of entries,
+   or a number of bytes if a |sizeof| function is given. Levels that
+   shrink demote their LRU items down the chain rather than dropping them,
+   so dirty data still reaches the backing store. The backing store
+   capacity is not managed by the controller.
+   """
+
+   @staticmethod
+   def _apportion(weights, total, floor):
+      # split |total| into integer shares proportional to |weights|
+      #
+      # Every share gets at least |floor|. The remainder left after
+      # flooring is handed out using the largest remainder method, so
+      # the shares always add up to |total|.
+      #
+      # Args:
+      #     weights: list of non-negative numbers, one per share
+      #     total: int to split
+      #     floor: int minimum for each share
+      #
+      # Returns:
+      #     list of int shares
+      spare = total - floor * len(weights)
+      wsum = sum(weights)
+      if wsum == 0:
+         weights = [1] * len(weights)
+         wsum = len(weights)
+      exact = [spare * w / wsum for w in weights]
+      shares = [int(e) for e in exact]
+      left = spare - sum(shares)
+      order = sorted(range(len(exact)),
+                     key=lambda i: exact[i] - shares[i], reverse=True)
+      for i in order[:left]:
+         shares[i] += 1
+      return [floor + s for s in shares]
+
+   def _avg_entry_size(self, level):
+      # return the average size in bytes of an entry held in |level|
+      #
+      # Falls back to 1 if |level| is empty.
+      if not len(level):
+         return 1
+      return max(1, sum(self._sizeof(v) for v in level.values()) //
+                 len(level))
+
+   def __init__(self, cache, budget, sizeof=None, min_capacity=1,
+                smoothing=0.5):
+      """Instantiate a CapacityController object.
+
+      The budget is split evenly across the levels when the controller
+      is created.
+
+      Args:
+         cache: top Cache of the chain to control
+         budget: int total number of entries, or bytes if |sizeof| is
+            given, shared by all Cache levels of the chain
+         sizeof: function returning the size in bytes of a value. If
+            None, |budget| counts entries. Defaults to None.
+         min_capacity: int smallest capacity any level can be shrunk
+            to. Defaults to 1.
+         smoothing: float between 0 and 1. The share of the budget that
+            follows the current split rather than the observed hits.
+            Defaults to 0.5.
+
+      Raises:
+         TypeError: cache is not of type Cache
+         ValueError: budget is too small to give every level
+            |min_capacity|, or smoothing is not between 0 and 1
+      """
+      if not isinstance(cache, Cache):
+         raise TypeError("cache must be of type Cache")
+      if min_capacity < 1:
+         raise ValueError("min_capacity must be greater than 0")
+      if not 0 <= smoothing <= 1:
+         raise ValueError("smoothing must be between 0 and 1")
+      self._cache = cache
+      self._budget = budget
+      self._sizeof = sizeof
+      self._min_capacity = min_capacity
+      self._smoothing = smoothing
+
+      levels = list(cache._levels())
+      if sizeof is None and budget < min_capacity * len(levels):
+         raise ValueError("budget must cover min_capacity for each level")
+      self._last_hits = [lv.stats()['hits'] for lv in levels]
+      self._shares = CapacityController._apportion(
+         [1] * len(levels), budget, 0)
+      self._resize(levels, self._capacities(levels))
+
+   @property
+   def budget(self):
+      """get total budget of the chain
+
+      Returns:
+         total number of entries, or bytes, shared by all levels
+      """
+      return self._budget
+
+   def _capacities(self, levels):
+      # turn the current budget shares into a capacity per level
+      #
+      # Args:
+      #     levels: list of Cache levels of the chain, top first
+      #
+      # Returns:
+      #     list of int capacities, one per level
+      if self._sizeof is None:
+         return [max(self._min_capacity, s) for s in self._shares]
+      return [max(self._min_capacity, s // self._avg_entry_size(lv))
+              for s, lv in zip(self._shares, levels)]
+
+   def _resize(self, levels, caps):
+      # set the capacity of each level in |levels| to |caps|
+      #
+      # Levels are grown first so the demotions caused by shrinking
+      # levels have room to land below. Shrinking goes from top to
+      # bottom. If the lowest level has no backing store below, it is
+      # never shrunk below the number of items it holds, since anything
+      # demoted from it would be lost.
+      #
+      # Args:
+      #     levels: list of Cache levels of the chain, top first
+      #     caps: list of int capacities, one per level
+      lowest = levels[-1]
+      spill = lowest.lower_mem is None
+      for lv, cap in zip(levels, caps):
+         if cap > lv.capacity:
+            lv.capacity = cap
+      if spill:
+         lowest.capacity = lowest.capacity + sum(len(lv) for lv in levels)
+      for lv, cap in zip(levels, caps):
+         if spill and lv is lowest:
+            cap = max(cap, len(lv))
+         if cap < lv.capacity:
+            lv.capacity = cap
+
+   def rebalance(self):
+      """shift capacity between levels according to observed hits
+
+      Each level's new share of the budget is a blend of its current
+      share and its share of the hits counted since the last rebalance,
+      weighted by the smoothing factor. If no hits were counted, the
+      capacities are left unchanged.
+
+      Returns:
+         list of the new capacities, one per level starting at the top
+      """
+      levels = list(self._cache._levels())
+      now = [lv.stats()['hits'] for lv in levels]
+      # a counter lower than last time means its stats were reset
+      hits = [n - last if n >= last else n
+              for n, last in zip(now, self._last_hits)]
+      self._last_hits = now
+      total = sum(hits)
+      if total > 0:
+         weights = [self._smoothing * s / self._budget +
+                    (1 - self._smoothing) * h / total
+                    for s, h in zip(self._shares, hits)]
+         floor = self._min_capacity if self._sizeof is None else 0
+         self._shares = CapacityController._apportion(
+            weights, self._budget, floor)
+         self._resize(levels, self._capacities(levels))
+      return [lv.capacity for lv in levels]
+
+
+class _SharedTable(MutableMapping):
+   # Represents an ordered hash table of Cache._Val objects kept in a
+   # multiprocessing.shared_memory block
+   #
+   # This is the shared memory counterpart of the OrderedDict a Cache
+   # keeps its items in, and supports the parts of the OrderedDict
+   # interface Cache uses. Items live in fixed size slots linked in LRU
+   # order (head is the LRU item, tail the MRU item). Keys are found
+   # through an open addressing index of slot numbers. Every operation
+   # holds |lock| so the table can be used from several processes.
+   #
+   # Layout of the block: header, index buckets, slots. Each slot is a
+   # slot header followed by |slot_size| bytes for the pickled
+   # (key, dirty, value) triple.
+
+   _MAGIC = 0x53484d43
+   _HDR = struct.Struct('<10i')
+   (_H_MAGIC, _H_SLOTS, _H_SLOT_SIZE, _H_BUCKETS, _H_COUNT, _H_HEAD,
+    _H_TAIL, _H_FREE, _H_TOMBS, _H_CAPACITY) = range(10)
+   _SLOT = struct.Struct('<qiiiI')
+   _BUCKET = struct.Struct('<i')
+   _EMPTY = -1
+   _TOMB = -2
+   _NIL = -1
+
+   @staticmethod
+   def size_for(slots, slot_size):
+      # return the number of bytes needed for a table of |slots| slots
+      #
+      # Returns:
+      #     a (size, number of buckets) pair
+      nbuckets = 1
+      while nbuckets < 2 * slots:
+         nbuckets *= 2
+      st = _SharedTable
+      size = st._HDR.size + nbuckets * st._BUCKET.size + \
+         slots * (st._SLOT.size + slot_size)
+      return size, nbuckets
+
+   def __init__(self, buf, lock, slots=None, slot_size=None):
+      # instantiate a _SharedTable object over the memoryview |buf|
+      #
+      # If |slots| is given, the table is formatted as a new empty table;
+      # otherwise the header already in |buf| is used.
+      #
+      # Args:
+      #     buf: memoryview of the shared memory block
+      #     lock: multiprocessing lock shared by every process using the
+      #        table
+      #     slots: int number of slots of a new table
+      #     slot_size: int bytes available for each pickled item
+      #
+      # Raises:
+      #     ValueError: |buf| doesn't hold a table
+      self._buf = buf
+      self._lock = lock
+      if slots is not None:
+         size, nbuckets = _SharedTable.size_for(slots, slot_size)
+         self._set(self._H_MAGIC, self._MAGIC)
+         self._set(self._H_SLOTS, slots)
+         self._set(self._H_SLOT_SIZE, slot_size)
+         self._set(self._H_BUCKETS, nbuckets)
+         self._set(self._H_CAPACITY, slots)
+      elif self._get(self._H_MAGIC) != self._MAGIC:
+         raise ValueError("shared memory block doesn't hold a cache")
+      self._nslots = self._get(self._H_SLOTS)
+      self._slot_size = self._get(self._H_SLOT_SIZE)
+      self._nbuckets = self._get(self._H_BUCKETS)
+      self._buckets_off = self._HDR.size
+      self._slots_off = self._buckets_off + \
+         self._nbuckets * self._BUCKET.size
+      if slots is not None:
+         self._reset()
+
+   def _get(self, field):
+      return struct.unpack_from('<i', self._buf, 4 * field)[0]
+
+   def _set(self, field, value):
+      struct.pack_into('<i', self._buf, 4 * field, value)
+
+   def _bucket(self, b):
+      return self._BUCKET.unpack_from(
+         self._buf, self._buckets_off + b * self._BUCKET.size)[0]
+
+   def _set_bucket(self, b, slot):
+      self._BUCKET.pack_into(
+         self._buf, self._buckets_off + b * self._BUCKET.size, slot)
+
+   def _slot_off(self, slot):
+      return self._slots_off + slot * (self._SLOT.size + self._slot_size)
+
+   def _slot_hdr(self, slot):
+      # return [hash, prev, next, bucket, length] of |slot|
+      return list(self._SLOT.unpack_from(self._buf, self._slot_off(slot)))
+
+   def _set_slot_hdr(self, slot, hdr):
+      self._SLOT.pack_into(self._buf, self._slot_off(slot), *hdr)
+
+   def _set_link(self, slot, prev=None, nxt=None):
+      hdr = self._slot_hdr(slot)
+      if prev is not None:
+         hdr[1] = prev
+      if nxt is not None:
+         hdr[2] = nxt
+      self._set_slot_hdr(slot, hdr)
+
+   def _load(self, slot):
+      # return the (key, dirty, value) triple stored in |slot|
+      off = self._slot_off(slot) + self._SLOT.size
+      length = self._slot_hdr(slot)[4]
+      return pickle.loads(self._buf[off:off + length])
+
+   def _reset(self):
+      # empty the table and chain every slot into the free list
+      for b in range(self._nbuckets):
+         self._set_bucket(b, self._EMPTY)
+      for slot in range(self._nslots):
+         nxt = slot + 1 if slot + 1 < self._nslots else self._NIL
+         self._set_slot_hdr(slot, [0, self._NIL, nxt, self._EMPTY, 0])
+      self._set(self._H_COUNT, 0)
+      self._set(self._H_HEAD, self._NIL)
+      self._set(self._H_TAIL, self._NIL)
+      self._set(self._H_FREE, 0 if self._nslots else self._NIL)
+      self._set(self._H_TOMBS, 0)
+
+   def _find(self, key, h):
+      # look up |key| whose hash is |h| in the index
+      #
+      # Returns:
+      #     (bucket, slot) of |key| if found; otherwise (bucket, -1) where
+      #     bucket is where |key| should be inserted
+      mask = self._nbuckets - 1
+      b = h & mask
+      first_tomb = None
+      for i in range(self._nbuckets):
+         slot = self._bucket(b)
+         if slot == self._EMPTY:
+            return (b if first_tomb is None else first_tomb), -1
+         if slot == self._TOMB:
+            if first_tomb is None:
+               first_tomb = b
+         elif self._slot_hdr(slot)[0] == h and self._load(slot)[0] == key:
+            return b, slot
+         b = (b + 1) & mask
+      return first_tomb, -1
+
+   def _rehash(self):
+      # rebuild the index from the LRU list to get rid of tombstones
+      for b in range(self._nbuckets):
+         self._set_bucket(b, self._EMPTY)
+      mask = self._nbuckets - 1
+      slot = self._get(self._H_HEAD)
+      while slot != self._NIL:
+         hdr = self._slot_hdr(slot)
+         b = hdr[0] & mask
+         while self._bucket(b) != self._EMPTY:
+            b = (b + 1) & mask
+         self._set_bucket(b, slot)
+         hdr[3] = b
+         self._set_slot_hdr(slot, hdr)
+         slot = hdr[2]
+      self._set(self._H_TOMBS, 0)
+
+   def _write(self, slot, h, bucket, key, item):
+      # pickle (key, item) into |slot|, keeping its links
+      #
+      # Raises:
+      #     ValueError: the pickled item doesn't fit in a slot
+      data = pickle.dumps((key, item.dirty, item.val))
+      if len(data) > self._slot_size:
+         raise ValueError(
+            "item for key {!r} needs {} bytes; slot_size is {}".format(
+               key, len(data), self._slot_size))
+      hdr = self._slot_hdr(slot)
+      self._set_slot_hdr(slot, [h, hdr[1], hdr[2], bucket, len(data)])
+      off = self._slot_off(slot) + self._SLOT.size
+      self._buf[off:off + len(data)] = data
+
+   def _unlink(self, slot):
+      # remove |slot| from the LRU list
+      hdr = self._slot_hdr(slot)
+      prev, nxt = hdr[1], hdr[2]
+      if prev == self._NIL:
+         self._set(self._H_HEAD, nxt)
+      else:
+         self._set_link(prev, nxt=nxt)
+      if nxt == self._NIL:
+         self._set(self._H_TAIL, prev)
+      else:
+         self._set_link(nxt, prev=prev)
+
+   def _link_last(self, slot, last=True):
+      # link |slot| in at the MRU end, or the LRU end if |last| is False
+      head = self._get(self._H_HEAD)
+      tail = self._get(self._H_TAIL)
+      if last:
+         self._set_link(slot, prev=tail, nxt=self._NIL)
+         if tail == self._NIL:
+            self._set(self._H_HEAD, slot)
+         else:
+            self._set_link(tail, nxt=slot)
+         self._set(self._H_TAIL, slot)
+      else:
+         self._set_link(slot, prev=self._NIL, nxt=head)
+         if head == self._NIL:
+            self._set(self._H_TAIL, slot)
+         else:
+            self._set_link(head, prev=slot)
+         self._set(self._H_HEAD, slot)
+
+   def _remove(self, bucket, slot):
+      # remove the item in |slot| indexed by |bucket| from the table
+      self._unlink(slot)
+      self._set_bucket(bucket, self._TOMB)
+      self._set_link(slot, prev=self._NIL, nxt=self._get(self._H_FREE))
+      self._set(self._H_FREE, slot)
+      self._set(self._H_COUNT, self._get(self._H_COUNT) - 1)
+      self._set(self._H_TOMBS, self._get(self._H_TOMBS) + 1)
+      if self._get(self._H_TOMBS) > self._nslots:
+         self._rehash()
+
+   @property
+   def slots(self):
+      return self._nslots
+
+   @property
+   def capacity(self):
+      with self._lock:
+         return self._get(self._H_CAPACITY)
+
+   @capacity.setter
+   def capacity(self, new_cap):
+      with self._lock:
+         self._set(self._H_CAPACITY, new_cap)
+
+   def __getitem__(self, key):
+      with self._lock:
+         slot = self._find(key, _stable_hash(key))[1]
+         if slot == -1:
+            raise KeyError(key)
+         k, dirty, val = self._load(slot)
+         return Cache._Val(dirty, val)
+
+   def __setitem__(self, key, item):
+      # an existing key keeps its place in the LRU order, like OrderedDict
+      with self._lock:
+         h = _stable_hash(key)
+         bucket, slot = self._find(key, h)
+         if slot != -1:
+            self._write(slot, h, bucket, key, item)
+            return
+         slot = self._get(self._H_FREE)
+         if slot == self._NIL:
+            raise ValueError("shared cache has no free slot")
+         if bucket is None:
+            self._rehash()
+            bucket = self._find(key, h)[0]
+         self._write(slot, h, bucket, key, item)
+         self._set(self._H_FREE, self._slot_hdr(slot)[2])
+         if self._bucket(bucket) == self._TOMB:
+            self._set(self._H_TOMBS, self._get(self._H_TOMBS) - 1)
+         self._set_bucket(bucket, slot)
+         self._link_last(slot)
+         self._set(self._H_COUNT, self._get(self._H_COUNT) + 1)
+
+   def __delitem__(self, key):
+      with self._lock:
+         bucket, slot = self._find(key, _stable_hash(key))
+         if slot == -1:
+            raise KeyError(key)
+         self._remove(bucket, slot)
+
+   def __contains__(self, key):
+      with self._lock:
+         return self._find(key, _stable_hash(key))[1] != -1
+
+   def __len__(self):
+      with self._lock:
+         return self._get(self._H_COUNT)
+
+   def __iter__(self):
+      return iter(self.keys())
+
+   def _walk(self):
+      # return the (key, dirty, value) triples in LRU order
+      with self._lock:
+         triples = []
+         slot = self._get(self._H_HEAD)
+         while slot != self._NIL:
+            triples.append(self._load(slot))
+            slot = self._slot_hdr(slot)[2]
+         return triples
+
+   def keys(self):
+      return [k for k, dirty, val in self._walk()]
+
+   def values(self):
+      return [Cache._Val(dirty, val) for k, dirty, val in self._walk()]
+
+   def items(self):
+      return [(k, Cache._Val(dirty, val)) for k, dirty, val in self._walk()]
+
+   __marker = object()
+
+   def pop(self, key, default=__marker):
+      with self._lock:
+         bucket, slot = self._find(key, _stable_hash(key))
+         if slot == -1:
+            if default is _SharedTable.__marker:
+               raise KeyError(key)
+            return default
+         k, dirty, val = self._load(slot)
+         self._remove(bucket, slot)
+         return Cache._Val(dirty, val)
+
+   def popitem(self, last=True):
+      with self._lock:
+         slot = self._get(self._H_TAIL if last else self._H_HEAD)
+         if slot == self._NIL:
+            raise KeyError('popitem(): table is empty')
+         k, dirty, val = self._load(slot)
+         self._remove(self._slot_hdr(slot)[3], slot)
+         return k, Cache._Val(dirty, val)
+
+   def move_to_end(self, key, last=True):
+      with self._lock:
+         slot = self._find(key, _stable_hash(key))[1]
+         if slot == -1:
+            raise KeyError(key)
+         self._unlink(slot)
+         self._link_last(slot, last)
+
+   def clear(self):
+      with self._lock:
+         self._reset()
+
+   def __eq__(self, other):
+      if isinstance(other, (OrderedDict, _SharedTable)):
+         return list(self.items()) == list(other.items())
+      return dict(self.items()) == other
+
+
+class SharedMemoryCache(Cache):
+   """Shared memory Cache class. Link this below per-process caches
+
+   A Cache whose items, LRU order and dirty flags live in a
+   multiprocessing.shared_memory block, so every process attached to it
+   sees the same contents. Intended as the L2 shared by the private L1
+   caches of forked worker processes: create it in the parent before
+   forking, then in each worker link a private Cache to it with
+   lower_mem. Processes that are not forked from the creator can join
+   with SharedMemoryCache.attach().
+
+   Every operation holds a lock shared by all attached processes,
+   including demotions into lower memory. Chain-wide passes such as
+   flush(), restore() and the invalidate methods hold it too, whichever
+   level of the chain they are called on. A backing store below a
+   shared level is written by whichever process demotes into it, so it
+   must be safe to open from several processes.
+
+   The number of slots is fixed when the block is created; capacity can
+   be lowered and raised again up to that number. Each item is pickled
+   into a slot of |slot_size| bytes.
+   """
+
+   def __init__(self, capacity=10, lower_mem=None, name=None,
+                slot_size=1024, lock=None, create=True):
+      """Instantiate a SharedMemoryCache object.
+
+      Args:
+         capacity: int specifying the capacity, which is also the
+            number of slots allocated. Ignored if |create| is False.
+         lower_mem: Cache or BackingStore to link to self
+         name: string naming the shared memory block. A unique name is
+            picked if None.
+         slot_size: int bytes available for each pickled
+            (key, dirty, value) item. Ignored if |create| is False.
+         lock: multiprocessing lock shared by all processes using the
+            block. A new multiprocessing.RLock is made if None. Must be
+            reentrant.
+         create: if True, create a new block; otherwise attach to the
+            existing block |name|
+
+      Raises:
+         ImportError: multiprocessing.shared_memory is not available
+         ValueError: capacity or slot_size is less than 1, or |create|
+            is False and |name| or |lock| is None
+         TypeError: lower_mem is not of type Cache or BackingStore
+      """
+      if shared_memory is None:
+         raise ImportError(
+            "SharedMemoryCache needs multiprocessing.shared_memory")
+      if create:
+         if capacity < 1:
+            raise ValueError("capacity must be greater than 0")
+         if slot_size < 1:
+            raise ValueError("slot_size must be greater than 0")
+         size = _SharedTable.size_for(capacity, slot_size)[0]
+         self._shm = shared_memory.SharedMemory(name, True, size)
+         self._lock = lock if lock is not None else multiprocessing.RLock()
+         self._table = _SharedTable(self._shm.buf, self._lock,
+                                    capacity, slot_size)
+      else:
+         if name is None or lock is None:
+            raise ValueError("attaching needs both name and lock")
+         self._shm = shared_memory.SharedMemory(name)
+         self._lock = lock
+         self._table = _SharedTable(self._shm.buf, self._lock)
+         capacity = self._table.capacity
+      Cache.__init__(self, capacity, lower_mem=lower_mem)
+      self._cache = self._table
+
+   @classmethod
+   def attach(cls, name, lock, lower_mem=None):
+      """return a SharedMemoryCache attached to an existing block
+
+      Args:
+         name: string naming the shared memory block
+         lock: the lock the block was created with
+         lower_mem: Cache or BackingStore to link to the returned cache
+
+      Returns:
+         SharedMemoryCache over the block |name|
+      """
+      return cls(lower_mem=lower_mem, name=name, lock=lock, create=False)
+
+   @property
+   def _capacity(self):
+      # capacity is kept in the shared header so all processes agree
+      return self._table.capacity
+
+   @_capacity.setter
+   def _capacity(self, new_cap):
+      if new_cap > self._table.slots:
+         raise ValueError(
+            "capacity can't exceed the {} slots allocated".format(
+               self._table.slots))
+      self._table.capacity = new_cap
+
+   @property
+   def capacity(self):
+      """get/set capacity
+
+      See Cache.capacity. The capacity can't be raised above the number
+      of slots allocated when the block was created.
+
+      Raises:
+         ValueError: new_cap is less than 1 or more than the number of
+            slots
+      """
+      return self._capacity
+
+   @capacity.setter
+   def capacity(self, new_cap):
+      with self._lock:
+         Cache.capacity.fset(self, new_cap)
+
+   @property
+   def name(self):
+      """get the name of the shared memory block"""
+      return self._shm.name
+
+   @property
+   def lock(self):
+      """get the lock shared by the processes using the block"""
+      return self._lock
+
+   def _hold(self):
+      return self._lock
+
+   def _recurs_pop_unless_from_bs(self, key):
+      with self._lock:
+         return Cache._recurs_pop_unless_from_bs(self, key)
+
+   def _recurs_copy_unless_from_bs(self, key):
+      with self._lock:
+         return Cache._recurs_copy_unless_from_bs(self, key)
+
+   def _discard(self, key):
+      with self._lock:
+         return Cache._discard(self, key)
+
+   def _mark_dirty(self, key):
+      with self._lock:
+         Cache._mark_dirty(self, key)
+
+   def _setitem(self, key, val, dirty=True):
+      with self._lock:
+         Cache._setitem(self, key, val, dirty)
+
+   def __getitem__(self, key):
+      with self._lock:
+         return Cache.__getitem__(self, key)
+
+   def __setitem__(self, key, val):
+      with self._lock:
+         Cache.__setitem__(self, key, val)
+
+   def close(self):
+      """detach this process from the shared memory block"""
+      self._cache = OrderedDict()
+      self._table = None
+      self._shm.close()
+
+   def unlink(self):
+      """destroy the shared memory block
+
+      Call once, from one process, after every process is done with it.
+      """
+      self._shm.unlink()
+
+
+class ShardedCache(MutableMapping):
+   """Sharded cache class. Spreads keys over several Cache chains
+
+   Each key is mapped to one of K independent chains (shards) with
+   consistent hashing: every shard owns |vnodes| points on a hash ring
+   and a key belongs to the first point at or after its own hash. A
+   shard is a top Cache that may be linked to lower caches and a
+   backing store of its own. Each shard has its own lock, so threads
+   working on keys of different shards don't wait on each other. For
+   parallelism across processes, give each process the shards it owns.
+
+   Like a Cache, len(), iteration, keys(), items() and values() cover
+   the top level of each chain, here aggregated over all shards.
+   """
+
+   __marker = object()
+
+   def __init__(self, shards, vnodes=64):
+      """Instantiate a ShardedCache object.
+
+      Args:
+         shards: list of top Cache objects, one per shard
+         vnodes: int number of ring points per shard. Defaults to 64.
+
+      Raises:
+         ValueError: shards is empty or vnodes is less than 1
+         TypeError: a shard is not of type Cache
+      """
+      if not shards:
+         raise ValueError("shards must not be empty")
+      if vnodes < 1:
+         raise ValueError("vnodes must be greater than 0")
+      if not all(isinstance(s, Cache) for s in shards):
+         raise TypeError("shards must be of type Cache")
+      self._shards = list(shards)
+      self._locks = [threading.Lock() for s in self._shards]
+      ring = sorted((_stable_hash('{}#{}'.format(i, v)), i)
+                    for i in range(len(self._shards))
+                    for v in range(vnodes))
+      self._ring_hashes = [h for h, i in ring]
+      self._ring_shards = [i for h, i in ring]
+
+   @classmethod
+   def with_bstores(cls, count, capacities=(10,), bstore_capacity=10,
+                    dbname='bstore', vnodes=64, manager=None):
+      """return a ShardedCache of |count| identical chains
+
+      Every chain ends in its own BackingStore, written to a file named
+      "|dbname|-<shard number>".
+
+      Args:
+         count: int number of shards
+         capacities: capacities of the Cache levels of each chain, top
+            level first. Defaults to a single level of 10.
+         bstore_capacity: int capacity of each backing store. Defaults
+            to 10.
+         dbname: string prefix of the backing store names. Defaults to
+            'bstore'.
+         vnodes: int number of ring points per shard. Defaults to 64.
+         manager: StoreManager of the backing stores, so that many
+            shards don't keep as many databases open. Defaults to None.
+
+      Returns:
+         a new ShardedCache
+      """
+      shards = []
+      for i in range(count):
+         mem = BackingStore(bstore_capacity, '{}-{}'.format(dbname, i),
+                            manager=manager)
+         for cap in reversed(capacities):
+            mem = Cache(cap, lower_mem=mem)
+         shards.append(mem)
+      return cls(shards, vnodes)
+
+   @property
+   def shards(self):
+      """return the list of top Cache objects, one per shard"""
+      return list(self._shards)
+
+   def _index_for(self, key):
+      # return the index of the shard owning |key|
+      i = bisect.bisect_left(self._ring_hashes, _stable_hash(key))
+      return self._ring_shards[i % len(self._ring_shards)]
+
+   def shard_for(self, key):
+      """return the top Cache of the shard owning |key|
+
+      Args:
+         key: string representing the key
+      """
+      return self._shards[self._index_for(key)]
+
+   def _call(self, key, name, *args):
+      # call the method |name| of the shard owning |key| holding the
+      # shard's lock
+      #
+      # The method is looked up on the shard, so the overrides of a Cache
+      # subclass are called.
+      i = self._index_for(key)
+      with self._locks[i]:
+         return getattr(self._shards[i], name)(key, *args)
+
+   def _each_shard(self, fn):
+      # return [fn(shard)] for every shard, each under its lock
+      results = []
+      for shard, lock in zip(self._shards, self._locks):
+         with lock:
+            results.append(fn(shard))
+      return results
+
+   def __getitem__(self, key):
+      """cache[key]
+
+      Get the item associated to key |key| from the shard owning it.
+      See Cache.__getitem__().
+
+      Raises:
+         CacheMiss: |key| doesn't match anything in the shard's chain
+      """
+      return self._call(key, '__getitem__')
+
+   def __setitem__(self, key, val):
+      """cache[key] = val
+
+      set (key, val) in the shard owning |key|. See Cache.__setitem__().
+      """
+      self._call(key, '__setitem__', val)
+
+   def __delitem__(self, key):
+      """del cache[key]
+
+      Removes item with key |key| from the top cache of its shard
+      """
+      self._call(key, '__delitem__')
+
+   def __contains__(self, key):
+      """return True if key is in the top cache of its shard"""
+      return self._call(key, '__contains__')
+
+   def __len__(self):
+      """return the number of items in the top caches of all shards"""
+      return sum(self._each_shard(len))
+
+   def __iter__(self):
+      """return iterator over the keys in the top caches of all shards"""
+      return iter(self.keys())
+
+   def keys(self):
+      """return list of keys in the top caches of all shards"""
+      return list(itertools.chain(
+         *self._each_shard(lambda c: list(c.keys()))))
+
+   def items(self):
+      """return list of (key, value) pairs in the top caches of all shards"""
+      return list(itertools.chain(
+         *self._each_shard(lambda c: list(c.items()))))
+
+   def values(self):
+      """return list of values in the top caches of all shards"""
+      return list(itertools.chain(
+         *self._each_shard(lambda c: list(c.values()))))
+
+   def get(self, key, default=None, promote=False):
+      """return the value of |key| if exists in its shard
+
+      Default otherwise. See Cache.get().
+      """
+      return self._call(key, 'get', default, promote)
+
+   def peek(self, key):
+      """return the value of |key| in its shard without changing anything
+
+      See Cache.peek().
+      """
+      return self._call(key, 'peek')
+
+   def pop(self, key, default=__marker):
+      """remove |key| from the top cache of its shard and return its value
+
+      See Cache.pop().
+
+      Raises:
+         KeyError: key doesn't exist and |default| isn't given
+      """
+      if default is ShardedCache.__marker:
+         return self._call(key, 'pop')
+      return self._call(key, 'pop', default)
+
+   def setdefault(self, key, default=None):
+      """return key's value, inserting |default| first if it is missing
+
+      See Cache.setdefault().
+      """
+      return self._call(key, 'setdefault', default)
+
+   def clear(self):
+      """Remove all items in the top caches of all shards"""
+      self._each_shard(lambda c: c.clear())
+
+   def __str__(self):
+      """return string representation of the shards
+
+      Each shard's top cache is listed on its own line.
+      """
+      return "ShardedCache:\n" + "\n".join(
+         "   {}".format(s) for s in self._each_shard(str))
+
+   def flush(self, executor=None):
+      """write back the dirty items of every shard
+
+      Each shard's chain is flushed as one batch to its own backing
+      store (see Cache.flush()). With an executor such as a
+      ThreadPoolExecutor, the batches of different shards are pickled
+      and written in parallel.
+
+      Args:
+         executor: concurrent.futures.Executor used to write the
+            batches. If None, each batch is written before moving on.
+
+      Returns:
+         WriteBackHandle covering the batches of all shards
+
+      Raises:
+         NoBStoreError: a shard's chain doesn't end in a BackingStore
+      """
+      handles = self._each_shard(lambda c: c.flush(executor))
+      return WriteBackHandle(
+         itertools.chain(*(h._futures for h in handles)))
+
+   def open_bstore(self):
+      """open the backing store of every shard
+
+      Raises:
+         NoBStoreError: a shard's chain doesn't end in a BackingStore
+      """
+      self._each_shard(lambda c: c.open_bstore())
+
+   def close_bstore(self):
+      """close the backing store of every shard that has one"""
+      self._each_shard(lambda c: c.close_bstore())
+
+   def bstore_closed(self):
+      """return True if any shard's backing store is closed or missing"""
+      return any(self._each_shard(lambda c: c.bstore_closed()))
+
+   def invalidate_pattern(self, pattern):
+      """remove every key matching |pattern| from every shard's chain
+
+      See Cache.invalidate_pattern().
+
+      Returns:
+         number of keys removed
+      """
+      return sum(self._each_shard(lambda c: c.invalidate_pattern(pattern)))
+
+   def __enter__(self):
+      """opens the backing stores using the "with" context manager
+
+      Returns:
+         self
+      """
+      self.open_bstore()
+      return self
+
+   def __exit__(self, exc_type, exc_val, exc_tb):
+      """closes the backing stores at the end of the "with" context"""
+      self.close_bstore()
+      return False
+
+
+def _canonical(obj):
+   # return bytes identifying |obj| by value, the same in every process
+   #
+   # Tuples, lists, dicts, sets and frozensets are encoded element by
+   # element, dicts and sets in sorted order so that equal ones encode
+   # the same whatever their iteration order. Anything else is pickled.
+   if isinstance(obj, (tuple, list)):
+      parts = [_canonical(o) for o in obj]
+   elif isinstance(obj, dict):
+      parts = sorted(_canonical(k) + _canonical(v) for k, v in obj.items())
+   elif isinstance(obj, (set, frozenset)):
+      parts = sorted(_canonical(o) for o in obj)
+   else:
+      return pickle.dumps(obj, 4)
+   return type(obj).__name__.encode('utf-8') + b''.join(
+      struct.pack('<I', len(p)) + p for p in parts)
+
+
+def _memo_key(namespace, args, kwargs):
+   # return the key of a call with |args| and |kwargs| in |namespace|
+   digest = hashlib.blake2b(_canonical((args, kwargs)), digest_size=16)
+   return '{}:{}'.format(namespace, digest.hexdigest())
+
+
+_chain_locks = {}
+_chain_locks_lock = threading.Lock()
+
+
+def _chain_lock(chain):
+   # return the lock serializing memoized calls' use of |chain|
+   #
+   # Caches are unhashable and get deep-copied, so the locks are kept
+   # here by id() rather than on the caches, and dropped when the chain
+   # is garbage collected.
+   with _chain_locks_lock:
+      lock = _chain_locks.get(id(chain))
+      if lock is None:
+         lock = _chain_locks[id(chain)] = threading.RLock()
+         weakref.finalize(chain, _chain_locks.pop, id(chain), None)
+      return lock
+
+
+def _memo_namespace(func, namespace):
+   # return |namespace|, or the default namespace of |func|
+   if namespace is None:
+      return '{}.{}'.format(func.__module__, func.__qualname__)
+   return namespace
+
+
+def _memo_get(chain, key, counts):
+   # look |key| up in |chain| for a memoized function
+   #
+   # Counts a hit or an expired result in |counts|.
+   #
+   # Returns:
+   #     (True, result) if a valid result was found; (False, None)
+   #     otherwise
+   try:
+      expires, result = chain[key]
+   except (CacheMiss, KeyError):
+      return False, None
+   if expires is None or expires > time.time():
+      counts['hits'] += 1
+      return True, result
+   counts['expired'] += 1
+   return False, None
+
+
+def _memo_set(chain, key, result, ttl):
+   # set |result| of a memoized function in |chain|
+   chain[key] = (None if ttl is None else time.time() + ttl, result)
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'shared', 'expired'])
+CacheInfo.__doc__ = """Report returned by cache_info() of a memoized function
+
+   hits: calls answered from the chain
+   misses: calls that ran the function
+   shared: calls that waited for the same call running in another thread
+   expired: misses due to a result older than the ttl
+"""
+
+
+def cached(chain, namespace=None, ttl=None):
+   """memoize a function in a Cache chain
+
+   Each call's arguments are hashed into a key that is the same in
+   every process, prefixed with the function's namespace. The result is
+   set in |chain| under that key, so it moves down the chain like any
+   other item and, if the chain ends in a BackingStore, is written back
+   to it and found there after a restart. Concurrent calls with the same
+   arguments run the function once; the others wait for its result.
+   Exceptions aren't memoized.
+
+   The decorated function gets a cache_info() method returning a
+   CacheInfo of its counters, and a cache_clear() method removing its
+   results from the chain and resetting the counters.
+
+   Args:
+      chain: top Cache of the chain, or any object with the same
+         __getitem__ and __setitem__, such as a ShardedCache
+      namespace: string prefixed to the keys of the function. Defaults
+         to the function's module and qualified name
+      ttl: seconds a result stays valid. Defaults to None, forever.
+         Results carry their wall clock expiry time, so it holds across
+         restarts.
+
+   Returns:
+      decorator to apply to the function
+   """
+   def decorate(func):
+      ns = _memo_namespace(func, namespace)
+      lock = _chain_lock(chain)
+      inflight = {}
+      counts = dict.fromkeys(CacheInfo._fields, 0)
+
+      @functools.wraps(func)
+      def wrapper(*args, **kwargs):
+         key = _memo_key(ns, args, kwargs)
+         with lock:
+            found, result = _memo_get(chain, key, counts)
+            if found:
+               return result
+            future = inflight.get(key)
+            owner = future is None
+            if owner:
+               future = inflight[key] = concurrent.futures.Future()
+               counts['misses'] += 1
+            else:
+               counts['shared'] += 1
+         if not owner:
+            return future.result()
+         try:
+            try:
+               result = func(*args, **kwargs)
+               with lock:
+                  _memo_set(chain, key, result, ttl)
+            finally:
+               with lock:
+                  del inflight[key]
+         except BaseException as e:
+            future.set_exception(e)
+            raise
+         future.set_result(result)
+         return result
+
+      _add_memo_reports(wrapper, chain, ns, lock, counts)
+      return wrapper
+   return decorate
+
+
+def _add_memo_reports(wrapper, chain, ns, lock, counts):
+   # give |wrapper| its cache_info() and cache_clear() methods
+   def cache_info():
+      with lock:
+         return CacheInfo(**counts)
+
+   def cache_clear():
+      with lock:
+         chain.invalidate_pattern(glob.escape(ns) + ':*')
+         for k in counts:
+            counts[k] = 0
+
+   wrapper.cache_info = cache_info
+   wrapper.cache_clear = cache_clear
+
+
+def async_cached(chain, namespace=None, ttl=None, executor=None):
+   """memoize a coroutine function in a Cache chain
+
+   The asyncio counterpart of cached(), with the same keys, namespaces,
+   ttl and reports. Looking a result up in |chain| and setting it there
+   may read or write the backing store, so both run in |executor|
+   rather than on the event loop. Concurrent awaits of a call with the
+   same arguments share one task running the coroutine; cancelling one
+   of them doesn't cancel the task for the others.
+
+   Args:
+      chain: top Cache of the chain, or any object with the same
+         __getitem__ and __setitem__, such as a ShardedCache
+      namespace: string prefixed to the keys of the function. Defaults
+         to the function's module and qualified name
+      ttl: seconds a result stays valid. Defaults to None, forever
+      executor: concurrent.futures.Executor running the chain accesses.
+         Defaults to the event loop's default executor
+
+   Returns:
+      decorator to apply to the coroutine function
+   """
+   def decorate(func):
+      ns = _memo_namespace(func, namespace)
+      lock = _chain_lock(chain)
+      inflight = {}
+      counts = dict.fromkeys(CacheInfo._fields, 0)
+
+      def lookup(key):
+         with lock:
+            return _memo_get(chain, key, counts)
+
+      def store(key, result):
+         with lock:
+            _memo_set(chain, key, result, ttl)
+
+      def count(name):
+         with lock:
+            counts[name] += 1
+
+      async def run(key, args, kwargs):
+         try:
+            result = await func(*args, **kwargs)
+            await asyncio.get_running_loop().run_in_executor(
+               executor, store, key, result)
+            return result
+         finally:
+            del inflight[key]
+
+      @functools.wraps(func)
+      async def wrapper(*args, **kwargs):
+         key = _memo_key(ns, args, kwargs)
+         if key not in inflight:
+            loop = asyncio.get_running_loop()
+            found, result = await loop.run_in_executor(executor, lookup, key)
+            if found:
+               return result
+         task = inflight.get(key)
+         if task is None:
+            count('misses')
+            task = inflight[key] = asyncio.ensure_future(
+               run(key, args, kwargs))
+         else:
+            count('shared')
+         return await asyncio.shield(task)
+
+      _add_memo_reports(wrapper, chain, ns, lock, counts)
+      return wrapper
+   return decorate
@@ -5,6 +5,13 @@ from copy import deepcopy
 import os.path
 import os
 import string
+import multiprocessing
+import threading
+import concurrent.futures
+import random
+import time
+import pickle
+import asyncio
 
 
 class CacheTest(unittest.TestCase):
@@ -26,6 +33,11 @@ class CacheTest(unittest.TestCase):
       if os.path.isfile(file):
          os.remove(file)
 
+   @staticmethod
+   def rm_bstore_files(dbname):
+      for ext in ('', '.db', '.dat', '.dir', '.bak', '.recency', '.meta'):
+         CacheTest.rm_or_noop(dbname + ext)
+
    def setUp(self):
       d = {'cherry':3, 'blueberry':1, 'strawberry':2}
       self.c1 = Cache()
@@ -727,5 +739,1694 @@ class CacheTest(unittest.TestCase):
 
       CacheTest.rm_or_noop('bstore.db')
 
+   def test_cap_change_demotes(self):
+      c2 = Cache(4)
+      c1 = Cache(3, [('a', 1), ('b', 2), ('c', 3)], lower_mem=c2)
+      c1.capacity = 1
+      self.assertEqual(c1, Cache(1, [('c', 3)]))
+      self.assertEqual(c2, Cache(4, [('a', 1), ('b', 2)]))
+      with self.assertRaises(ValueError):
+         c1.capacity = 0
+
+      CacheTest.rm_bstore_files('foo')
+      bs = BackingStore(5, 'foo')
+      c1 = Cache(3, lower_mem=bs)
+      with c1:
+         c1['a'] = 1
+         c1['b'] = 2
+         c1['c'] = 3
+         c1['b']
+         c1.capacity = 1
+         self.assertEqual(c1.items(), [('b', 2)])
+         self.assertEqual(sorted(bs.items()), [('a', 1), ('c', 3)])
+      CacheTest.rm_bstore_files('foo')
+
+   def test_stats(self):
+      c2 = Cache(2, [('b', 2)])
+      c1 = Cache(2, [('a', 1)], lower_mem=c2)
+      c1['a']
+      c1['b']
+      with self.assertRaises(CacheMiss):
+         c1['z']
+      self.assertEqual(c1.stats(), {'hits': 1, 'misses': 2})
+      self.assertEqual(c2.stats(), {'hits': 1, 'misses': 1})
+      c1.reset_stats()
+      self.assertEqual(c1.stats(), {'hits': 0, 'misses': 0})
+
+   def test_capacity_controller(self):
+      c3 = Cache(1)
+      c2 = Cache(1, lower_mem=c3)
+      c1 = Cache(1, lower_mem=c2)
+      with self.assertRaises(ValueError):
+         CapacityController(c1, 2)
+      with self.assertRaises(TypeError):
+         CapacityController(c3.lower_mem, 6)
+
+      ctl = CapacityController(c1, 9)
+      self.assertEqual([c1.capacity, c2.capacity, c3.capacity], [3, 3, 3])
+      for k, v in zip(string.ascii_lowercase[:9], range(9)):
+         c1[k] = v
+      self.assertEqual(len(c1) + len(c2) + len(c3), 9)
+      self.assertEqual(ctl.rebalance(), [3, 3, 3])
+
+      # hits only at lv3, so it grows while lv1 and lv2 shrink
+      for k in ('a', 'b', 'c'):
+         c1[k]
+      caps = ctl.rebalance()
+      self.assertEqual(sum(caps), 9)
+      self.assertTrue(caps[2] > caps[0] and caps[2] > caps[1])
+      kept = sorted(list(c1.keys()) + list(c2.keys()) + list(c3.keys()))
+      self.assertEqual(kept, list(string.ascii_lowercase[:9]))
+      self.assertNotIn('False', CacheTest.cascade_dump(c1))
+
+   def test_capacity_controller_with_bstore(self):
+      CacheTest.rm_bstore_files('foo')
+      bs = BackingStore(20, 'foo')
+      c2 = Cache(4, lower_mem=bs)
+      c1 = Cache(4, lower_mem=c2)
+      ctl = CapacityController(c1, 8)
+      with c1:
+         for k, v in zip(string.ascii_lowercase[:8], range(8)):
+            c1[k] = v
+         for i in range(5):
+            c1['h']
+         ctl.rebalance()
+         self.assertTrue(c1.capacity > c2.capacity)
+         for k, v in zip(string.ascii_lowercase[:8], range(8)):
+            self.assertEqual(c1[k], v)
+      CacheTest.rm_bstore_files('foo')
+
+      # shrinking a lower level keeps the clean copies of the levels
+      # above it backed by the store
+      bs = BackingStore(2, 'foo')
+      c2 = Cache(2, lower_mem=bs)
+      c1 = Cache(2, lower_mem=c2)
+      with c1:
+         bs['a'] = 1
+         bs['b'] = 2
+         c1['x'] = 3
+         c1['y'] = 4
+         c1['a']
+         c1['b']
+         c2.capacity = 1
+         self.assertEqual(CacheTest.cascade_dump(c1),
+                          "cascade dump:\n"
+                          "   Cache: [(a, (True, 1)), (b, (False, 2))]\n"
+                          "   Cache: [(y, (True, 4))]\n"
+                          "   BackingStore: [('b', 2), ('x', 3)]\n")
+      CacheTest.rm_bstore_files('foo')
+
+   def test_capacity_controller_bytes(self):
+      c2 = Cache(1)
+      c1 = Cache(1, lower_mem=c2)
+      ctl = CapacityController(c1, 1000, sizeof=len)
+      c1['a'] = 'x' * 100
+      c1['b'] = 'x' * 100
+      c1['a']
+      c1['a']
+      caps = ctl.rebalance()
+      self.assertEqual(caps, [c1.capacity, c2.capacity])
+      self.assertTrue(caps[0] >= 1 and caps[1] >= 1)
+      self.assertTrue(caps[0] * 100 <= 1000)
+
+   def test_shared_memory_cache(self):
+      c2 = SharedMemoryCache(4, slot_size=128)
+      try:
+         c1 = Cache(2, lower_mem=c2)
+         for k, v in zip(string.ascii_lowercase[:5], range(1, 6)):
+            c1[k] = v
+         self.assertEqual(c1, Cache(2, [('d', 4), ('e', 5)]))
+         self.assertEqual(c2.items(), [('a', 1), ('b', 2), ('c', 3)])
+
+         c1['b']
+         self.assertEqual(c2.items(), [('a', 1), ('c', 3), ('d', 4)])
+         self.assertEqual(str(c2),
+                          'Cache: [(a, (True, 1)), (c, (True, 3)), '
+                          '(d, (True, 4))]')
+         c1['f'] = 6
+         c1['g'] = 7
+         self.assertEqual(c2.items(), [('c', 3), ('d', 4), ('e', 5), ('b', 2)])
+         self.assertEqual(c2, Cache(4, [('c', 3), ('d', 4), ('e', 5),
+                                        ('b', 2)]))
+         self.assertEqual(c2.pop('d'), 4)
+         self.assertFalse('d' in c2)
+         self.assertEqual(c2.popitem(False), ('c', 3))
+
+         with self.assertRaises(ValueError):
+            c2.capacity = 5
+         c2.capacity = 1
+         self.assertEqual(c2.items(), [('b', 2)])
+         c2.capacity = 4
+
+         with self.assertRaises(ValueError):
+            c2['big'] = 'x' * 200
+
+         for i in range(50):
+            c2['k{}'.format(i)] = i
+            del c2['k{}'.format(i)]
+         self.assertEqual(c2.keys(), ['b'])
+
+         attached = SharedMemoryCache.attach(c2.name, c2.lock)
+         attached['z'] = 26
+         self.assertEqual(c2.keys(), ['b', 'z'])
+         self.assertEqual(attached.capacity, 4)
+         attached.close()
+      finally:
+         c2.close()
+         c2.unlink()
+
+   @staticmethod
+   def _shared_worker(l2, start):
+      l1 = Cache(1, lower_mem=l2)
+      for i in range(start, start + 3):
+         l1['k{}'.format(i)] = i
+      l1['flush'] = None
+
+   @staticmethod
+   def _shared_writer(l2, paused, written):
+      paused.wait(5)
+      l2['a'] = 2
+      written.set()
+
+   def test_shared_memory_cache_across_processes(self):
+      ctx = multiprocessing.get_context('fork')
+      c2 = SharedMemoryCache(10, slot_size=128, lock=ctx.RLock())
+      try:
+         procs = [ctx.Process(target=CacheTest._shared_worker,
+                              args=(c2, start)) for start in (0, 10)]
+         for p in procs:
+            p.start()
+         for p in procs:
+            p.join()
+            self.assertEqual(p.exitcode, 0)
+         self.assertEqual(
+            sorted(c2.keys()),
+            ['k0', 'k1', 'k10', 'k11', 'k12', 'k2'])
+         c1 = Cache(1, lower_mem=c2)
+         self.assertEqual(c1['k11'], 11)
+         self.assertFalse('k11' in c2)
+      finally:
+         c2.close()
+         c2.unlink()
+
+      # a write from another process waits for a flush to finish, rather
+      # than landing between its read and its rewrite of the table
+      class PausingCache(SharedMemoryCache):
+         pause = None
+
+         def _items(self):
+            items = SharedMemoryCache._items(self)
+            if self.pause is not None:
+               paused, written = self.pause
+               self.pause = None
+               paused.set()
+               written.wait(0.2)
+            return items
+
+      CacheTest.rm_bstore_files('foo')
+      bs = BackingStore(5, 'foo')
+      c2 = PausingCache(4, lower_mem=bs, slot_size=128, lock=ctx.RLock())
+      try:
+         with c2:
+            c2['a'] = 1
+            paused, written = ctx.Event(), ctx.Event()
+            p = ctx.Process(target=CacheTest._shared_writer,
+                            args=(c2, paused, written))
+            p.start()
+            c2.pause = (paused, written)
+            c2.flush()
+            p.join()
+            self.assertEqual(p.exitcode, 0)
+            self.assertEqual(str(c2), 'Cache: [(a, (True, 2))]')
+            c2.flush()
+            self.assertEqual(bs['a'], 2)
+      finally:
+         c2.close()
+         c2.unlink()
+      CacheTest.rm_bstore_files('foo')
+
+   def test_sharded_cache(self):
+      with self.assertRaises(ValueError):
+         ShardedCache([])
+      with self.assertRaises(TypeError):
+         ShardedCache([Cache(), BackingStore()])
+
+      sc = ShardedCache([Cache(100) for i in range(4)])
+      keys = ['key{}'.format(i) for i in range(200)]
+      for i, k in enumerate(keys):
+         sc[k] = i
+      self.assertEqual(len(sc), sum(len(s) for s in sc.shards))
+      self.assertEqual(sorted(sc.keys()), sorted(
+         k for s in sc.shards for k in s.keys()))
+      for k in keys:
+         self.assertTrue(k in sc.shard_for(k))
+      self.assertTrue(all(len(s) > 0 for s in sc.shards))
+      self.assertEqual(sc['key7'], 7)
+      self.assertEqual(sc.get('key8'), 8)
+      self.assertEqual(sc.get('nope', 0), 0)
+      with self.assertRaises(CacheMiss):
+         sc['nope']
+      self.assertEqual(sc.pop('key9'), 9)
+      self.assertEqual(sc.pop('key9', None), None)
+      self.assertEqual(sc.setdefault('key9', 90), 90)
+      del sc['key9']
+      self.assertFalse('key9' in sc)
+
+      # the same keys land on the same shards in another instance, and
+      # adding a shard only moves keys onto the new shard
+      owners = [ShardedCache([Cache() for i in range(4)])._index_for(k)
+                for k in keys]
+      self.assertEqual(owners, [sc._index_for(k) for k in keys])
+      sc5 = ShardedCache([Cache() for i in range(5)])
+      moved = [k for k, o in zip(keys, owners) if sc5._index_for(k) != o]
+      self.assertTrue(all(sc5._index_for(k) == 4 for k in moved))
+
+      sc.clear()
+      self.assertEqual(len(sc), 0)
+
+      # the shards' own methods are called
+      class RecordingCache(Cache):
+         def __init__(self, capacity):
+            super().__init__(capacity)
+            self.read = []
+         def __getitem__(self, key):
+            self.read.append(key)
+            return super().__getitem__(key)
+      sc = ShardedCache([RecordingCache(10) for i in range(2)])
+      sc['a'] = 1
+      self.assertEqual(sc['a'], 1)
+      self.assertEqual(sc.shard_for('a').read, ['a'])
+      shards = [SharedMemoryCache(20, slot_size=128) for i in range(2)]
+      try:
+         sc = ShardedCache(shards)
+         for i, k in enumerate(keys[:20]):
+            sc[k] = i
+         self.assertEqual(len(sc), 20)
+         self.assertEqual(sorted(sc.keys()), sorted(keys[:20]))
+         self.assertEqual(sc['key3'], 3)
+         self.assertEqual(sc.get('key4'), 4)
+         self.assertEqual(sc.pop('key5'), 5)
+         self.assertFalse('key5' in sc)
+         sc.clear()
+         self.assertEqual(len(sc), 0)
+      finally:
+         for c in shards:
+            c.close()
+            c.unlink()
+
+   def test_sharded_cache_with_bstores(self):
+      for i in range(3):
+         CacheTest.rm_bstore_files('foo-{}'.format(i))
+      sc = ShardedCache.with_bstores(3, (2, 4), 100, 'foo')
+      self.assertTrue(sc.bstore_closed())
+
+      def work(start):
+         for i in range(start, start + 50):
+            sc['k{}'.format(i)] = i
+
+      with sc:
+         threads = [threading.Thread(target=work, args=(i * 50,))
+                    for i in range(4)]
+         for t in threads:
+            t.start()
+         for t in threads:
+            t.join()
+         for i in range(200):
+            self.assertEqual(sc['k{}'.format(i)], i)
+         self.assertEqual(
+            sorted(s.lower_mem.lower_mem.dbname for s in sc.shards),
+            ['foo-0', 'foo-1', 'foo-2'])
+      self.assertTrue(sc.bstore_closed())
+      for i in range(3):
+         CacheTest.rm_bstore_files('foo-{}'.format(i))
+
+   def test_bstore_set_many(self):
+      CacheTest.rm_bstore_files('foo')
+      with BackingStore(4, 'foo') as bs:
+         bs['a'] = 1
+         bs['b'] = 2
+         h = bs.set_many([('b', 20), ('c', 3)])
+         self.assertTrue(h.done())
+         self.assertEqual(h.wait(), 2)
+         self.assertEqual(sorted(bs.items()), [('a', 1), ('b', 20), ('c', 3)])
+
+         # room is made once for the batch, and only the last keys that
+         # fit are kept
+         h = bs.set_many([('d', 4), ('e', 5), ('f', 6), ('g', 7), ('h', 8)])
+         self.assertEqual(h.wait(), 4)
+         self.assertEqual(sorted(bs.keys()), ['e', 'f', 'g', 'h'])
+
+         with concurrent.futures.ThreadPoolExecutor(1) as ex:
+            gate = threading.Event()
+            ex.submit(gate.wait)
+            h = bs.set_many({'x': 10, 'y': 11, 'z': 12}, ex)
+            self.assertFalse(h.done())
+            self.assertEqual(bs['x'], 10)
+            self.assertTrue('y' in bs)
+            self.assertEqual(len(bs), 4)
+            bs['y'] = 111
+            del bs['z']
+            gate.set()
+            self.assertEqual(h.wait(5), 1)
+         self.assertEqual(bs['x'], 10)
+         self.assertEqual(bs['y'], 111)
+         self.assertFalse('z' in bs)
+         self.assertEqual(len(bs), 3)
+      CacheTest.rm_bstore_files('foo')
+
+   def test_flush(self):
+      CacheTest.rm_bstore_files('foo')
+      bs = BackingStore(10, 'foo')
+      c2 = Cache(2, lower_mem=bs)
+      c1 = Cache(2, lower_mem=c2)
+      self.assertRaises(NoBStoreError, Cache(2).flush)
+      with c1:
+         for k, v in zip(string.ascii_lowercase[:4], range(1, 5)):
+            c1[k] = v
+         self.assertEqual(len(bs), 0)
+         with concurrent.futures.ThreadPoolExecutor(2) as ex:
+            self.assertEqual(c1.flush(ex).wait(), 4)
+         self.assertEqual(sorted(bs.items()),
+                          [('a', 1), ('b', 2), ('c', 3), ('d', 4)])
+         self.assertEqual(CacheTest.cascade_dump(c1),
+                          "cascade dump:\n"
+                          "   Cache: [(c, (False, 3)), (d, (False, 4))]\n"
+                          "   Cache: [(a, (False, 1)), (b, (False, 2))]\n"
+                          "   BackingStore: [('a', 1), ('b', 2), ('c', 3), "
+                          "('d', 4)]\n")
+         self.assertEqual(c1.flush().wait(), 0)
+      CacheTest.rm_bstore_files('foo')
+
+      for i in range(3):
+         CacheTest.rm_bstore_files('foo-{}'.format(i))
+      sc = ShardedCache.with_bstores(3, (50,), 50, 'foo')
+      with sc:
+         for i in range(60):
+            sc['k{}'.format(i)] = i
+         with concurrent.futures.ThreadPoolExecutor(3) as ex:
+            self.assertEqual(sc.flush(ex).wait(), 60)
+         stores = [s.lower_mem for s in sc.shards]
+         self.assertEqual(sum(len(bs) for bs in stores), 60)
+      for i in range(3):
+         CacheTest.rm_bstore_files('foo-{}'.format(i))
+
+   def test_snapshot_restore(self):
+      CacheTest.rm_or_noop('snap')
+      CacheTest.rm_bstore_files('bar')
+      c2 = Cache(3, lower_mem=BackingStore(10, 'bar'))
+      c1 = Cache(2, lower_mem=c2)
+      with c1:
+         c1.lower_mem.lower_mem['d'] = 4
+         c1['c'] = 3
+         c1['d']
+         c1['a'] = 1
+         c1['b'] = 2
+      self.assertEqual((str(c1), str(c2)),
+                       ('Cache: [(a, (True, 1)), (b, (True, 2))]',
+                        'Cache: [(c, (True, 3)), (d, (False, 4))]'))
+      CacheTest.rm_bstore_files('bar')
+      self.assertEqual(c1.snapshot('snap'), 4)
+
+      # dirty items are written back before being replaced
+      r1 = Cache(2, [('x', 0)], lower_mem=Cache(3))
+      with self.assertRaises(ValueError):
+         r1.restore('snap')
+      self.assertEqual(r1.items(), [('x', 0)])
+      CacheTest.rm_bstore_files('foo')
+      bs = BackingStore(10, 'foo')
+      r2 = Cache(3, lower_mem=bs)
+      r1 = Cache(2, lower_mem=r2)
+      with r1:
+         r1['x'] = 0
+         self.assertEqual(r1.restore('snap'), 4)
+         self.assertEqual((str(r1), str(r2)), (str(c1), str(c2)))
+         self.assertEqual(str(bs), "BackingStore: [('x', 0)]")
+
+         r1.capacity = 1
+         self.assertEqual(r1.restore('snap'), 4)
+         self.assertEqual(r1.items(), [('b', 2)])
+         self.assertEqual(r2.items(), [('c', 3), ('d', 4), ('a', 1)])
+
+         # a bad file leaves the chain as it was
+         dump = CacheTest.cascade_dump(r1)
+         with self.assertRaises(ValueError):
+            Cache(2).restore('snap')
+         with open('snap', 'rb') as f:
+            data = f.read()
+         with open('snap', 'wb') as f:
+            f.write(data[:-3])
+         with self.assertRaises(ValueError):
+            r1.restore('snap')
+         with open('snap', 'wb') as f:
+            f.write(b'not a snapshot')
+         with self.assertRaises(ValueError):
+            r1.restore('snap')
+         self.assertEqual(CacheTest.cascade_dump(r1), dump)
+      CacheTest.rm_bstore_files('foo')
+      CacheTest.rm_or_noop('snap')
+
+   def test_warm_up(self):
+      CacheTest.rm_bstore_files('foo')
+      CacheTest.rm_or_noop('foo.recency')
+      with self.assertRaises(ValueError):
+         with BackingStore(5, 'foo') as bs:
+            bs.recent_keys()
+
+      with BackingStore(10, 'foo', track_recency=True) as bs:
+         for k, v in zip(string.ascii_lowercase[:6], range(1, 7)):
+            bs[k] = v
+         bs['b']
+         bs['a']
+         self.assertEqual(bs.recent_keys(3), ['a', 'b', 'f'])
+      self.assertTrue(os.path.isfile('foo.recency'))
+
+      bs = BackingStore(10, 'foo', track_recency=True)
+      c2 = Cache(2, lower_mem=bs)
+      c1 = Cache(1, lower_mem=c2)
+      self.assertRaises(NoBStoreError, Cache(1).warm_up)
+      with c1:
+         self.assertEqual(bs.recent_keys(), ['a', 'b', 'f', 'e', 'd', 'c'])
+         c1['f']
+         self.assertEqual(c1.warm_up(), 2)
+         self.assertEqual(c1.items(), [('a', 1)])
+         self.assertEqual(c2.items(), [('f', 6), ('b', 2)])
+         self.assertFalse(any(v.dirty for v in c1._values() + c2._values()))
+      CacheTest.rm_bstore_files('foo')
+      CacheTest.rm_or_noop('foo.recency')
+
+   def test_dirty_notifications(self):
+      CacheTest.rm_bstore_files('foo')
+      bs = BackingStore(2, 'foo')
+      c2 = Cache(3, lower_mem=bs)
+      c1 = Cache(1, lower_mem=c2)
+      with c1:
+         bs['a'] = 1
+         bs['b'] = 2
+         c1['a']
+         c1['b']
+         self.assertEqual(CacheTest.cascade_dump(c1),
+                          "cascade dump:\n"
+                          "   Cache: [(b, (False, 2))]\n"
+                          "   Cache: [(a, (False, 1))]\n"
+                          "   BackingStore: [('a', 1), ('b', 2)]\n")
+
+         # both keys are dropped by the store in one batch; both cached
+         # copies must become dirty
+         bs.set_many([('x', 10), ('y', 11)]).wait()
+         self.assertEqual(CacheTest.cascade_dump(c1),
+                          "cascade dump:\n"
+                          "   Cache: [(b, (True, 2))]\n"
+                          "   Cache: [(a, (True, 1))]\n"
+                          "   BackingStore: [('x', 10), ('y', 11)]\n")
+
+      CacheTest.rm_bstore_files('foo')
+
+      # a key dropped by the store while it is on its way down between
+      # two caches becomes dirty where it lands
+      bs = BackingStore(2, 'foo')
+      c2 = Cache(2, lower_mem=bs)
+      c1 = Cache(1, lower_mem=c2)
+      with c1:
+         bs['k'] = 1
+         bs['m'] = 2
+         c1['j'] = 3
+         c1['m']
+         c1['k']
+         self.assertEqual(CacheTest.cascade_dump(c1),
+                          "cascade dump:\n"
+                          "   Cache: [(k, (False, 1))]\n"
+                          "   Cache: [(j, (True, 3)), (m, (False, 2))]\n"
+                          "   BackingStore: [('k', 1), ('m', 2)]\n")
+         c1['n'] = 5
+         self.assertEqual(CacheTest.cascade_dump(c1),
+                          "cascade dump:\n"
+                          "   Cache: [(n, (True, 5))]\n"
+                          "   Cache: [(m, (False, 2)), (k, (True, 1))]\n"
+                          "   BackingStore: [('j', 3), ('m', 2)]\n")
+      CacheTest.rm_bstore_files('foo')
+
+   def test_directory(self):
+      def create_caches():
+         c3 = Cache(3)
+         c2 = Cache(2, lower_mem=c3)
+         return Cache(1, [('a', 1)], lower_mem=c2)
+
+      plain = create_caches()
+      c1 = create_caches()
+      c1.enable_directory()
+      levels = list(c1._levels())
+
+      rnd = random.Random(5)
+      for i in range(300):
+         k = rnd.choice('abcdefgh')
+         op = rnd.random()
+         if op < 0.45:
+            plain[k] = i
+            c1[k] = i
+         elif op < 0.9:
+            try:
+               expected = plain[k]
+            except CacheMiss:
+               self.assertRaises(CacheMiss, c1.__getitem__, k)
+            else:
+               self.assertEqual(c1[k], expected)
+         elif op < 0.95:
+            plain.lower_mem.pop(k, None)
+            c1.lower_mem.pop(k, None)
+         else:
+            plain.capacity = c1.capacity = rnd.choice((1, 2))
+         self.assertEqual(CacheTest.cascade_dump(c1),
+                          CacheTest.cascade_dump(plain))
+         self.assertEqual(c1._directory,
+                          {k: m for m in levels for k in m})
+      self.assertEqual([m.stats() for m in c1._levels()],
+                       [m.stats() for m in plain._levels()])
+
+      # lookups and counters through a lower level
+      for c in (plain, c1):
+         c.lower_mem.reset_stats()
+         for k in 'abcdefgh':
+            try:
+               c.lower_mem[k]
+            except CacheMiss:
+               pass
+      self.assertEqual([m.stats() for m in c1._levels()],
+                       [m.stats() for m in plain._levels()])
+      self.assertEqual(CacheTest.cascade_dump(c1),
+                       CacheTest.cascade_dump(plain))
+      stats = [m.stats() for m in c1._levels()]
+      c1.disable_directory()
+      self.assertEqual([m.stats() for m in c1._levels()], stats)
+      c1.enable_directory()
+
+      c1.lower_mem.clear()
+      self.assertEqual(c1._directory,
+                       {k: m for m in (levels[0], levels[2]) for k in m})
+      c1.disable_directory()
+      self.assertTrue(all(m._directory is None for m in levels))
+      c4 = Cache(1, lower_mem=SharedMemoryCache(1))
+      with self.assertRaises(ValueError):
+         c4.enable_directory()
+      c4.lower_mem.close()
+      c4.lower_mem.unlink()
+
+   def test_directory_with_bstore(self):
+      CacheTest.rm_bstore_files('foo')
+      bs = BackingStore(3, 'foo')
+      c2 = Cache(2, lower_mem=bs)
+      c1 = Cache(1, lower_mem=c2)
+      c1.enable_directory()
+      with c1:
+         for k, v in zip('abcdef', range(1, 7)):
+            c1[k] = v
+         self.assertEqual(c1['a'], 1)
+         self.assertEqual(c1._directory['a'], c1)
+         with self.assertRaises(CacheMiss):
+            c1['zz']
+         self.assertEqual(c1._directory,
+                          {k: m for m in (c1, c2) for k in m})
+      CacheTest.rm_bstore_files('foo')
+
+   def test_bstore_bloom_filter(self):
+      CacheTest.rm_bstore_files('foo')
+      bs = BackingStore(4, 'foo', bloom_filter=True)
+      with bs:
+         for k, v in zip('abcdef', range(1, 7)):
+            bs[k] = v
+         keys = set(bs.keys())
+         self.assertEqual(len(keys), 4)
+         for k in keys:
+            self.assertIn(k, bs)
+         skips = bs.bloom_skips()
+         for i in range(50):
+            self.assertNotIn('missing' + str(i), bs)
+            self.assertIsNone(bs.get('missing' + str(i)))
+         self.assertGreater(bs.bloom_skips(), skips)
+         with self.assertRaises(KeyError):
+            bs['missing']
+         self.assertEqual(bs.pop('missing', 'dflt'), 'dflt')
+
+         for k in list(keys):
+            del bs[k]
+         bs.set_many({'x': 24, 'y': 25})
+         self.assertEqual(bs['x'], 24)
+         self.assertEqual(set(bs.keys()), {'x', 'y'})
+         bs.clear()
+         self.assertNotIn('x', bs)
+         bs['z'] = 26
+
+      with BackingStore(4, 'foo', bloom_filter=True) as bs:
+         self.assertEqual(bs['z'], 26)
+         self.assertNotIn('x', bs)
+
+      bs = BackingStore(3, 'foo', bloom_filter=True)
+      c1 = Cache(1, lower_mem=bs)
+      with c1:
+         c1['a'] = 1
+         c1['b'] = 2
+         self.assertEqual(c1['z'], 26)
+         self.assertEqual(c1['a'], 1)
+         with self.assertRaises(CacheMiss):
+            c1['missing']
+      CacheTest.rm_bstore_files('foo')
+
+   def test_negative_ttl(self):
+      c2 = Cache(2)
+      c1 = Cache(2, lower_mem=c2, negative_ttl=60)
+      c1['a'] = 1
+      c1.reset_stats()
+      c2.reset_stats()
+      self.assertEqual(c1.stats(),
+                       {'hits': 0, 'misses': 0, 'negative_hits': 0})
+      with self.assertRaises(CacheMiss):
+         c1['x']
+      self.assertEqual(c2.stats(), {'hits': 0, 'misses': 1})
+      with self.assertRaises(CacheMiss):
+         c1['x']
+      self.assertEqual(c1.stats()['negative_hits'], 1)
+      self.assertEqual(c2.stats(), {'hits': 0, 'misses': 1})
+
+      c1['x'] = 24
+      self.assertEqual(c1['x'], 24)
+      del c1['x']
+      with self.assertRaises(CacheMiss):
+         c1['x']
+
+      # bounded by capacity, oldest forgotten first
+      for k in 'yz':
+         with self.assertRaises(CacheMiss):
+            c1[k]
+      self.assertEqual(list(c1._negatives), ['y', 'z'])
+
+      # a write below self is seen once the entry expires
+      c2['z'] = 26
+      with self.assertRaises(CacheMiss):
+         c1['z']
+      c1._negatives['z'] = 0
+      self.assertEqual(c1['z'], 26)
+      self.assertNotIn('z', c1._negatives)
+
+      c1.clear()
+      self.assertEqual(len(c1._negatives), 0)
+      self.assertEqual(Cache(1).stats(), {'hits': 0, 'misses': 0})
+
+   def test_inclusive_mode(self):
+      c3 = Cache(3)
+      c2 = Cache(3, lower_mem=c3)
+      c1 = Cache(1, lower_mem=c2)
+      self.assertEqual(c1.mode, 'exclusive')
+      c1.set_mode('inclusive')
+      self.assertEqual([m.mode for m in (c1, c2, c3)], ['inclusive'] * 3)
+
+      c1['a'] = 1
+      c1['b'] = 2
+      self.assertEqual(c1['a'], 1)
+      self.assertEqual(c1._items(), [('a', Cache._Val(True, 1))])
+      self.assertEqual(c2._items(), [('a', Cache._Val(False, 1)),
+                                     ('b', Cache._Val(True, 2))])
+      # 'a' leaves L1 dirty, so its copy in L2 takes the dirty flag back
+      self.assertEqual(c1['b'], 2)
+      self.assertEqual(c2._items(), [('b', Cache._Val(False, 2)),
+                                     ('a', Cache._Val(True, 1))])
+      c2._setitem('c', 3, False)
+      self.assertEqual(c1['c'], 3)
+      self.assertEqual(c1._items(), [('c', Cache._Val(False, 3))])
+      self.assertEqual(c2._items(), [('a', Cache._Val(True, 1)),
+                                     ('c', Cache._Val(False, 3)),
+                                     ('b', Cache._Val(True, 2))])
+      # 'c' leaves L1 clean while L2 holds a copy, so L2 is left alone
+      self.assertEqual(c1['a'], 1)
+      self.assertEqual(c1._items(), [('a', Cache._Val(True, 1))])
+      self.assertEqual(c2._items(), [('c', Cache._Val(False, 3)),
+                                     ('b', Cache._Val(True, 2)),
+                                     ('a', Cache._Val(False, 1))])
+      self.assertEqual(c3._items(), [])
+      # a write removes the copies below the one written
+      c1['a'] = 10
+      self.assertEqual(c2._items(), [('c', Cache._Val(False, 3)),
+                                     ('b', Cache._Val(True, 2))])
+      c1['b'] = 20
+      self.assertEqual(c2._items(), [('c', Cache._Val(False, 3)),
+                                     ('a', Cache._Val(True, 10))])
+      self.assertEqual(c1._items(), [('b', Cache._Val(True, 20))])
+
+      with self.assertRaises(ValueError):
+         c1.enable_directory()
+      with self.assertRaises(ValueError):
+         c1.set_mode('bogus')
+      c1.set_mode('exclusive')
+      c1.enable_directory()
+      with self.assertRaises(ValueError):
+         c1.set_mode('inclusive')
+
+   def test_inclusive_mode_with_bstore(self):
+      CacheTest.rm_bstore_files('foo')
+      rnd = random.Random(7)
+      model = {}
+      bs = BackingStore(50, 'foo')
+      c2 = Cache(3, lower_mem=bs)
+      c1 = Cache(2, lower_mem=c2)
+      c1.set_mode('inclusive')
+      with c1:
+         for i in range(400):
+            k = rnd.choice('abcdefghij')
+            op = rnd.random()
+            if op < 0.3:
+               c1[k] = model[k] = i
+            elif op < 0.95:
+               if k in model:
+                  self.assertEqual(c1[k], model[k])
+               else:
+                  self.assertRaises(CacheMiss, c1.__getitem__, k)
+            else:
+               c1.capacity = rnd.choice((1, 2, 3))
+            # a key is dirty at most in the highest cache holding it
+            for key in model:
+               flags = [m._cache[key].dirty for m in (c1, c2)
+                        if key in m]
+               self.assertNotIn(True, flags[1:])
+         c1.flush().wait()
+      with BackingStore(50, 'foo') as bs:
+         self.assertEqual(dict(bs.items()), model)
+      CacheTest.rm_bstore_files('foo')
+
+   def test_clean_demotion(self):
+      with self.assertRaises(ValueError):
+         Cache(1, clean_demotion='bogus')
+      CacheTest.rm_bstore_files('foo')
+      bs = BackingStore(10, 'foo')
+      c2 = Cache(2, lower_mem=bs)
+      c1 = Cache(1, lower_mem=c2, clean_demotion='drop')
+      with c1:
+         bs.update({'a': 1, 'b': 2})
+         self.assertEqual(c1['a'], 1)
+         self.assertEqual(c1['b'], 2)
+         # 'a' is clean and held by the store, so it isn't demoted
+         self.assertEqual(len(c2), 0)
+         c1['x'] = 24
+         self.assertEqual(len(c2), 0)
+         # dirty items are demoted as usual
+         self.assertEqual(c1['a'], 1)
+         self.assertEqual(c2._items(), [('x', Cache._Val(True, 24))])
+         self.assertEqual(c1['x'], 24)
+         self.assertEqual(len(c2), 0)
+         self.assertEqual(c1['b'], 2)
+         self.assertEqual(c2._items(), [('x', Cache._Val(True, 24))])
+
+      # without a backing store, a clean item has nowhere else to be
+      c2 = Cache(2)
+      c1 = Cache(1, lower_mem=c2, clean_demotion='drop')
+      c2._setitem('a', 1, False)
+      self.assertEqual(c1['a'], 1)
+      c1['b'] = 2
+      self.assertIn('a', c2)
+      CacheTest.rm_bstore_files('foo')
+
+   def test_write_policy(self):
+      with self.assertRaises(ValueError):
+         Cache(1, write_policy='bogus')
+      CacheTest.rm_bstore_files('foo')
+      bs = BackingStore(10, 'foo')
+      c2 = Cache(2, lower_mem=bs, write_policy='write-through')
+      c1 = Cache(1, lower_mem=c2)
+      with c1:
+         c1['a'] = 1
+         self.assertNotIn('a', bs)
+         c1['b'] = 2
+         # 'a' was evicted dirty into the write-through L2
+         self.assertEqual(bs['a'], 1)
+         self.assertEqual(c2._items(), [('a', Cache._Val(False, 1))])
+         self.assertNotIn('b', bs)
+
+         c1 = Cache(2, lower_mem=c2, write_policy='write-through')
+         c1['c'] = 3
+         self.assertEqual(bs['c'], 3)
+         self.assertEqual(c1._items(), [('c', Cache._Val(False, 3))])
+
+         c1 = Cache(1, lower_mem=c2, write_policy='write-around')
+         self.assertEqual(c1['a'], 1)
+         c1['x'] = 24
+         self.assertEqual(c1._items(), [('a', Cache._Val(True, 1))])
+         self.assertEqual(bs['x'], 24)
+         self.assertEqual(c2._items(), [('x', Cache._Val(False, 24))])
+         # the copy in the write-around cache is replaced, not kept stale
+         c1['a'] = 10
+         self.assertEqual(len(c1), 0)
+         self.assertEqual(c1['a'], 10)
+
+         c2 = Cache(2, lower_mem=bs, write_policy='write-around')
+         c1 = Cache(1, lower_mem=c2, write_policy='write-around')
+         c1['y'] = 25
+         self.assertEqual((len(c1), len(c2)), (0, 0))
+         self.assertEqual(bs['y'], 25)
+
+      c1 = Cache(1, write_policy='write-around')
+      c1['z'] = 26
+      self.assertEqual(c1._items(), [('z', Cache._Val(True, 26))])
+      CacheTest.rm_bstore_files('foo')
+
+      # a key written through stays in a full store making room below
+      bs = BackingStore(2, 'foo')
+      c2 = Cache(1, lower_mem=bs)
+      c1 = Cache(1, lower_mem=c2, write_policy='write-through')
+      with c1:
+         c2['d'] = 4
+         c1['j'] = 1
+         c1['k'] = 2
+         self.assertEqual(CacheTest.cascade_dump(c1),
+                          "cascade dump:\n"
+                          "   Cache: [(k, (False, 2))]\n"
+                          "   Cache: [(j, (True, 1))]\n"
+                          "   BackingStore: [('d', 4), ('k', 2)]\n")
+      CacheTest.rm_bstore_files('foo')
+
+   def test_views(self):
+      c = Cache(3, [('a', 1), ('b', 2)])
+      items, keys, values = c.items(), c.keys(), c.values()
+      self.assertNotIsInstance(items, list)
+      c['c'] = 3
+      self.assertEqual(items, [('a', 1), ('b', 2), ('c', 3)])
+      self.assertEqual(list(keys), ['a', 'b', 'c'])
+      self.assertEqual(values, (1, 2, 3))
+      self.assertEqual(len(items), 3)
+      self.assertIn('b', keys)
+      self.assertIn(('b', 2), items)
+      self.assertNotIn(4, values)
+      self.assertEqual(Cache(3, c.items()), c)
+
+      class DeferredExecutor():
+         def submit(self, fn, *args):
+            self.call = fn, args
+            return concurrent.futures.Future()
+
+      CacheTest.rm_bstore_files('foo')
+      with BackingStore(10, 'foo') as bs:
+         for k, v in zip('abcdef', range(1, 7)):
+            bs[k] = v
+         executor = DeferredExecutor()
+         bs.set_many({'b': 20, 'p': 16}, executor)
+         expected = dict(zip('abcdef', range(1, 7)), b=20, p=16)
+         self.assertEqual(dict(bs.items(batch_size=2)), expected)
+         self.assertEqual(sorted(bs.values(batch_size=4)),
+                          sorted(expected.values()))
+         self.assertEqual(len(bs.keys()), 7)
+         self.assertIn('p', bs.keys())
+
+         it = iter(bs.keys(batch_size=2))
+         first = next(it)
+         removed = next(k for k in 'abcdef' if k != first)
+         del bs[removed]
+         rest = list(it)
+         self.assertEqual(len(rest) + 1, len(set(rest) | {first}))
+         self.assertLessEqual(set(rest) | {first}, set(expected))
+         self.assertIn('p', rest)
+
+         fn, args = executor.call
+         fn(*args)
+         del expected[removed]
+         self.assertEqual(str(bs), 'BackingStore: [{}]'.format(
+            ', '.join(str(p) for p in sorted(expected.items()))))
+         it = iter(bs.items(batch_size=1))
+         next(it)
+      with self.assertRaises(BStoreClosedError):
+         next(it)
+
+      # a batch written to the database while iterating isn't missed
+      CacheTest.rm_bstore_files('foo')
+      with BackingStore(10, 'foo') as bs:
+         bs['a'] = 1
+         executor = DeferredExecutor()
+         bs.set_many({'b': 2, 'c': 3}, executor)
+         it = iter(bs.items(batch_size=1))
+         self.assertEqual(next(it), ('a', 1))
+         fn, args = executor.call
+         fn(*args)
+         self.assertEqual(sorted(it), [('b', 2), ('c', 3)])
+         self.assertEqual(len(bs), 3)
+
+      # only the first pairs by key are listed
+      CacheTest.rm_bstore_files('foo')
+      with BackingStore(200, 'foo') as bs:
+         for i in reversed(range(150)):
+            bs['k{:03}'.format(i)] = i
+         self.assertEqual(str(bs), 'BackingStore: [{}, ...]'.format(
+            ', '.join(str(('k{:03}'.format(i), i)) for i in range(100))))
+      CacheTest.rm_bstore_files('foo')
+
+   def test_bstore_scan(self):
+      from cache import _SortedKeys
+
+      class SmallRuns(_SortedKeys):
+         _RUN = 4
+
+      rnd = random.Random(3)
+      index, model = SmallRuns(['m', 'c']), {'m', 'c'}
+      for i in range(500):
+         k = str(rnd.randrange(100))
+         if rnd.random() < 0.6:
+            index.add(k)
+            model.add(k)
+         else:
+            index.discard(k)
+            model.discard(k)
+         self.assertEqual(len(index), len(model))
+      self.assertEqual(index.after(None, 1000), sorted(model))
+      self.assertEqual(index.after('5', 3), sorted(model)[
+         sorted(model).index(min(k for k in model if k >= '5')):][:3])
+
+      CacheTest.rm_bstore_files('foo')
+      with self.assertRaises(ValueError):
+         with BackingStore(1, 'foo') as bs:
+            bs.scan(prefix='a')
+      bs = BackingStore(40, 'foo', ordered_index=True)
+      with bs:
+         for i in range(100):
+            bs['t{}:o{:02}'.format(i % 3, rnd.randrange(50))] = i
+            if i % 10 == 0:
+               bs.pop(next(iter(bs.keys())))
+         bs.set_many({'t0:new': 1, 't1:new': 2})
+         self.assertEqual(bs._index.after(None, 100), sorted(bs.keys()))
+         self.assertEqual(list(bs.scan(prefix='t1:', batch_size=3)),
+                          sorted((k, bs[k]) for k in bs.keys()
+                                 if k.startswith('t1:')))
+         self.assertEqual([k for k, v in bs.scan('t0:o10', 't2')],
+                          sorted(k for k in bs.keys()
+                                 if 't0:o10' <= k < 't2'))
+         self.assertEqual(list(bs.scan(prefix='t9')), [])
+         with self.assertRaises(ValueError):
+            bs.scan('a', prefix='t1')
+
+         scan = bs.scan(batch_size=2)
+         first = next(scan)[0]
+         later = sorted(bs.keys())[-1]
+         del bs[later]
+         self.assertNotIn(later, [k for k, v in scan])
+         bs.clear()
+         self.assertEqual(list(bs.scan()), [])
+         bs['x'] = 24
+
+      with BackingStore(40, 'foo', ordered_index=True) as bs:
+         self.assertEqual(list(bs.scan()), [('x', 24)])
+      CacheTest.rm_bstore_files('foo')
+
+   def test_invalidate(self):
+      CacheTest.rm_bstore_files('foo')
+      bs = BackingStore(20, 'foo')
+      c2 = Cache(2, lower_mem=bs)
+      c1 = Cache(2, lower_mem=c2)
+      with c1:
+         for i in range(4):
+            c1.set('u1:{}'.format(i), i, tags=['user1', 'all'])
+            c1.set('u2:{}'.format(i), i, tags=('user2', 'all'))
+         c1['plain'] = 0
+         self.assertEqual(c1.tags('u1:0'), {'user1', 'all'})
+         self.assertEqual(c2.tags('plain'), frozenset())
+         self.assertTrue(len(bs) > 0)
+
+         self.assertEqual(c1.invalidate_tag('user1'), 4)
+         for i in range(4):
+            self.assertRaises(CacheMiss, c1.__getitem__, 'u1:{}'.format(i))
+            self.assertEqual(c1['u2:{}'.format(i)], i)
+         self.assertEqual(c1.tags('u2:0'), {'user2', 'all'})
+         self.assertEqual(c1.invalidate_tag('user1'), 0)
+
+         # setting a key without tags drops its tags
+         c1['u2:3'] = 33
+         self.assertEqual(c1.tags('u2:3'), frozenset())
+         self.assertEqual(c1.invalidate_tag('all'), 3)
+         self.assertEqual(c1['u2:3'], 33)
+         self.assertEqual(c1['plain'], 0)
+
+         for k in ('t1:a', 't1:b', 't2:a', 't10:a', 't1:c'):
+            c1[k] = k
+         self.assertEqual(c1.invalidate_pattern('t1:*'), 3)
+         self.assertEqual(sorted(k for m in (c1, c2, bs) for k in m.keys()
+                                 if k.startswith('t')), ['t10:a', 't2:a'])
+         c1.flush()
+      with BackingStore(20, 'foo') as bs:
+         self.assertNotIn('t1:a', bs)
+         self.assertNotIn('u1:0', bs)
+         self.assertIn('t10:a', bs)
+
+      c1 = Cache(2)
+      c1.set('a', 1, ['x'])
+      c1._tag_index.sweep_at = 2
+      for k in 'bcd':
+         c1.set(k, 1, ['x'])
+      # 'a' was pruned when 'c' was set
+      self.assertEqual(sorted(c1._tag_index.keys()), ['b', 'c', 'd'])
+      self.assertEqual(c1.invalidate_tag('x'), 2)
+      self.assertEqual(len(c1), 0)
+      CacheTest.rm_bstore_files('foo')
+
+   def test_cached(self):
+      CacheTest.rm_bstore_files('foo')
+      calls = []
+
+      def create_chain():
+         return Cache(2, lower_mem=Cache(2, lower_mem=BackingStore(20, 'foo')))
+
+      c1 = create_chain()
+      with c1:
+         @cached(c1)
+         def add(a, b=0, *more, **opts):
+            calls.append((a, b))
+            return a + b
+
+         @cached(c1, namespace='other')
+         def sub(a, b=0):
+            calls.append((a, b))
+            return a - b
+
+         self.assertEqual(add(1, 2), 3)
+         self.assertEqual(add(1, 2), 3)
+         self.assertEqual(add(1, b=2, x={'p': {1, 2}, 'q': []}), 3)
+         self.assertEqual(add(1, x={'q': [], 'p': {2, 1}}, b=2), 3)
+         self.assertEqual(sub(1, 2), -1)
+         self.assertEqual(calls, [(1, 2), (1, 2), (1, 2)])
+         self.assertEqual(add.cache_info(), CacheInfo(2, 2, 0, 0))
+         self.assertEqual(add.__name__, 'add')
+         for i in range(10):
+            add(i, i)
+         self.assertEqual(add.cache_info().misses, 12)
+
+         with self.assertRaises(TypeError):
+            add(1, 'x')
+         with self.assertRaises(TypeError):
+            add(1, 'x')
+         self.assertEqual(add.cache_info().misses, 14)
+
+         @cached(c1, ttl=0)
+         def now():
+            calls.append(None)
+            return len(calls)
+
+         self.assertEqual(now(), now() - 1)
+         self.assertEqual(now.cache_info(), CacheInfo(0, 2, 0, 1))
+
+         add.cache_clear()
+         self.assertEqual(add.cache_info(), CacheInfo(0, 0, 0, 0))
+         del calls[:]
+         self.assertEqual(add(1, 2), 3)
+         self.assertEqual(sub(1, 2), -1)
+         self.assertEqual(calls, [(1, 2)])
+         c1.flush()
+
+      # results persist through the backing store
+      c1 = create_chain()
+      with c1:
+         @cached(c1, namespace='other')
+         def sub(a, b=0):
+            calls.append((a, b))
+            return a - b
+
+         del calls[:]
+         self.assertEqual(sub(1, 2), -1)
+         self.assertEqual(calls, [])
+
+         # single flight
+         started = threading.Event()
+         release = threading.Event()
+
+         @cached(c1)
+         def slow(x):
+            calls.append(x)
+            started.set()
+            release.wait()
+            return x * 2
+
+         results = []
+         threads = [threading.Thread(target=lambda: results.append(slow(4)))
+                    for i in range(5)]
+         threads[0].start()
+         started.wait()
+         for th in threads[1:]:
+            th.start()
+         while slow.cache_info().shared < 4:
+            time.sleep(0.01)
+         release.set()
+         for th in threads:
+            th.join()
+         self.assertEqual(results, [8] * 5)
+         self.assertEqual(calls, [4])
+         self.assertEqual(slow.cache_info(), CacheInfo(0, 1, 4, 0))
+      CacheTest.rm_bstore_files('foo')
+
+      # a result that can't be set doesn't block later calls
+      c1 = Cache(1, lower_mem=BackingStore(20, 'foo'))
+      with c1:
+         @cached(c1)
+         def unpicklable(x):
+            return lambda: x
+
+         self.assertEqual(unpicklable(1)(), 1)
+         with self.assertRaises(AttributeError):
+            unpicklable(2)
+         results = []
+         th = threading.Thread(
+            target=lambda: results.append(unpicklable(2)()), daemon=True)
+         th.start()
+         th.join(5)
+         self.assertEqual(results, [2])
+      CacheTest.rm_bstore_files('foo')
+
+   def test_async_cached(self):
+      CacheTest.rm_bstore_files('foo')
+      bs = BackingStore(20, 'foo')
+      c1 = Cache(1, lower_mem=Cache(1, lower_mem=bs))
+      calls = []
+      gates = {}
+
+      @async_cached(c1, namespace='fetch')
+      async def fetch(x):
+         calls.append(x)
+         await asyncio.sleep(0.01)
+         if x in gates:
+            await gates[x].wait()
+         if x < 0:
+            raise ValueError(x)
+         return x * 2
+
+      async def fan_out():
+         self.assertEqual(await asyncio.gather(*[fetch(i % 2)
+                                                 for i in range(6)]),
+                          [0, 2] * 3)
+         self.assertEqual(await fetch(1), 2)
+         for i in range(2):
+            with self.assertRaises(ValueError):
+               await fetch(-1)
+
+         # a cancelled await doesn't cancel the call for the others
+         gates[5] = asyncio.Event()
+         first = asyncio.ensure_future(fetch(5))
+         while 5 not in calls:
+            await asyncio.sleep(0.001)
+         second = asyncio.ensure_future(fetch(5))
+         while fetch.cache_info().shared < 5:
+            await asyncio.sleep(0.001)
+         first.cancel()
+         gates[5].set()
+         self.assertEqual(await second, 10)
+         self.assertTrue(first.cancelled())
+
+      with c1:
+         asyncio.run(fan_out())
+         self.assertEqual(sorted(calls), [-1, -1, 0, 1, 5])
+         self.assertEqual(fetch.cache_info(), CacheInfo(1, 5, 5, 0))
+         self.assertEqual(fetch.__name__, 'fetch')
+         c1.flush()
+
+      # results were written back to the backing store
+      c1 = Cache(1, lower_mem=bs)
+      with c1:
+         @async_cached(c1, namespace='fetch')
+         async def fetch(x):
+            calls.append(x)
+            return x * 2
+
+         del calls[:]
+         self.assertEqual(asyncio.run(fetch(1)), 2)
+         self.assertEqual(calls, [])
+      CacheTest.rm_bstore_files('foo')
+
+   def test_refresh(self):
+      data = {'a': 1, 'b': 2}
+      calls = []
+
+      def loader(k):
+         calls.append(k)
+         return data[k]
+
+      c2 = Cache(4)
+      c1 = Cache(2, lower_mem=c2)
+      with self.assertRaises(ValueError):
+         c1.enable_refresh(loader, 0)
+      with self.assertRaises(ValueError):
+         c1.enable_refresh(loader, 10, refresh_ahead=2)
+      ex = concurrent.futures.ThreadPoolExecutor(1)
+      c1.enable_refresh(loader, 10, stale_ttl=10, refresh_ahead=0.5,
+                        executor=ex)
+      r = c1._refresher
+
+      # a miss is loaded and set like a write
+      self.assertEqual(c1['a'], 1)
+      self.assertEqual(c1['a'], 1)
+      self.assertEqual(calls, ['a'])
+      with self.assertRaises(CacheMiss):
+         c1['x']
+      calls.clear()
+
+      # stale values are served while reloading in the background
+      def settle():
+         # wait for the running reloads to be handed back
+         for f in list(r.inflight.values()):
+            f.result()
+         while len(r.done) < len(r.inflight):
+            time.sleep(0.001)
+
+      data['a'] = 11
+      r.born['a'] -= 15
+      self.assertEqual(c1['a'], 1)
+      self.assertEqual(c1.stats()['stale_hits'], 1)
+      self.assertEqual(c1.stats()['refreshes'], 1)
+      settle()
+      self.assertEqual(c1['a'], 11)
+      self.assertEqual(calls, ['a'])
+      self.assertEqual(r.inflight, {})
+
+      # refresh-ahead, and too old values are reloaded before returning
+      data['a'] = 21
+      r.born['a'] -= 6
+      self.assertEqual(c1['a'], 11)
+      settle()
+      self.assertEqual(c1['a'], 21)
+      data['a'] = 31
+      r.born['a'] -= 25
+      self.assertEqual(c1['a'], 31)
+      self.assertEqual(c1.stats()['loads'], 3)
+
+      # a write made while reloading wins over the reload
+      r.born['a'] -= 15
+      self.assertEqual(c1['a'], 31)
+      settle()
+      c1['a'] = 41
+      self.assertEqual(c1['a'], 41)
+
+      # values of unknown age and recently read invalidated keys
+      c2['b'] = 0
+      self.assertEqual(c1['b'], 2)
+      c1.set('a', 51, tags=['t'])
+      c1['a']
+      c1.invalidate_tag('t')
+      self.assertEqual(c1.stats()['refreshes'], 4)
+      settle()
+      self.assertEqual(c1['a'], 31)
+
+      # a reload keeps the tags of the key
+      c1.set('a', 61, tags=['t'])
+      r.born['a'] -= 15
+      self.assertEqual(c1['a'], 61)
+      settle()
+      self.assertEqual(c1['a'], 31)
+      self.assertEqual(c1.tags('a'), frozenset({'t'}))
+      r.born['a'] -= 25
+      self.assertEqual(c1['a'], 31)
+      self.assertEqual(c1.tags('a'), frozenset({'t'}))
+      self.assertEqual(c1.invalidate_tag('t'), 1)
+      self.assertNotIn('a', c1)
+      settle()
+
+      c1.disable_refresh()
+      self.assertIsNone(c1._refresher)
+      with self.assertRaises(CacheMiss):
+         c1['x']
+      ex.shutdown()
+
+   def test_read_buffer(self):
+      c = Cache(4, lower_mem=Cache(4))
+      with self.assertRaises(ValueError):
+         c.enable_read_buffer(drain_at=0)
+      for k in 'abcd':
+         c[k] = ord(k)
+      c.enable_read_buffer(stripes=2, drain_at=2)
+      self.assertEqual(c.get('a'), 97)
+      self.assertIsNone(c.get('x'))
+      self.assertEqual(c.get('x', 0), 0)
+      self.assertEqual(list(c), ['a', 'b', 'c', 'd'])
+
+      # a full stripe is applied to the LRU order
+      c.get('b')
+      self.assertEqual(list(c), ['c', 'd', 'a', 'b'])
+
+      # evictions apply the reads first
+      c.get('c')
+      c['e'] = 101
+      self.assertEqual(list(c), ['a', 'b', 'c', 'e'])
+      self.assertEqual(c.lower_mem.keys(), ['d'])
+
+      # writes are seen by the next read
+      c['a'] = 1
+      self.assertEqual(c.get('a'), 1)
+      del c['a']
+      self.assertIsNone(c.get('a'))
+      self.assertEqual(c.get('d'), 100)
+      self.assertEqual(c.lower_mem.keys(), ['d'])
+      self.assertEqual(c['d'], 100)
+      self.assertEqual(c.get('d'), 100)
+
+      # concurrent readers and a writer
+      def read(n):
+         for i in range(n):
+            c.get(random.choice('bcdefg'))
+
+      with concurrent.futures.ThreadPoolExecutor(4) as ex:
+         futures = [ex.submit(read, 2000) for i in range(3)]
+         for i in range(500):
+            c[random.choice('fg')] = i
+         for f in futures:
+            f.result()
+      self.assertEqual(len(c), 4)
+      self.assertEqual(c, deepcopy(c))
+
+      c.disable_read_buffer()
+      self.assertFalse(c._read_buffered)
+      self.assertEqual(len(c), 4)
+
+   def test_peek(self):
+      self.rm_bstore_files('bstore')
+      bs = BackingStore(10, track_recency=True)
+      c2 = Cache(2, lower_mem=bs)
+      c1 = Cache(2, lower_mem=c2, negative_ttl=60)
+      with c1:
+         for k in 'abcdef':
+            c1[k] = ord(k)
+         c1.flush()
+         c1.reset_stats()
+         c2.reset_stats()
+         dump = self.cascade_dump(c1)
+         recent = bs.recent_keys()
+
+         self.assertEqual(c1.peek('f'), 102)
+         self.assertEqual(c1.peek('c'), 99)
+         self.assertEqual(c1.peek('a'), 97)
+         with self.assertRaises(CacheMiss):
+            c1.peek('x')
+         self.assertEqual(c1.get('a'), 97)
+         self.assertNotIn('a', c1.keys())
+         self.assertEqual(c1.get('x', 0), 0)
+         self.assertEqual(c2.peek('a'), 97)
+         self.assertEqual(c2.peek('f'), 102)
+         self.assertEqual(self.cascade_dump(c1), dump)
+         self.assertEqual(bs.recent_keys(), recent)
+         self.assertEqual(c1.stats(),
+                          {'hits': 0, 'misses': 0, 'negative_hits': 0})
+         self.assertEqual(c2.stats(), {'hits': 0, 'misses': 0})
+
+         # the misses of peek() aren't remembered as negative entries
+         with self.assertRaises(CacheMiss):
+            c1['x']
+         self.assertEqual(c1.stats()['negative_hits'], 0)
+
+         # promote goes through cache[key], and evicts the LRU item 'e'
+         # even though it was just peeked at
+         self.assertEqual(c1.peek('e'), 101)
+         self.assertEqual(c1.get('a', promote=True), 97)
+         self.assertEqual(c1.keys(), ['f', 'a'])
+         self.assertIsNone(c1.get('x', promote=True))
+
+         # the directory goes straight to the cache holding the key
+         c1.enable_directory()
+         self.assertEqual(c1.peek('c'), 99)
+         self.assertEqual(c1.peek('d'), 100)
+         self.assertEqual(c1.peek('b'), 98)
+         with self.assertRaises(CacheMiss):
+            c1.peek('x')
+      self.assertRaises(BStoreClosedError, c1.peek, 'b')
+      self.assertIsNone(c1.get('b'))
+      self.assertEqual(c1.get('a'), 97)
+      self.rm_bstore_files('bstore')
+
+   def test_bstore_durability(self):
+      self.rm_bstore_files('jstore')
+      self.rm_or_noop('jstore.journal')
+      with self.assertRaises(ValueError):
+         BackingStore(dbname='jstore', durability='sometimes')
+
+      # the journal is replayed after a crash, up to a torn record
+      bs = BackingStore(5, 'jstore', durability='fsync')
+      bs.open()
+      bs['a'] = 1
+      bs['b'] = [2]
+      del bs['a']
+      bs.set_many({'c': 3})
+      self.assertEqual(bs.verify(), (None, 2, [], 4, False))
+      bs._journal.close()
+      bs._db.close()
+      self.rm_bstore_files('jstore')
+      with open('jstore.journal', 'ab') as f:
+         f.write(b'torn')
+      report = BackingStore(5, 'jstore').verify()
+      self.assertIsNotNone(report.error)
+      self.assertEqual(report[3:], (4, True))
+      bs = BackingStore(5, 'jstore', durability='group', group_commit_ms=1)
+      with bs:
+         self.assertEqual(bs.items(), [('b', [2]), ('c', 3)])
+
+         # the journal is emptied every capacity records
+         for i in range(5):
+            bs[str(i)] = i
+         self.assertEqual(bs._journal_records, 2)
+         time.sleep(0.05)
+         self.assertEqual(bs.verify().journal_records, 2)
+         self.assertEqual(len(bs), 5)
+      self.assertFalse(os.path.exists('jstore.journal'))
+
+      # unreadable values are dropped by repair()
+      with bs:
+         bs._db.dict[b'9'] = b'junk'
+         self.assertEqual(bs.verify().unreadable, ['9'])
+         self.assertRaises(ValueError, bs.repair)
+      self.assertEqual(bs.repair(), (None, 6, ['9'], 0, False))
+      self.assertEqual(bs.verify(), (None, 5, [], 0, False))
+      with bs:
+         self.assertEqual(len(bs), 5)
+         self.assertEqual(bs['4'], 4)
+
+      # the change that fills the journal is in the synced database
+      self.rm_bstore_files('jstore')
+      bs = BackingStore(3, 'jstore', durability='fsync')
+      reports = []
+      checkpoint = bs._checkpoint
+      def record_checkpoint():
+         reports.append(bs.verify())
+         checkpoint()
+      bs._checkpoint = record_checkpoint
+      with bs:
+         bs['a'] = 1
+         bs['b'] = 2
+         self.assertEqual(bs.verify().journal_records, 2)
+         bs['c'] = 3
+         self.assertEqual(reports, [(None, 3, [], 3, False)])
+         self.assertEqual(bs.verify(), (None, 3, [], 0, False))
+         del bs['a']
+         bs.pop('b')
+         self.assertEqual(bs.verify().journal_records, 2)
+         bs.popitem()
+         self.assertEqual(bs.verify(), (None, 0, [], 0, False))
+         bs['a'] = 1
+         bs['b'] = 2
+         bs.clear()
+         self.assertEqual(bs.verify(), (None, 0, [], 0, False))
+      self.rm_bstore_files('jstore')
+
+   def test_bstore_staging(self):
+      self.rm_bstore_files('sstore')
+      bs = BackingStore(4, 'sstore', stage_size=3, ordered_index=True)
+      with bs:
+         bs['a'] = 1
+         bs['b'] = 2
+         self.assertEqual(list(bs._staged), ['a', 'b'])
+         self.assertEqual(len(bs._db), 0)
+         self.assertEqual(bs['a'], 1)
+         self.assertIn('b', bs)
+         self.assertEqual(len(bs), 2)
+         self.assertEqual(list(bs.scan()), [('a', 1), ('b', 2)])
+         bs['a'] = 10
+         del bs['b']
+         self.assertEqual(list(bs._staged), ['a'])
+         self.assertEqual(len(bs), 1)
+
+         # a full buffer is committed as one group
+         bs['c'] = 3
+         bs['d'] = 4
+         self.assertEqual(bs._staged, {})
+         self.assertEqual(len(bs._db), 3)
+         self.assertEqual(bs.items(), [('a', 10), ('c', 3), ('d', 4)])
+
+         # room is made once per group
+         for k in 'efg':
+            bs[k] = k
+         self.assertEqual(len(bs), 4)
+         self.assertEqual([k for k, v in bs.scan()], sorted(bs.keys()))
+         bs['h'] = 'h'
+         self.assertEqual(bs.commit().wait(), 1)
+         self.assertEqual(len(bs), 4)
+         self.assertEqual(bs['h'], 'h')
+         self.assertEqual(bs.commit().wait(), 0)
+         bs['i'] = 'i'
+      with bs:
+         self.assertEqual(len(bs), 4)
+         self.assertEqual(bs['i'], 'i')
+
+      # write-backs from a chain, and a time bound
+      bs = BackingStore(10, 'sstore', stage_size=100, stage_ms=0)
+      c = Cache(1, lower_mem=bs)
+      with c:
+         bs.clear()
+         c['a'] = 1
+         c['b'] = 2
+         self.assertEqual(bs._staged, {})
+         self.assertEqual(bs['a'], 1)
+         self.assertEqual(c['a'], 1)
+      self.rm_bstore_files('sstore')
+
+   def test_store_manager(self):
+      names = ['mstore' + str(i) for i in range(4)]
+      for n in names:
+         self.rm_bstore_files(n)
+      with self.assertRaises(ValueError):
+         StoreManager(0)
+      m = StoreManager(2)
+      stores = [m.store(n, 5) for n in names]
+      self.assertIs(m.store('mstore0'), stores[0])
+      with self.assertRaises(ValueError):
+         BackingStore(dbname='mstore0', manager=m)
+
+      # databases open on first access, least recently used closed first
+      for bs in stores:
+         bs.open()
+      self.assertFalse(stores[0].closed())
+      self.assertEqual(m.open_count(), 0)
+      for i, bs in enumerate(stores):
+         bs['k'] = i
+      self.assertEqual(m.open_count(), 2)
+      self.assertTrue(stores[0]._db is None)
+      stores[2]['j'] = 2
+      self.assertEqual(stores[0]['k'], 0)
+      self.assertIsNotNone(stores[2]._db)
+      self.assertIsNone(stores[3]._db)
+      self.assertEqual([bs['k'] for bs in stores], [0, 1, 2, 3])
+      self.assertEqual(m.stats(), {'opens': 8, 'closes': 6})
+
+      # a store in use isn't closed
+      m2 = StoreManager(1)
+      a = BackingStore(dbname='mstore0', manager=m2)
+      b = BackingStore(dbname='mstore1', manager=m2)
+      with a, b:
+         a.update(b)
+         self.assertEqual(m2.open_count(), 2)
+      with a:
+         self.assertEqual(a['k'], 1)
+
+      # closing a database keeps staged writes and the built state
+      del a
+      a = BackingStore(5, 'mstore0', manager=m2, stage_size=10,
+                       bloom_filter=True, ordered_index=True)
+      with a, b:
+         a['s'] = 's'
+         bloom = a._bloom
+         b['k']
+         self.assertIsNone(a._db)
+         self.assertEqual(a.verify().entries, 1)
+         self.assertEqual(a['s'], 's')
+         self.assertIs(a._bloom, bloom)
+         self.assertEqual(list(a.scan()), [('k', 1), ('s', 's')])
+         keys = iter(a.keys(batch_size=1))
+         next(keys)
+         b['k']
+         self.assertIsNotNone(a._db)
+         self.assertEqual(list(keys), ['s'])
+         b['k']
+      self.assertEqual(a.verify().entries, 2)
+
+      # a chain over a managed store
+      c = Cache(1, lower_mem=stores[3])
+      c['x'] = 'x'
+      c['y'] = 'y'
+      m.close_all()
+      self.assertEqual(m.open_count(), 0)
+      self.assertEqual(c['x'], 'x')
+      for bs in stores:
+         bs.close()
+      self.assertTrue(stores[0].closed())
+      sc = ShardedCache.with_bstores(8, dbname='mstore', manager=m)
+      with sc:
+         for i in range(40):
+            sc['key' + str(i)] = i
+         sc.flush().wait()
+         self.assertEqual(sc['key7'], 7)
+         self.assertLessEqual(m.open_count(), 2)
+      self.assertEqual(m.open_count(), 0)
+      with self.assertRaises(BStoreClosedError):
+         stores[0]['k']
+      for n in names + ['mstore-' + str(i) for i in range(8)]:
+         self.rm_bstore_files(n)
+
+   def test_bstore_lazy_open(self):
+      self.rm_bstore_files('lstore')
+      self.rm_or_noop('lstore.meta')
+      with BackingStore(50, 'lstore') as bs:
+         for i in range(50):
+            bs[str(i)] = i
+
+      # trimmed by a few keys on each write rather than on open
+      bs = BackingStore(10, 'lstore', lazy_open=True, ordered_index=True)
+      with bs:
+         self.assertEqual(len(bs), 50)
+         sizes = []
+         for k in 'abcdef':
+            bs[k] = k
+            sizes.append(len(bs))
+         self.assertEqual(sizes, [42, 34, 26, 18, 10, 10])
+         self.assertEqual(len(list(bs.scan())), 10)
+         self.assertEqual(bs['f'], 'f')
+         del bs['f']
+         self.assertEqual(bs.pop('e'), 'e')
+         bs.set_many({'x': 1, 'y': 2, 'z': 3})
+         self.assertEqual(len(bs), 10)
+      self.assertTrue(os.path.exists('lstore.meta'))
+
+      # the saved count is used instead of counting, then forgotten
+      with open('lstore.meta', 'wb') as f:
+         pickle.dump(999, f)
+      with bs:
+         self.assertEqual(len(bs), 999)
+         self.assertFalse(os.path.exists('lstore.meta'))
+      with BackingStore(10, 'lstore') as bs:
+         self.assertEqual(len(bs), 10)
+         self.assertFalse(os.path.exists('lstore.meta'))
+      self.rm_bstore_files('lstore')
+
+   def test_max_entry_size(self):
+      self.rm_bstore_files('bstore')
+      bs = BackingStore(10)
+      c3 = Cache(2, lower_mem=bs)
+      c2 = Cache(2, lower_mem=c3, max_entry_size=100, sizeof=len)
+      c1 = Cache(2, lower_mem=c2, max_entry_size=10, sizeof=len)
+      self.assertEqual(c1.stats(), {'hits': 0, 'misses': 0,
+                                    'admitted': 0, 'bypassed': 0})
+      with c1:
+         c1['a'] = 'a'
+         c1['m'] = 'm' * 50
+         c1['l'] = 'l' * 500
+         self.assertEqual(c1.keys(), ['a'])
+         self.assertEqual(c2.keys(), ['m'])
+         self.assertEqual(c3.keys(), ['l'])
+         self.assertEqual(c1.stats()['bypassed'], 2)
+         self.assertEqual(c2.stats()['bypassed'], 1)
+
+         # reads promote a large item only as high as it is admitted
+         c1['b'] = 'b'
+         self.assertEqual(c1['l'], 'l' * 500)
+         self.assertEqual(c1['m'], 'm' * 50)
+         self.assertEqual(c1.keys(), ['a', 'b'])
+         self.assertEqual(c2.keys(), ['m'])
+         self.assertEqual(c3.keys(), ['l'])
+
+         # a large write replaces the small copy held by a level
+         c1['a'] = 'a' * 20
+         self.assertEqual(c1.keys(), ['b'])
+         self.assertEqual(c2.keys(), ['m', 'a'])
+         self.assertEqual(c1['a'], 'a' * 20)
+         c1.flush()
+      with c1:
+         self.assertEqual(bs['l'], 'l' * 500)
+
+      # the bottom of a chain admits everything
+      c = Cache(1, max_entry_size=1)
+      c['big'] = 'x' * 100
+      self.assertEqual(c.keys(), ['big'])
+      self.rm_bstore_files('bstore')
+
 if __name__ == '__main__':
    unittest.main()